@@ -5,7 +5,7 @@ import { useQuery } from "@tanstack/react-query";
 
 import Input from "./chat_components/Input";
 import Chat from "./chat_components/Chat";
-import { Author, ChatEntryData } from "./api/api_types";
+import { Author, ChatDeltaData, ChatEntryData } from "./api/api_types";
 import Header from "./Header";
 
 const Container = styled.div`
@@ -61,9 +61,20 @@ function App() {
   );
 
   const updateLastChat = useCallback(
-    (content: string) => {
+    (chat: ChatEntryData) => {
       setChats((chats) => {
-        chats[chats.length - 1].content = content;
+        chats[chats.length - 1] = { ...chats[chats.length - 1], content: chat.content, context: chat.context };
+        return [...chats]
+      });
+    },
+    [setChats]
+  );
+
+  const appendToLastChat = useCallback(
+    (delta: string) => {
+      setChats((chats) => {
+        const last = chats[chats.length - 1];
+        chats[chats.length - 1] = { ...last, content: last.content + delta };
         return [...chats]
       });
     },
@@ -77,7 +88,7 @@ function App() {
       sse.onmessage = (e) => {
         const parsed_chat: ChatEntryData = JSON.parse(e.data)
         if (parsed_chat.isTransient){
-          updateLastChat(parsed_chat.content)
+          updateLastChat(parsed_chat)
         } else {
           addChat(parsed_chat);
         }
@@ -86,6 +97,11 @@ function App() {
           setLoadingResponse(false);
         }
       }
+      // Answer text streams in as deltas appended to the entry the last message started
+      sse.addEventListener("delta", (e) => {
+        const parsed_delta: ChatDeltaData = JSON.parse((e as MessageEvent).data)
+        appendToLastChat(parsed_delta.delta)
+      })
       sse.onerror = () => {
         sse?.close();
         setLoadingResponse(false);
@@ -95,7 +111,7 @@ function App() {
       setEnabledEventSource(false);
     }
     // return () => sse?.close()
-  }, [enabledEventSource, addChat, updateLastChat]);
+  }, [enabledEventSource, addChat, updateLastChat, appendToLastChat]);
 
 
   // Note - not ideal latency-wise to issue this fetch through this useEffect -> useQuery cascade. Should just make it imperative but this is more "react-y"
@@ -9,4 +9,8 @@ export interface ChatEntryData {
     context?: string,
     isTransient?: boolean,
     isStop?: boolean
-}
\ No newline at end of file
+}
+
+export interface ChatDeltaData {
+    delta: string
+}
@@ -0,0 +1,94 @@
+import faiss
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+
+class CachedAnswer(NamedTuple):
+    question: str
+    answer: str
+    context: str
+    created: float
+
+
+class AnswerCache():
+    """ A semantic cache of answers keyed by the embedding of the standalone question they answer.
+
+        Past questions live in a small exact inner product index, a lookup hits when the closest one is at least
+        threshold similar and younger than ttl_seconds. The least recently used entry is evicted past max_entries.
+        When new sections are indexed, answers to questions those sections are relevant to are dropped so the
+        next ask is answered from the new content.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, threshold: float, invalidation_threshold: float,
+                 embedding_length=1536):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self.invalidation_threshold = invalidation_threshold
+        self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(embedding_length))
+        self._entries: OrderedDict[int, CachedAnswer] = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, embedding: list[float]) -> Optional[CachedAnswer]:
+        with self._lock:
+            entry = None
+            if self._index.ntotal > 0:
+                D, I = self._index.search(np.array([embedding], dtype=np.float32), 1)
+                id = int(I[0][0])
+                if id >= 0 and D[0][0] >= self.threshold:
+                    entry = self._entries[id]
+                    if time.time() - entry.created > self.ttl_seconds:
+                        self._remove([id])
+                        entry = None
+                    else:
+                        self._entries.move_to_end(id)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, question: str, embedding: list[float], answer: str, context: str):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(np.array([embedding], dtype=np.float32), np.array([id], dtype=np.int64))
+            self._entries[id] = CachedAnswer(question, answer, context, time.time())
+            if len(self._entries) > self.max_entries:
+                self._remove([next(iter(self._entries))])
+
+    def invalidate(self, section_embeddings: np.ndarray) -> int:
+        """ Drop answers to questions that any of the new section embeddings is relevant to, returns how many """
+        with self._lock:
+            if self._index.ntotal == 0 or len(section_embeddings) == 0:
+                return 0
+            _, _, I = self._index.range_search(np.ascontiguousarray(section_embeddings, dtype=np.float32),
+                                               self.invalidation_threshold)
+            ids = list(set(int(id) for id in I))
+            self._remove(ids)
+            self.invalidations += len(ids)
+            return len(ids)
+
+    def clear(self):
+        with self._lock:
+            self._index.reset()
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "invalidations": self.invalidations, "size": len(self._entries)}
+
+    def _remove(self, ids: list[int]):
+        if len(ids) == 0:
+            return
+        self._index.remove_ids(np.array(ids, dtype=np.int64))
+        for id in ids:
+            del self._entries[id]
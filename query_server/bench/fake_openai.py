@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import numpy as np
+from functools import lru_cache
+from typing import Optional
+from aiohttp import web
+
+EMBEDDING_LENGTH = 1536
+WORD_PATTERN = re.compile(r"\w+")
+CANNED_ANSWER = ("The extracted sections describe it in some detail, the answer is a synthetic one so only its "
+                 "length and timing matter to the benchmark.")
+UNKNOWN_ANSWER = "I don't know."
+SUMMARY = "The human asked about several synthetic articles."
+
+
+@lru_cache(maxsize=1 << 16)
+def _word_bucket(word: str) -> tuple[int, float]:
+    digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest[:4], "little") % EMBEDDING_LENGTH, 1.0 if digest[4] & 1 else -1.0
+
+
+def hash_embedding(text: str) -> np.ndarray:
+    """ A unit vector of hashed word counts. Texts sharing words are similar, so retrieval over it behaves
+        like retrieval over real embeddings for the purposes of timing, and it costs microseconds to compute.
+    """
+    vector = np.zeros(EMBEDDING_LENGTH, dtype=np.float32)
+    for word in WORD_PATTERN.findall(text.lower()):
+        bucket, sign = _word_bucket(word)
+        vector[bucket] += sign
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        vector[0] = 1.0
+        return vector
+    return vector / norm
+
+
+def _last_line_after(prompt: str, marker: str) -> str:
+    return prompt[prompt.rindex(marker) + len(marker):].split("\n", 1)[0].strip()
+
+
+def canned_completion(prompt: str, answer_words: int, unknown_rate: float) -> str:
+    """ A completion shaped like the one each prompt in prompts.py expects """
+    if "Standalone Question:" in prompt:
+        # Keep rewritten questions distinct so chats do not all hit the same cached answer
+        return " " + _last_line_after(prompt, "Follow Up Question:")
+    if "New summary:" in prompt:
+        return " " + SUMMARY
+    if "search queries for wikipedia" in prompt:
+        # One query per line, the question itself finds its page through title search
+        return "\n" + _last_line_after(prompt, "Question:").rstrip("?")
+    if random.random() < unknown_rate:
+        return " " + UNKNOWN_ANSWER
+    words = CANNED_ANSWER.split(" ")
+    return " " + " ".join(words[i % len(words)] for i in range(answer_words))
+
+
+class FakeOpenAI():
+    """ A local stand in for the OpenAI embeddings and completions endpoints, served on a background thread.
+
+        Embeddings are hash_embedding, completions are canned_completion and stream word by word as server sent
+        events when asked to. Latencies are added to every request so the server can be loaded as if it were
+        talking to the real API without paying for it. Point openai at it by setting openai.api_base, or the
+        OPENAI_API_BASE environment variable of another process, to url.
+    """
+
+    def __init__(self, port: int = 0, embedding_latency: float = 0.0, completion_latency: float = 0.0,
+                 token_interval: float = 0.0, answer_words: int = 40, unknown_rate: float = 0.0):
+        self.port = port
+        self.embedding_latency = embedding_latency
+        self.completion_latency = completion_latency
+        self.token_interval = token_interval
+        self.answer_words = answer_words
+        self.unknown_rate = unknown_rate
+        self.embedding_requests = 0
+        self.embedded_texts = 0
+        self.completion_requests = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def stats(self) -> dict:
+        return {"embedding_requests": self.embedding_requests, "embedded_texts": self.embedded_texts,
+                "completion_requests": self.completion_requests}
+
+    def start(self) -> str:
+        """ Start serving and return the api base url """
+        started = threading.Event()
+        self._loop = asyncio.new_event_loop()
+
+        def serve():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start_site())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=serve, name="fake-openai", daemon=True)
+        self._thread.start()
+        started.wait()
+        return self.url
+
+    def stop(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    async def _start_site(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v1/embeddings", self._embeddings)
+        app.router.add_post("/v1/completions", self._completions)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", self.port)
+        await site.start()
+        # Port 0 picks a free port
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def _embeddings(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        texts = [body["input"]] if isinstance(body["input"], str) else body["input"]
+        self.embedding_requests += 1
+        self.embedded_texts += len(texts)
+        if self.embedding_latency > 0:
+            await asyncio.sleep(self.embedding_latency)
+        data = [{"object": "embedding", "index": i, "embedding": hash_embedding(text).tolist()} for i, text in enumerate(texts)]
+        # Words stand in for tokens, so the server's token counters move
+        tokens = sum(len(text.split()) for text in texts)
+        return web.json_response({"object": "list", "data": data, "model": body.get("model"),
+                                  "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+    async def _completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.completion_requests += 1
+        text = canned_completion(body["prompt"], self.answer_words, self.unknown_rate)
+        if self.completion_latency > 0:
+            await asyncio.sleep(self.completion_latency)
+        if not body.get("stream"):
+            return web.json_response(self._completion(body, text, "stop"))
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        pieces = re.findall(r"\s*\S+", text)
+        for i, piece in enumerate(pieces):
+            if i > 0 and self.token_interval > 0:
+                await asyncio.sleep(self.token_interval)
+            event = self._completion(body, piece, "stop" if i == len(pieces) - 1 else None)
+            await response.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def _completion(self, body: dict, text: str, finish_reason: Optional[str]) -> dict:
+        return {"id": "cmpl-bench", "object": "text_completion", "model": body.get("model"),
+                "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": finish_reason}]}
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description="Serve local stand ins for the OpenAI embeddings and completions endpoints")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="seconds added to every embedding request")
+    parser.add_argument("--completion-latency", type=float, default=0.0, help="seconds before a completion starts")
+    parser.add_argument("--token-interval", type=float, default=0.0, help="seconds between streamed words")
+    parser.add_argument("--answer-words", type=int, default=40, help="words in a canned answer")
+    parser.add_argument("--unknown-rate", type=float, default=0.0, help="fraction of answers that are \"I don't know\"")
+    args = parser.parse_args()
+    with FakeOpenAI(args.port, args.embedding_latency, args.completion_latency, args.token_interval,
+                    args.answer_words, args.unknown_rate) as server:
+        print(f"Serving on {server.url}, set OPENAI_API_BASE to it")
+        while True:
+            time.sleep(3600)
@@ -0,0 +1,170 @@
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+import aiohttp
+from typing import Optional
+from bench.fake_openai import FakeOpenAI
+from bench.results import DEFAULT_TOLERANCE, compare, print_results, run_meta, summarize, write_results
+from bench.synthetic_dump import SyntheticWiki
+from bench.workspace import prepare_workspace
+
+DEFAULT_CONCURRENCY = [1, 8, 32]
+SERVER_LOG = "server.log"
+SERVER_START_SECONDS = 120
+# ChatEntry.author of a question
+USER_AUTHOR = 1
+CHAT_EVENTS = (b"event: message", b"event: delta")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(root: str, env: dict[str, str], port: int, workers: int) -> subprocess.Popen:
+    """ Serve main:app from a workspace with uvicorn and wait until it accepts requests. The server opens the
+        workspace's store read only, so pages the fallback adds are kept by the worker and never reach the store.
+    """
+    env = dict(env)
+    if workers > 1:
+        # Sessions are created by one worker and streamed by another
+        env["SESSION_BACKEND"] = "sqlite"
+    log_path = os.path.join(root, SERVER_LOG)
+    with open(log_path, 'w') as log:
+        server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(workers),
+                                   "--log-level", "warning"], cwd=root, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + SERVER_START_SECONDS
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"The server exited with {server.returncode}, see {log_path}")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/", timeout=1)
+            return server
+        except urllib.error.HTTPError:
+            # Any response means it is up
+            return server
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f"The server did not start within {SERVER_START_SECONDS} seconds, see {log_path}")
+
+
+async def chat(session: aiohttp.ClientSession, url: str, question: str) -> tuple[float, float, int]:
+    """ Ask one question the way the frontend does, returns the seconds to the first event, to the end of the
+        stream, and the number of events
+    """
+    start = time.perf_counter()
+    async with session.post(f"{url}/create_streaming_chat", json=[{"content": question, "author": USER_AUTHOR}]) as response:
+        response.raise_for_status()
+        # The cookie is marked secure, so pass it on by hand rather than through a cookie jar
+        session_id = response.cookies["session_id"].value
+    first_event, events = None, 0
+    async with session.get(f"{url}/get_streaming_chat_response", headers={"Cookie": f"session_id={session_id}"}) as response:
+        response.raise_for_status()
+        async for line in response.content:
+            if line.startswith(CHAT_EVENTS):
+                events += 1
+                if first_event is None:
+                    first_event = time.perf_counter() - start
+    total = time.perf_counter() - start
+    return first_event if first_event is not None else total, total, events
+
+
+async def run_level(url: str, questions: list[str], concurrency: int, timeout: float) -> tuple[list[tuple], list[str], float]:
+    """ Send every question with concurrency chats in flight, returns the (first event, total, events) of the chats
+        that succeeded, the errors of the rest and the elapsed seconds
+    """
+    pending = iter(questions)
+    completed, errors = [], []
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency), cookie_jar=aiohttp.DummyCookieJar(),
+                                     timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        async def user():
+            for question in pending:
+                try:
+                    completed.append(await chat(session, url, question))
+                except Exception as e:
+                    errors.append(f"{type(e).__name__}: {e}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(concurrency)))
+        return completed, errors, time.perf_counter() - start
+
+
+def load_results(url: str, wiki: SyntheticWiki, levels: list[int], requests: int, timeout: float, pages: Optional[int]) -> list[dict]:
+    """ Run each concurrency level in turn, every client sends requests chats. Questions are never repeated, so
+        no level is served from answers cached by an earlier one.
+    """
+    results = []
+    # Not timed, the first chat loads the tokenizer and opens connections
+    asyncio.run(run_level(url, [wiki.question()], 1, timeout))
+    for concurrency in levels:
+        questions = [wiki.question() for _ in range(concurrency * requests)]
+        completed, errors, elapsed = asyncio.run(run_level(url, questions, concurrency, timeout))
+        if len(completed) == 0:
+            raise RuntimeError(f"Every chat failed at a concurrency of {concurrency}, the first with {errors[0]}")
+        if len(errors) > 0:
+            print(f"{len(errors)} chats failed at a concurrency of {concurrency}, the first with {errors[0]}")
+        first_events, totals, events = zip(*completed)
+        extra = {"pages": pages, "errors": len(errors), "events_per_chat": sum(events) / len(events)}
+        results.append(summarize("chat_first_event", concurrency, list(first_events), elapsed, **extra))
+        results.append(summarize("chat_total", concurrency, list(totals), elapsed, **extra))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the streaming chat endpoints of main.py with concurrent clients, "
+                                                 "reports latency to the first event and to the end of the stream, and throughput")
+    parser.add_argument("--url", help="server to load, by default one is started on a synthetic workspace and a local OpenAI stand in")
+    parser.add_argument("--concurrency", type=lambda levels: [int(level) for level in levels.split(",")], default=DEFAULT_CONCURRENCY,
+                        help="comma separated numbers of chats in flight, each is run in turn")
+    parser.add_argument("--requests", type=int, default=10, help="chats sent by each client")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds before a chat counts as failed")
+    parser.add_argument("--pages", type=int, default=1000, help="number of pages in the synthetic dump")
+    parser.add_argument("--root", default="bench_workspaces", help="where workspaces are built, they are reused between runs")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes used to build a workspace")
+    parser.add_argument("--server-workers", type=int, default=1, help="uvicorn workers of the started server")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--embedding-latency", type=float, default=0.02, help="seconds the stand in takes per embedding request")
+    parser.add_argument("--completion-latency", type=float, default=0.3, help="seconds before the stand in starts a completion")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="seconds between the words the stand in streams")
+    parser.add_argument("--unknown-rate", type=float, default=0.0, help="fraction of answers that are \"I don't know\", "
+                                                                        "which sends those chats through the fallback")
+    parser.add_argument("--output", default="bench_load.json", help="path to write the results to")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against, exits with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="p50 growth over the baseline counted as a regression")
+    args = parser.parse_args()
+
+    wiki = SyntheticWiki(args.pages, args.seed)
+    meta = run_meta(vars(args))
+    if args.url:
+        results = load_results(args.url.rstrip("/"), wiki, args.concurrency, args.requests, args.timeout, None)
+    else:
+        with FakeOpenAI(embedding_latency=args.embedding_latency, completion_latency=args.completion_latency,
+                        token_interval=args.token_interval, unknown_rate=args.unknown_rate) as stand_in:
+            root = os.path.abspath(os.path.join(args.root, f"pages_{args.pages}"))
+            env = prepare_workspace(root, args.pages, stand_in.url, args.workers, args.seed)
+            port = free_port()
+            server = start_server(root, env, port, args.server_workers)
+            try:
+                results = load_results(f"http://127.0.0.1:{port}", wiki, args.concurrency, args.requests,
+                                       args.timeout, args.pages)
+            finally:
+                server.terminate()
+                server.wait()
+            meta["openai_stand_in"] = stand_in.stats()
+    write_results(args.output, meta, results)
+    print_results(results)
+    print(f"Wrote {len(results)} results to {args.output}")
+    if args.baseline and len(compare(args.baseline, results, args.tolerance)) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
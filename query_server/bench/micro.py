@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from typing import Callable
+from bench.fake_openai import FakeOpenAI
+from bench.results import DEFAULT_TOLERANCE, compare, print_results, run_meta, summarize, write_results
+from bench.workspace import is_held_out, prepare_workspace, read_manifest, run_in_workspace
+
+DEFAULT_SIZES = [100, 1000, 10000]
+DEFAULT_SAMPLES = 200
+RUN_RESULTS = "micro.json"
+RUN_LOG = "micro.log"
+
+
+def time_each(items: list, operation: Callable) -> list[float]:
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        operation(item)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def _run(samples: int, output: str):
+    # Runs in a workspace with its environment, see run_in_workspace
+    from bench.fake_openai import hash_embedding
+    from bench.synthetic_dump import SyntheticWiki
+    from config import settings
+    from query_agent import QueryAgent
+    from sections import encode_with_split
+
+    manifest = read_manifest(".")
+    size = manifest["pages"]
+    # The agent opens the store read only, the pages add_page adds stay in this process
+    agent = QueryAgent(store_path=settings.wiki_db_path, index_path=settings.index_path)
+    db = agent._wikidb
+    wiki = SyntheticWiki(size, manifest["seed"])
+    rng = random.Random(manifest["seed"])
+    results = []
+
+    def record(name: str, latencies: list[float]):
+        results.append(summarize(name, size, latencies, sections=db.index.ntotal))
+
+    titles = rng.sample(wiki.titles, min(samples, len(wiki.titles)))
+    # The first read of a page decompresses its chunk unless a page next to it was read before, the second is cached
+    record("get_page_cold", time_each(titles, db.get_page))
+    record("get_page_warm", time_each(titles, db.get_page))
+
+    texts = [section.plain_text() for title in titles for section in db.get_page(title).sections]
+    record("encode_with_split", time_each(rng.sample(texts, min(samples, len(texts))), encode_with_split))
+
+    held_out = [title for i, title in enumerate(wiki.titles) if is_held_out(i)]
+    pages = [(title, db.get_page(title)) for title in rng.sample(held_out, min(samples, len(held_out)))]
+    record("add_page", time_each(pages, lambda page: db.add_page(*page)))
+
+    questions = [wiki.question() for _ in range(samples)]
+    embeddings = [hash_embedding(question) for question in questions]
+    queries = list(zip(questions, embeddings))
+    record("faiss_search", time_each(queries, lambda query: db.index.search_embeddings([query[0]], [query[1]], 4, 0)))
+    record("hybrid_search", time_each(queries, lambda query: db.index.search_embeddings([query[0]], [query[1]], 4)))
+    record("get_context_for_question", time_each(questions, agent.get_context_for_question))
+
+    db.close()
+    with open(output, 'w') as output_file:
+        json.dump(results, output_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro benchmarks of reading, splitting, adding and searching pages at several corpus sizes, "
+                                                 "against a synthetic dump and a local OpenAI stand in")
+    parser.add_argument("--sizes", type=lambda sizes: [int(size) for size in sizes.split(",")], default=DEFAULT_SIZES,
+                        help="comma separated numbers of pages in the synthetic dump")
+    parser.add_argument("--samples", type=int, default=DEFAULT_SAMPLES, help="operations timed per benchmark")
+    parser.add_argument("--root", default="bench_workspaces", help="where workspaces are built, they are reused between runs")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes used to build a workspace")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_micro.json", help="path to write the results to")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against, exits with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="p50 growth over the baseline counted as a regression")
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        _run(args.samples, args.output)
+        return
+
+    results = []
+    with FakeOpenAI() as server:
+        for size in args.sizes:
+            root = os.path.abspath(os.path.join(args.root, f"pages_{size}"))
+            env = prepare_workspace(root, size, server.url, args.workers, args.seed)
+            print(f"Benchmarking {size} pages, output in {os.path.join(root, RUN_LOG)}")
+            run_in_workspace(root, env, "bench.micro", "--run", "--samples", str(args.samples), "--output", RUN_RESULTS,
+                             log_path=os.path.join(root, RUN_LOG))
+            with open(os.path.join(root, RUN_RESULTS), 'r') as results_file:
+                results.extend(json.load(results_file))
+        meta = run_meta(vars(args))
+        meta["openai_stand_in"] = server.stats()
+    write_results(args.output, meta, results)
+    print_results(results)
+    print(f"Wrote {len(results)} results to {args.output}")
+    if args.baseline and len(compare(args.baseline, results, args.tolerance)) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
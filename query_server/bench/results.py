@@ -0,0 +1,80 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+from typing import Optional
+
+# A result is slower than its baseline when its p50 grew by more than this fraction
+DEFAULT_TOLERANCE = 0.2
+
+
+def summarize(name: str, size: int, latencies: list[float], elapsed: Optional[float] = None, **extra) -> dict:
+    """ One result row from per operation latencies in seconds. Throughput is operations over elapsed seconds,
+        the sum of the latencies when the operations ran one after the other.
+    """
+    latencies_ms = np.array(latencies) * 1000
+    elapsed = elapsed if elapsed is not None else float(np.sum(latencies))
+    return {
+        "name": name,
+        "size": size,
+        "count": len(latencies),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "mean_ms": float(np.mean(latencies_ms)),
+        "ops_per_s": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        **extra,
+    }
+
+
+def run_meta(args: dict) -> dict:
+    """ Where and how a run happened, so results from different machines or commits are not compared blindly """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": args,
+    }
+
+
+def write_results(path: str, meta: dict, results: list[dict]):
+    with open(path, 'w') as results_file:
+        json.dump({"meta": meta, "results": results}, results_file, indent=2)
+
+
+def compare(baseline_path: str, results: list[dict], tolerance: float = DEFAULT_TOLERANCE) -> list[dict]:
+    """ Print each result's p50 and p99 next to the same (name, size) in a baseline results file,
+        returns the results whose p50 regressed by more than tolerance
+    """
+    with open(baseline_path, 'r') as baseline_file:
+        baseline = {(result["name"], result["size"]): result for result in json.load(baseline_file)["results"]}
+    regressions = []
+    print(f"{'benchmark':<32}{'size':>8}{'p50 ms':>12}{'base':>10}{'p99 ms':>12}{'base':>10}{'change':>9}")
+    for result in results:
+        old = baseline.get((result["name"], result["size"]))
+        if old is None:
+            print(f"{result['name']:<32}{result['size']:>8}{result['p50_ms']:>12.3f}{'-':>10}{result['p99_ms']:>12.3f}{'-':>10}")
+            continue
+        change = result["p50_ms"] / old["p50_ms"] - 1 if old["p50_ms"] > 0 else 0.0
+        regressed = change > tolerance
+        if regressed:
+            regressions.append(result)
+        print(f"{result['name']:<32}{result['size']:>8}{result['p50_ms']:>12.3f}{old['p50_ms']:>10.3f}"
+              f"{result['p99_ms']:>12.3f}{old['p99_ms']:>10.3f}{change:>+9.0%}{'  REGRESSED' if regressed else ''}")
+    return regressions
+
+
+def print_results(results: list[dict]):
+    print(f"{'benchmark':<32}{'size':>8}{'count':>8}{'p50 ms':>12}{'p99 ms':>12}{'ops/s':>12}")
+    for result in results:
+        print(f"{result['name']:<32}{result['size']:>8}{result['count']:>8}{result['p50_ms']:>12.3f}"
+              f"{result['p99_ms']:>12.3f}{result['ops_per_s']:>12.1f}")
@@ -0,0 +1,128 @@
+import bz2
+import numpy as np
+from typing import Iterable
+from xml.sax.saxutils import escape
+
+SYLLABLES = [consonant + vowel for consonant in "bdfgklmnprstvz" for vowel in "aeiou"]
+VOCABULARY_SIZE = 5000
+# Real dumps hold 100 pages per bz2 stream
+PAGES_PER_STREAM = 100
+HEADER = ('<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" xml:lang="en">\n'
+          '  <siteinfo>\n    <sitename>Wikipedia</sitename>\n  </siteinfo>\n')
+FOOTER = '</mediawiki>\n'
+
+
+class SyntheticWiki():
+    """ Deterministic made up articles shaped like wikipedia ones, for benchmarks that cannot use the real dump.
+
+        Words are drawn from a vocabulary of pronounceable nonsense with a zipf like distribution, so BM25 and
+        hashed embeddings see a realistic mix of common and rare terms. Pages have a lead, a few sections with
+        internal links, the trailing sections indexing discards, and now and then a section long enough to be
+        split or a redirect.
+    """
+
+    def __init__(self, page_count: int, seed: int = 0):
+        self.rng = np.random.default_rng(seed)
+        self.vocabulary = self._vocabulary()
+        weights = 1 / (np.arange(len(self.vocabulary)) + 10)
+        self.word_weights = weights / weights.sum()
+        self.titles = self._titles(page_count)
+
+    def _vocabulary(self) -> list[str]:
+        words = set()
+        while len(words) < VOCABULARY_SIZE:
+            words.add("".join(self.rng.choice(SYLLABLES, size=self.rng.integers(1, 4))))
+        # Shorter words are the more common ones, sorted fully so the order does not depend on hash seeds
+        return sorted(words, key=lambda word: (len(word), word))
+
+    def _titles(self, page_count: int) -> list[str]:
+        titles: dict[str, None] = {}
+        while len(titles) < page_count:
+            # Skip the most common words so titles are distinctive
+            words = self.rng.choice(self.vocabulary[100:], size=self.rng.integers(1, 4))
+            titles[" ".join(word.capitalize() for word in words)] = None
+        return list(titles)
+
+    def words(self, count: int) -> list[str]:
+        return list(self.rng.choice(self.vocabulary, size=count, p=self.word_weights))
+
+    def sentence(self) -> str:
+        words = self.words(int(self.rng.integers(6, 30)))
+        if self.rng.random() < 0.2:
+            words[int(self.rng.integers(len(words)))] = f"[[{self.titles[int(self.rng.integers(len(self.titles)))]}]]"
+        return " ".join(words).capitalize() + "."
+
+    def paragraph(self, sentences: int) -> str:
+        return " ".join(self.sentence() for _ in range(sentences))
+
+    def page(self, title: str) -> str:
+        if self.rng.random() < 0.04:
+            return f"#REDIRECT [[{self.titles[int(self.rng.integers(len(self.titles)))]}]]"
+        parts = [f"'''{title}''' " + self.paragraph(int(self.rng.integers(2, 8)))]
+        for _ in range(int(self.rng.integers(1, 6))):
+            # One section in 20 runs past the section token limit
+            sentences = 150 if self.rng.random() < 0.05 else int(self.rng.integers(2, 20))
+            heading = " ".join(self.words(int(self.rng.integers(1, 4)))).capitalize()
+            parts.append(f"== {heading} ==\n" + "\n\n".join(self.paragraph(min(sentences - start, 6))
+                                                              for start in range(0, sentences, 6)))
+        see_also = self.rng.choice(self.titles, size=3)
+        parts.append("== See also ==\n" + "\n".join(f"* [[{other}]]" for other in see_also))
+        parts.append("== References ==\n{{Reflist}}")
+        return "\n\n".join(parts)
+
+    def pages(self) -> Iterable[tuple[str, str]]:
+        for title in self.titles:
+            yield title, self.page(title)
+
+    def question(self) -> str:
+        """ A question about a random page, worded from its title and common words """
+        title = self.titles[int(self.rng.integers(len(self.titles)))]
+        return f"What is {title} and how is it related to {' '.join(self.words(3))}?"
+
+
+def _page_xml(page_id: int, title: str, text: str) -> str:
+    return (f"  <page>\n    <title>{escape(title)}</title>\n    <ns>0</ns>\n    <id>{page_id}</id>\n"
+            f"    <revision>\n      <id>{page_id}</id>\n"
+            f"      <text bytes=\"{len(text.encode('utf-8'))}\" xml:space=\"preserve\">{escape(text)}</text>\n"
+            f"    </revision>\n  </page>\n")
+
+
+def write_multistream_dump(pages: Iterable[tuple[str, str]], dump_path: str, index_path: str,
+                           pages_per_stream: int = PAGES_PER_STREAM) -> int:
+    """ Write pages as a multistream bz2 dump and its start_byte:id:title index file, like the ones wikimedia
+        publishes: the siteinfo header, one bz2 stream per pages_per_stream pages and the closing tag are each a
+        separate stream. Returns the number of pages written.
+    """
+    page_id = 0
+    with open(dump_path, 'wb') as dump_file, open(index_path, 'w', encoding='utf-8') as index_file:
+        dump_file.write(bz2.compress(HEADER.encode('utf-8')))
+
+        def write_stream(stream: list[tuple[int, str, str]]):
+            start_byte = dump_file.tell()
+            dump_file.write(bz2.compress("".join(_page_xml(*page) for page in stream).encode('utf-8')))
+            for page_id, title, _ in stream:
+                index_file.write(f"{start_byte}:{page_id}:{title}\n")
+
+        stream = []
+        for title, text in pages:
+            page_id += 1
+            stream.append((page_id, title, text))
+            if len(stream) == pages_per_stream:
+                write_stream(stream)
+                stream = []
+        if len(stream) > 0:
+            write_stream(stream)
+        dump_file.write(bz2.compress(FOOTER.encode('utf-8')))
+    return page_id
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Write a synthetic multistream wikipedia dump and its index")
+    parser.add_argument("pages", type=int, help="number of pages")
+    parser.add_argument("dump", help="path to write the bz2 dump to")
+    parser.add_argument("index", help="path to write the multistream index to")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    written = write_multistream_dump(SyntheticWiki(args.pages, args.seed).pages(), args.dump, args.index)
+    print(f"Wrote {written} pages to {args.dump}")
@@ -0,0 +1,115 @@
+# A benchmark workspace is a self contained directory with everything the server reads: a synthetic dump and its
+# index, the title index, title search and section corpus built from it, and a section store and NN index of most of
+# its pages. Settings are read from the environment when config is first imported, so anything that opens a
+# workspace runs in its own process, started by run_in_workspace with workspace_env from the workspace directory.
+import json
+import os
+import subprocess
+import sys
+from typing import Optional
+
+QUERY_SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MANIFEST_FILE = "workspace.json"
+# Every HOLD_OUT_EVERY-th page is left out of the store, for add_page and the fallback to have something to add
+HOLD_OUT_EVERY = 10
+POPULATE_BATCH_PAGES = 1000
+
+
+def workspace_env(root: str, api_base: str) -> dict[str, str]:
+    """ The environment of a process using the workspace at root and the OpenAI stand in at api_base """
+    root = os.path.abspath(root)
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": QUERY_SERVER_DIR,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_API_BASE": api_base,
+        "WIKI_DB_PATH": os.path.join(root, "sections.sqlite"),
+        "INDEX_PATH": os.path.join(root, "index.faiss"),
+        "SNAPSHOT_ROOT": "",
+        "WIKIPEDIA_LOCAL_INDEX_PATH": os.path.join(root, "multistream-index.txt"),
+        "WIKIPEDIA_LOCAL_DUMP_PATH": os.path.join(root, "multistream.xml.bz2"),
+        "TITLE_SEARCH_PATH": os.path.join(root, "title_search.bin"),
+        "SECTION_CORPUS_PATH": os.path.join(root, "section_corpus.zst"),
+        # Every run should pay for its embeddings
+        "EMBEDDING_CACHE_PATH": "",
+        "SESSION_STORE_PATH": os.path.join(root, "sessions.sqlite"),
+    })
+    return env
+
+
+def run_in_workspace(root: str, env: dict[str, str], module: str, *args: str, log_path: Optional[str] = None):
+    """ Run a python module from the workspace directory, raises if it fails. Its output goes to log_path when given. """
+    command = [sys.executable, "-m", module, *args]
+    if log_path is None:
+        subprocess.run(command, cwd=root, env=env, check=True)
+        return
+    with open(log_path, 'w') as log:
+        subprocess.run(command, cwd=root, env=env, check=True, stdout=log, stderr=subprocess.STDOUT)
+
+
+def read_manifest(root: str) -> Optional[dict]:
+    path = os.path.join(root, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+
+def prepare_workspace(root: str, pages: int, api_base: str, workers: int = os.cpu_count(), seed: int = 0) -> dict[str, str]:
+    """ Build the workspace at root unless it was already built with the same pages and seed, returns its environment """
+    os.makedirs(root, exist_ok=True)
+    env = workspace_env(root, api_base)
+    manifest = read_manifest(root)
+    if manifest is None or (manifest["pages"], manifest["seed"]) != (pages, seed):
+        run_in_workspace(root, env, "bench.workspace", str(pages), "--workers", str(workers), "--seed", str(seed))
+    return env
+
+
+def is_held_out(page_number: int) -> bool:
+    return page_number % HOLD_OUT_EVERY == 0
+
+
+def _build(pages: int, workers: int, seed: int):
+    # Runs in the workspace with its environment
+    from bench.fake_openai import hash_embedding
+    from bench.synthetic_dump import SyntheticWiki, write_multistream_dump
+    from config import settings
+    from section_corpus import build_section_corpus
+    from title_index import build_title_index
+    from title_search import build_title_search
+    from wikidump import WIKI_INDEX_FILE
+    from wikidb import WikipediaDatabase
+
+    index_path, dump_path = settings.wikipedia_local_index_path, settings.wikipedia_local_dump_path
+    for path in [settings.wiki_db_path, settings.index_path, MANIFEST_FILE]:
+        if os.path.exists(path):
+            os.remove(path)
+    write_multistream_dump(SyntheticWiki(pages, seed).pages(), dump_path, index_path)
+    build_title_index(index_path, WIKI_INDEX_FILE)
+    build_title_search(index_path, dump_path, settings.title_search_path, workers)
+    build_section_corpus(index_path, dump_path, settings.section_corpus_path, workers)
+
+    db = WikipediaDatabase(store_path=settings.wiki_db_path)
+    with open(index_path, 'r', encoding='utf-8') as index_file:
+        titles = [line.rstrip("\n").split(":", 2)[2] for line in index_file]
+    stored = [title for i, title in enumerate(titles) if not is_held_out(i)]
+    for start in range(0, len(stored), POPULATE_BATCH_PAGES):
+        # Embedded here rather than through the stand in, there is nothing to measure yet
+        entries = [entry for title in stored[start:start + POPULATE_BATCH_PAGES] for entry in db.corpus.get_entries(title) or []]
+        db.add_embedded_entries(entries, [hash_embedding(entry[4]) for entry in entries])
+    db.save(settings.wiki_db_path, settings.index_path)
+    sections = db.index.ntotal
+    db.close()
+    with open(MANIFEST_FILE, 'w') as manifest_file:
+        json.dump({"pages": pages, "seed": seed, "stored_pages": len(stored), "sections": sections}, manifest_file)
+    print(f"Built a workspace of {pages} pages, {sections} sections of {len(stored)} of them are indexed")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Build a benchmark workspace in the current directory, see prepare_workspace")
+    parser.add_argument("pages", type=int, help="number of synthetic pages")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes used to build the title search and section corpus")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    _build(args.pages, args.workers, args.seed)
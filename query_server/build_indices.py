@@ -1,55 +1,75 @@
+import argparse
 import pywikibot
-import queue
-from wikidb import WikipediaDatabase
+from concurrent.futures import ThreadPoolExecutor
+from ingest import IngestPipeline, load_checkpoint, read_titles_file
 from pathlib import Path
 from datetime import datetime
-import wikitextparser as wtp
 from config import settings
 import os
-from tqdm import tqdm
 
 SEED = "History_of_technology"
 WIKI_DB_SAVE_PATH = Path("wikipedia_db_saves/")
 INDEX_SAVE_PATH = Path("index_saves/")
+CHECKPOINT_PATH = Path("ingest_checkpoints/")
 SCRAPE_COUNT = 1000
 
 os.environ["OPENAI_API_KEY"] = settings.openai_api_key
 
+
+def scrape(root: pywikibot.page._page.Page, max_count=10, workers=8) -> list[pywikibot.page._page.Page]:
+    """ Breadth first search over page links, fetching the links of a whole level of the frontier concurrently """
+    visited = {root}
+    frontier = [root]
+    pool = ThreadPoolExecutor(workers)
+    try:
+        while frontier:
+            next_frontier = []
+            for links in pool.map(lambda page: list(page.linkedPages(follow_redirects=True)), frontier):
+                for link in links:
+                    if link not in visited:
+                        visited.add(link)
+                        next_frontier.append(link)
+                        # Don't include root in max_count
+                        if len(visited) == max_count + 1:
+                            return list(visited)
+            frontier = next_frontier
+        return list(visited)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
 if __name__ == "__main__":
-    # Scrape the data we want to index
-    site = pywikibot.Site('en', 'wikipedia')
-
-    # TODO parallelize
-    def scrape(root: pywikibot.page._page.Page, max_count=10):
-        frontier = queue.Queue()
-        visited = set()
-        frontier.put(root)
-        visited.add(root)
-        while not frontier.empty():
-            current = frontier.get()
-            for link in current.linkedPages(follow_redirects=True):
-                if link not in visited:
-                    visited.add(link)
-                    frontier.put(link)
-                    # Don't include root in max_count
-                    if len(visited) == max_count + 1:
-                        return list(visited)
-        return visited
-
-    visited = scrape(pywikibot.Page(site, "Apollo"), max_count=SCRAPE_COUNT)
-    print(f"Scraped {len(visited)} pages")
-    page_titles = [page.title() for page in visited]
+    parser = argparse.ArgumentParser(description="Build the section store and NN index from the local wikipedia dump")
+    parser.add_argument("--titles-file", help="file with one page title per line, skips scraping so this can run offline")
+    parser.add_argument("--seed", default="Apollo", help="page to start scraping links from")
+    parser.add_argument("--count", type=int, default=SCRAPE_COUNT, help="number of pages to scrape")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes used to decompress and split pages")
+    parser.add_argument("--max-in-flight", type=int, default=4, help="concurrent embedding requests")
+    parser.add_argument("--snapshot-root", help="publish the result as a memory mapped snapshot under this directory, see SNAPSHOT_ROOT")
+    parser.add_argument("--checkpoint-dir", type=Path, default=CHECKPOINT_PATH, help="where to checkpoint progress, reruns resume from here")
+    args = parser.parse_args()
+
+    # Get the titles we want to index
+    if args.titles_file:
+        page_titles = read_titles_file(args.titles_file)
+    else:
+        site = pywikibot.Site('en', 'wikipedia')
+        visited = scrape(pywikibot.Page(site, args.seed), max_count=args.count)
+        print(f"Scraped {len(visited)} pages")
+        page_titles = [page.title() for page in visited]
 
     # Add
-    wikidb = WikipediaDatabase()
-    for page_title in tqdm(page_titles):
-        page = wikidb.get_page(page_title)
-        if page:
-            wikidb.add_page(page_title, page)
-    
+    wikidb, done = load_checkpoint(args.checkpoint_dir)
+    pipeline = IngestPipeline(wikidb, checkpoint_dir=args.checkpoint_dir, done=done,
+                              workers=args.workers, max_in_flight=args.max_in_flight)
+    pipeline.run(page_titles)
+
     # Save
-    now = datetime.now()
-    filename = now.strftime("%m_%d_%Y_%H_%M_%S")
-    WIKI_DB_SAVE_PATH.mkdir(exist_ok=True)
-    INDEX_SAVE_PATH.mkdir(exist_ok=True)
-    wikidb.save(str(WIKI_DB_SAVE_PATH / filename), str(INDEX_SAVE_PATH / filename))
+    if args.snapshot_root:
+        print(f"Published {wikidb.save_snapshot(args.snapshot_root)}")
+    else:
+        now = datetime.now()
+        filename = now.strftime("%m_%d_%Y_%H_%M_%S")
+        WIKI_DB_SAVE_PATH.mkdir(exist_ok=True)
+        INDEX_SAVE_PATH.mkdir(exist_ok=True)
+        wikidb.save(str(WIKI_DB_SAVE_PATH / filename), str(INDEX_SAVE_PATH / filename))
@@ -0,0 +1,61 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache():
+    """ A thread safe LRU cache bounded by the total size of its values.
+
+        sizeof is used to measure each value, by default every value has a size of 1 so max_size is an item count.
+        Hits and misses are counted so the cache can be sized from real traffic.
+    """
+
+    def __init__(self, max_size: int, sizeof: Callable[[Any], int] = lambda value: 1):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """ Get a value and mark it as most recently used, returns None on a miss """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any):
+        """ Insert a value, evicting the least recently used entries until it fits """
+        value_size = self.sizeof(value)
+        # Never cache values that would evict everything else
+        if value_size > self.max_size:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self._entries[key] = (value, value_size)
+            self.size += value_size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "size": self.size, "max_size": self.max_size}
@@ -0,0 +1,82 @@
+import numpy as np
+import tiktoken
+from nltk.tokenize import sent_tokenize
+from token_consts import MAX_SECTION_TOKENS
+
+# TODO: encoder should be parameterized
+ENCODING = "cl100k_base"
+
+
+class Chunker():
+    """ Splits section text into chunks of at most max_tokens tokens on sentence boundaries.
+
+        Every text is tokenized once in a batch to find the ones that fit whole. The sentences of the rest are
+        tokenized once, also in a batch, each with the space that joins it to the one before, and chunks are cut
+        from prefix sums of their lengths so nothing is encoded again. A chunk's count can be one token off at its
+        leading space. Consecutive chunks share up to overlap_tokens tokens of whole sentences, and a sentence
+        that is longer than max_tokens on its own is cut into max_tokens windows instead of being dropped.
+    """
+
+    def __init__(self, max_tokens: int = MAX_SECTION_TOKENS, overlap_tokens: int = 0, encoding: str = ENCODING):
+        if overlap_tokens >= max_tokens:
+            raise ValueError(f"overlap_tokens ({overlap_tokens}) has to be less than max_tokens ({max_tokens})")
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.tokenizer = tiktoken.get_encoding(encoding)
+
+    def chunk(self, text: str) -> list[tuple[str, int]]:
+        """ Split text into (chunk, token count) pairs """
+        return self.chunk_many([text])[0]
+
+    def chunk_many(self, texts: list[str]) -> list[list[tuple[str, int]]]:
+        """ Split every text into (chunk, token count) pairs, tokenizing them together """
+        counts = [len(tokens) for tokens in self.tokenizer.encode_ordinary_batch(texts)]
+        result: list[list[tuple[str, int]]] = [[(text, count)] for text, count in zip(texts, counts)]
+        long_texts = [i for i, count in enumerate(counts) if count > self.max_tokens]
+        if len(long_texts) == 0:
+            return result
+
+        sentences = [sent_tokenize(texts[i].replace("\n", " ")) for i in long_texts]
+        # The space joining a sentence to the previous one is tokenized with it, as it would be in the joined chunk
+        encoded = iter(self.tokenizer.encode_ordinary_batch(
+            [sentence if j == 0 else " " + sentence for text_sentences in sentences for j, sentence in enumerate(text_sentences)]))
+        for i, text_sentences in zip(long_texts, sentences):
+            result[i] = self._pack(text_sentences, [next(encoded) for _ in text_sentences])
+        return result
+
+    def _pack(self, sentences: list[str], encoded: list[list[int]]) -> list[tuple[str, int]]:
+        # prefix[j] is the number of tokens in the first j sentences
+        prefix = np.concatenate([[0], np.cumsum([len(tokens) for tokens in encoded])])
+        chunks = []
+        start = 0
+        while start < len(sentences):
+            # The most sentences from start that fit
+            end = int(np.searchsorted(prefix, prefix[start] + self.max_tokens, side="right")) - 1
+            if end == start:
+                chunks.extend(self._split_sentence(encoded[start]))
+                start += 1
+                continue
+            chunks.append((" ".join(sentences[start:end]), int(prefix[end] - prefix[start])))
+            if end == len(sentences):
+                break
+            next_start = end
+            if self.overlap_tokens > 0:
+                # The earliest sentence that keeps the overlap within overlap_tokens, as long as the next
+                # sentence still fits after it
+                overlap_start = max(int(np.searchsorted(prefix, prefix[end] - self.overlap_tokens, side="left")), start + 1)
+                if prefix[end + 1] - prefix[overlap_start] <= self.max_tokens:
+                    next_start = overlap_start
+            start = next_start
+        return chunks
+
+    def _split_sentence(self, tokens: list[int]) -> list[tuple[str, int]]:
+        """ Cut a sentence too long to fit a chunk into windows of max_tokens """
+        step = self.max_tokens - self.overlap_tokens
+        windows = []
+        for start in range(0, len(tokens), step):
+            window = tokens[start:start + self.max_tokens]
+            windows.append((self.tokenizer.decode(window).strip(), len(window)))
+            if start + self.max_tokens >= len(tokens):
+                break
+        return windows
+
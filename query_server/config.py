@@ -4,8 +4,51 @@ class Settings(BaseSettings):
     openai_api_key: str
     wiki_db_path: str
     index_path: str
+    # A directory of snapshots saved by WikipediaDatabase.save_snapshot, when set the published one is served
+    # in place of wiki_db_path and index_path
+    snapshot_root: str = ""
     wikipedia_local_index_path: str
     wikipedia_local_dump_path: str
+    # Sizes of the decompressed chunk and parsed page caches in front of the local dump
+    chunk_cache_bytes: int = 256 * 1024 * 1024
+    page_cache_bytes: int = 64 * 1024 * 1024
+    # Persistent embedding cache shared by every process, set to an empty string to disable it
+    embedding_cache_path: str = "embedding_cache.sqlite"
+    # faiss index_factory spec for new indices and search time parameters, e.g. "IVF4096,PQ64" and "nprobe=32"
+    index_spec: str = "Flat"
+    index_search_params: str = ""
+    # How many dense and BM25 candidates hybrid retrieval fuses per question, 0 searches the dense index only
+    retrieval_candidate_depth: int = 50
+    # Semantic answer cache, a question hits when it is at least threshold similar to a cached one. Answers are
+    # dropped once a newly indexed section is at least invalidation_threshold similar to their question.
+    answer_cache_entries: int = 10000
+    answer_cache_ttl_seconds: float = 24 * 60 * 60
+    answer_cache_threshold: float = 0.97
+    answer_cache_invalidation_threshold: float = 0.8
+    # Chat sessions, "memory" keeps them in the worker, "sqlite" shares them between workers through session_store_path
+    session_backend: str = "memory"
+    session_store_path: str = "sessions.sqlite"
+    session_ttl_seconds: float = 24 * 60 * 60
+    session_max_entries: int = 10000
+    session_sweep_interval_seconds: float = 60
+    # Retrievals arriving within query_batch_window_ms of each other are embedded and searched together,
+    # up to query_batch_max_size at a time. /batch_query answers at most batch_query_concurrency questions at once.
+    query_batch_window_ms: float = 5
+    query_batch_max_size: int = 256
+    batch_query_max_questions: int = 256
+    batch_query_concurrency: int = 16
+    # Tokens of whole sentences repeated at the start of the next piece when a long section is split
+    section_overlap_tokens: int = 0
+    # Size of the connection pool shared by async OpenAI requests
+    openai_max_connections: int = 100
+    # When an answer is missing, how long to spend reading wikipedia before answering with what was indexed,
+    # and how many processes extract pages from the local dump
+    fallback_deadline_seconds: float = 20.0
+    fallback_workers: int = 4
+    # Offline BM25 search over the local dump built by title_search.py, searches go to the wikipedia API without it
+    title_search_path: str = "title_search.bin"
+    # Every article of the local dump split into sections by section_corpus.py, pages are read from the dump without it
+    section_corpus_path: str = "section_corpus.zst"
 
     class Config:
         env_file = ".env"
@@ -1,32 +1,171 @@
+import asyncio
 import openai
-from typing import Union
+import tiktoken
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
 import os
 from tenacity import (
     retry,
+    retry_if_not_exception_type,
     stop_after_attempt,
     wait_random_exponential,
 )
+from token_consts import MAX_EMBEDDING_BATCH_ITEMS, MAX_EMBEDDING_BATCH_TOKENS
+from embedding_cache import EmbeddingCache
+from metrics import span, tokens_sent
 
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
+# Rejected inputs fail the same way every time, anything else is retried and raised as itself once retries run out
+@retry(retry=retry_if_not_exception_type(openai.error.InvalidRequestError), wait=wait_random_exponential(min=1, max=60),
+       stop=stop_after_attempt(6), reraise=True)
 def embed_with_backoff(**kwargs):
     return openai.Embedding.create(**kwargs)
 
 
+@retry(retry=retry_if_not_exception_type(openai.error.InvalidRequestError), wait=wait_random_exponential(min=1, max=60),
+       stop=stop_after_attempt(6), reraise=True)
+async def aembed_with_backoff(**kwargs):
+    return await openai.Embedding.acreate(**kwargs)
+
+
 DEFAULT_EMBEDDING_MODEL = "text-embedding-ada-002"
+ENCODING = "cl100k_base"  # encoding for text-embedding-ada-002
 
 class Embedder:
 
-    def __init__(self, model=DEFAULT_EMBEDDING_MODEL):
+    def __init__(self, model=DEFAULT_EMBEDDING_MODEL, cache: Optional[EmbeddingCache] = None):
         self.model = model
+        self.cache = cache
         # TODO: switch to dotenv
         openai.api_key = os.environ["OPENAI_API_KEY"]
 
     # Batch embedding
     def get_embedding(self, text: Union[str, list[str]]) -> Union[list[list[float]], None]:
+        """ Embed one or more texts, None when the request fails """
         try:
-            result = embed_with_backoff(model=self.model, input=text)
-            return [x["embedding"] for x in result["data"]]
+            # Questions repeat, so they are kept in the cache's memory
+            return self.embed_many([text] if isinstance(text, str) else text, remember=True)
         except Exception as e:
             print(f"ERROR EMBEDDING {e}")
             # TODO: handle exception approriately
             return None
+
+    def embed_many(self, texts: list[str], remember: bool = False) -> list[list[float]]:
+        """ Embed texts, raising the error of a request that failed, e.g. openai.error.InvalidRequestError for a
+            rejected input or the last rate limit or connection error once retries run out.
+            remember keeps them in the cache's memory, bulk callers leave it off.
+        """
+        if self.cache is None:
+            return self._fetch_embeddings(texts)
+
+        # Only send what we haven't embedded before
+        embeddings = self.cache.get_many(self.model, texts, remember)
+        misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if len(misses) > 0:
+            miss_texts = [texts[i] for i in misses]
+            fetched = self._fetch_embeddings(miss_texts)
+            self.cache.put_many(self.model, miss_texts, fetched, remember)
+            for i, embedding in zip(misses, fetched):
+                embeddings[i] = embedding
+        return embeddings
+
+    async def aget_embedding(self, text: Union[str, list[str]]) -> Union[list[list[float]], None]:
+        """ Like get_embedding but awaits the API and keeps cache IO off the event loop """
+        texts = [text] if isinstance(text, str) else text
+        if self.cache is None:
+            return await self._afetch_embeddings(texts)
+
+        embeddings = await asyncio.to_thread(self.cache.get_many, self.model, texts, True)
+        misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if len(misses) > 0:
+            miss_texts = [texts[i] for i in misses]
+            fetched = await self._afetch_embeddings(miss_texts)
+            if fetched is None:
+                return None
+            await asyncio.to_thread(self.cache.put_many, self.model, miss_texts, fetched, True)
+            for i, embedding in zip(misses, fetched):
+                embeddings[i] = embedding
+        return embeddings
+
+    def _fetch_embeddings(self, texts: list[str]) -> list[list[float]]:
+        with span("embedding_request"):
+            result = embed_with_backoff(model=self.model, input=texts)
+        _count_tokens(result)
+        return [x["embedding"] for x in result["data"]]
+
+    async def _afetch_embeddings(self, texts: list[str]) -> Union[list[list[float]], None]:
+        try:
+            with span("embedding_request"):
+                result = await aembed_with_backoff(model=self.model, input=texts)
+            _count_tokens(result)
+            return [x["embedding"] for x in result["data"]]
+        except Exception as e:
+            print(f"ERROR EMBEDDING {e}")
+            return None
+
+
+def _count_tokens(result):
+    # The API reports how many tokens it embedded, counting them here would mean tokenizing every text again
+    if "usage" in result:
+        tokens_sent.labels("embedding").inc(result["usage"]["total_tokens"])
+
+
+class EmbeddingBatcher():
+    """ Packs texts, typically the sections of many pages, into embedding requests bounded by a token budget
+        and an item count, and runs up to max_in_flight of those requests concurrently.
+
+        Results line up with the input texts. A request the API rejects as invalid is split in half and retried so
+        one bad input only loses itself, texts that are still rejected come back as None. Any other error, such as
+        a rate limit or an outage that outlasts the retries, is raised rather than multiplied by splitting.
+    """
+
+    def __init__(self, embedder: Embedder, max_tokens: int = MAX_EMBEDDING_BATCH_TOKENS,
+                 max_items: int = MAX_EMBEDDING_BATCH_ITEMS, max_in_flight: int = 4):
+        self.embedder = embedder
+        self.max_tokens = max_tokens
+        self.max_items = max_items
+        self.max_in_flight = max_in_flight
+        self.tokenizer = tiktoken.get_encoding(ENCODING)
+
+    def embed(self, texts: list[str], token_counts: Optional[list[int]] = None) -> list[Optional[list[float]]]:
+        if token_counts is None:
+            token_counts = [len(tokens) for tokens in self.tokenizer.encode_ordinary_batch(texts)]
+        batches = self.pack(token_counts)
+        results: list[Optional[list[float]]] = [None] * len(texts)
+        if len(batches) == 0:
+            return results
+
+        def run(batch: range):
+            results[batch.start:batch.stop] = self.embed_batch(texts[batch.start:batch.stop])
+
+        if len(batches) == 1:
+            run(batches[0])
+        else:
+            with ThreadPoolExecutor(min(self.max_in_flight, len(batches))) as pool:
+                # Surface unexpected errors rather than returning a partially filled result
+                for _ in pool.map(run, batches):
+                    pass
+        return results
+
+    def pack(self, token_counts: list[int]) -> list[range]:
+        """ Split the inputs into contiguous ranges that fit within the token budget and item count """
+        batches = []
+        start, batch_tokens = 0, 0
+        for i, n_tokens in enumerate(token_counts):
+            if i > start and (batch_tokens + n_tokens > self.max_tokens or i - start >= self.max_items):
+                batches.append(range(start, i))
+                start, batch_tokens = i, 0
+            batch_tokens += n_tokens
+        if start < len(token_counts):
+            batches.append(range(start, len(token_counts)))
+        return batches
+
+    def embed_batch(self, texts: list[str]) -> list[Optional[list[float]]]:
+        """ Embed a single request worth of texts, bisecting on rejected inputs to isolate them """
+        try:
+            return self.embedder.embed_many(texts)
+        except openai.error.InvalidRequestError as e:
+            if len(texts) == 1:
+                print(f"ERROR EMBEDDING rejected input: {e}")
+                return [None]
+        middle = len(texts) // 2
+        return self.embed_batch(texts[:middle]) + self.embed_batch(texts[middle:])
@@ -0,0 +1,76 @@
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from typing import Optional
+from cache import LRUCache
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache():
+    """ A persistent, content addressed cache of embeddings keyed by (model, sha256 of the text).
+
+        Vectors are stored as float32 blobs in SQLite, in WAL mode so several processes can share one cache file,
+        and come back as float32 arrays. A small in memory LRU sits in front of it for hot strings such as repeated
+        user questions. Only lookups made with remember fill it, so bulk writes of page sections never push them out.
+    """
+
+    def __init__(self, path: str, memory_entries: int = 10000):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (model TEXT NOT NULL, text_hash BLOB NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, text_hash)) WITHOUT ROWID")
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self.memory = LRUCache(memory_entries)
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, model: str, texts: list[str], remember: bool = False) -> list[Optional[np.ndarray]]:
+        """ Look up embeddings for texts, returns None for every text that is not cached.
+            With remember, the ones read from disk are kept in memory for the next lookup.
+        """
+        hashes = [text_hash(text) for text in texts]
+        results: list[Optional[np.ndarray]] = [self.memory.get((model, h)) for h in hashes]
+        missing = list(set(h for h, result in zip(hashes, results) if result is None))
+        if len(missing) > 0:
+            found = {}
+            with self._lock:
+                # Stay well below SQLite's limit on bound parameters
+                for start in range(0, len(missing), 500):
+                    batch = missing[start:start + 500]
+                    rows = self._conn.execute(
+                        f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                        [model, *batch]).fetchall()
+                    for h, vector in rows:
+                        found[h] = np.frombuffer(vector, dtype=np.float32)
+            for i, h in enumerate(hashes):
+                if results[i] is None and h in found:
+                    results[i] = found[h]
+                    if remember:
+                        self.memory.put((model, h), found[h])
+        hits = sum(1 for result in results if result is not None)
+        self.hits += hits
+        self.misses += len(results) - hits
+        return results
+
+    def put_many(self, model: str, texts: list[str], embeddings: list[list[float]], remember: bool = False):
+        """ Store embeddings of texts, with remember they are also kept in memory """
+        rows = []
+        for text, embedding in zip(texts, embeddings):
+            h = text_hash(text)
+            vector = np.asarray(embedding, dtype=np.float32)
+            if remember:
+                self.memory.put((model, h), vector)
+            rows.append((model, h, vector.tobytes()))
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "memory": self.memory.stats()}
@@ -1,31 +1,383 @@
+import asyncio
 import faiss
+import json
+import mmap
 import numpy as np
-from typing import Optional
-from embedder import Embedder
+import os
+from typing import Callable, Optional, Protocol, Union
+from embedder import Embedder, EmbeddingBatcher
+from embedding_cache import EmbeddingCache
+from config import settings
+from metrics import span
+from rwlock import ReadWriteLock
+
+# Any faiss index_factory string works, e.g. "Flat", "IVF4096,Flat", "IVF4096,PQ64", "HNSW32" or "OPQ64,IVF4096,PQ64"
+DEFAULT_INDEX_SPEC = "Flat"
+# Number of vectors sampled from the existing index to train a new one
+DEFAULT_TRAIN_SIZE = 100000
+# Damping constant of reciprocal rank fusion, larger values flatten the advantage of the top ranks
+RRF_K = 60
+
+
+# Files of an index snapshot directory, see Index.save_snapshot
+SNAPSHOT_META_FILE = "index.json"
+SNAPSHOT_VECTORS_FILE = "vectors.f32"
+SNAPSHOT_IDS_FILE = "ids.i64"
+SNAPSHOT_FAISS_FILE = "index.faiss"
+# Vectors copied at a time when writing a snapshot or merging the mapped base
+COPY_BLOCK_SIZE = 65536
+
+
+def _meta_path(index_file: str) -> str:
+    return index_file + ".meta.json"
+
+
+def _map_array(path: str, dtype) -> np.ndarray:
+    """ Memory map a raw array file read only, its pages are shared with every process mapping the same file """
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    with open(path, 'rb') as array_file:
+        return np.frombuffer(mmap.mmap(array_file.fileno(), 0, access=mmap.ACCESS_READ), dtype=dtype)
+
+
+class _MappedVectors():
+    """ The vectors and ids of a flat snapshot mapped straight from disk and searched exhaustively without a copy """
+
+    def __init__(self, directory: str, embedding_length: int):
+        self.ids = _map_array(os.path.join(directory, SNAPSHOT_IDS_FILE), np.int64)
+        self.vectors = _map_array(os.path.join(directory, SNAPSHOT_VECTORS_FILE), np.float32).reshape(-1, embedding_length)
+        self.ntotal = len(self.ids)
+
+    def search(self, xq: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        D, I = faiss.knn(xq, self.vectors, k, faiss.METRIC_INNER_PRODUCT)
+        return D, np.where(I >= 0, self.ids[np.maximum(I, 0)], -1)
+
+
+class _MappedFaissIndex():
+    """ A faiss index read from a snapshot with IO_FLAG_MMAP, IVF inverted lists stay on disk and are paged in as searched """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        self.ids = faiss.vector_to_array(self.index.id_map)
+        self.ntotal = self.index.ntotal
+
+    def search(self, xq: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        return self.index.search(xq, k)
+
+
+def parse_search_params(search_params: str) -> dict:
+    """ Parse search parameters written as name=value pairs, e.g. "nprobe=32,efSearch=64" """
+    params = {}
+    for param in search_params.split(","):
+        if param.strip() == '':
+            continue
+        name, value = param.split("=")
+        params[name.strip()] = float(value) if "." in value else int(value)
+    return params
+
+
+def reciprocal_rank_fusion(rankings: list[list[int]], k: int = RRF_K) -> list[int]:
+    """ Merge several rankings of ids into one, each id scores the sum of 1 / (k + rank) over the rankings it is in """
+    scores: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, id in enumerate(ranking):
+            scores[id] = scores.get(id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class SparseIndex(Protocol):
+    def search_text(self, query: str, k: int) -> list[int]:
+        ...
+
+
+def _new_faiss_index(embedding_length: int, index_spec: str) -> faiss.Index:
+    # Vectors are stored under explicit section ids so removing or updating a page never shifts the others
+    return faiss.index_factory(embedding_length, "IDMap2," + index_spec, faiss.METRIC_INNER_PRODUCT)
 
 
 class Index:
+    """ A nearest neighbour index over section embeddings, keyed by int64 section ids.
 
-    def __init__(self, index_file: Optional[str], embedding_length=1536):
-        if (index_file):
-            self._faiss_index: faiss.IndexFlatIP = faiss.read_index(index_file)
+        The backing faiss index is described by an index_factory spec. Approximate specs (IVF, PQ, HNSW) have to be
+        trained before vectors can be added and expose search time parameters such as nprobe and efSearch.
+        The spec and search parameters are saved next to the index so loading it restores both.
+
+        An index can also be saved as a snapshot directory that is memory mapped rather than read when it is loaded,
+        so loading takes the same time at any size and processes serving the same snapshot share its pages through
+        the OS page cache. Flat snapshots are raw vector and id arrays, anything else is a faiss file read with
+        IO_FLAG_MMAP. The mapped base is read only: vectors added afterwards go to a small flat index in memory,
+        removed base ids are masked out of results, and saving writes both merged.
+
+        When a sparse index is attached, searches are hybrid: the top candidate_depth dense and sparse results are
+        merged with reciprocal rank fusion, which recovers exact names and dates that embeddings tend to blur.
+    """
+
+    def __init__(self, index_file: Optional[str], embedding_length=1536, index_spec: Optional[str] = None,
+                 search_params: Optional[dict] = None):
+        self.index_spec = index_spec or settings.index_spec
+        self.search_params = parse_search_params(settings.index_search_params)
+        self._base: Optional[Union[_MappedVectors, _MappedFaissIndex]] = None
+        # Ids removed from the read only base since it was mapped
+        self._removed: set[int] = set()
+        if index_file and os.path.isdir(index_file):
+            with open(os.path.join(index_file, SNAPSHOT_META_FILE), 'r') as meta_file:
+                meta = json.load(meta_file)
+            self.index_spec = meta["index_spec"]
+            self.search_params = meta["search_params"]
+            if meta["format"] == "vectors":
+                self._base = _MappedVectors(index_file, meta["embedding_length"])
+            else:
+                self._base = _MappedFaissIndex(os.path.join(index_file, SNAPSHOT_FAISS_FILE))
+            self._faiss_index: faiss.Index = _new_faiss_index(meta["embedding_length"], DEFAULT_INDEX_SPEC)
+            self.migrated_from_positional = False
+        elif (index_file):
+            self._faiss_index: faiss.Index = faiss.read_index(index_file)
+            # Indices saved before specs existed are flat
+            self.index_spec = DEFAULT_INDEX_SPEC
+            self.search_params = {}
+            if os.path.exists(_meta_path(index_file)):
+                with open(_meta_path(index_file), 'r') as meta_file:
+                    meta = json.load(meta_file)
+                self.index_spec = meta["index_spec"]
+                self.search_params = meta["search_params"]
+            self.migrated_from_positional = not isinstance(self._faiss_index, faiss.IndexIDMap2)
+            if self.migrated_from_positional:
+                self._faiss_index = self._with_positional_ids(self._faiss_index)
         else:
-            self._faiss_index: faiss.IndexFlatIP = faiss.IndexFlatIP(embedding_length)
+            self._faiss_index: faiss.Index = _new_faiss_index(embedding_length, self.index_spec)
+            self.migrated_from_positional = False
+        self.set_search_params(**(search_params or {}))
+        # faiss indices can be searched concurrently but not while vectors are being added or removed
+        self._lock = ReadWriteLock()
 
         # TODO: factory / DI support
-        self.embedder = Embedder()
+        cache = EmbeddingCache(settings.embedding_cache_path) if settings.embedding_cache_path else None
+        self.embedder = Embedder(cache=cache)
+        self.batcher = EmbeddingBatcher(self.embedder)
+        self.sparse_index: Optional[SparseIndex] = None
+        self.candidate_depth = settings.retrieval_candidate_depth
+        # Called with every batch of vectors after it is added, e.g. to invalidate cached answers
+        self.add_listeners: list[Callable[[np.ndarray], None]] = []
+
+    @property
+    def is_trained(self) -> bool:
+        return self._faiss_index.is_trained
+
+    @property
+    def ntotal(self) -> int:
+        if self._base is None:
+            return self._faiss_index.ntotal
+        return self._base.ntotal - len(self._removed) + self._faiss_index.ntotal
+
+    def train(self, vectors: np.ndarray):
+        """ Train the index on a representative sample of vectors, required before adding to IVF and PQ indices """
+        self._faiss_index.train(np.ascontiguousarray(vectors, dtype=np.float32))
+
+    def set_search_params(self, **params):
+        """ Set search time parameters such as nprobe (IVF) or efSearch (HNSW) """
+        self.search_params.update(params)
+        if isinstance(self._base, _MappedVectors):
+            return
+        # With a mapped base the in memory index is flat and has no parameters
+        tuned_index = self._base.index if self._base is not None else self._faiss_index
+        parameter_space = faiss.ParameterSpace()
+        for name, value in self.search_params.items():
+            parameter_space.set_index_parameter(tuned_index, name, value)
+
+    def ids(self) -> np.ndarray:
+        added_ids = faiss.vector_to_array(self._faiss_index.id_map)
+        if self._base is None:
+            return added_ids
+        return np.concatenate([self._live_base_ids(), added_ids])
+
+    def reconstruct_all(self) -> tuple[np.ndarray, np.ndarray]:
+        """ Get every stored (id, vector) back, only supported by flat indices """
+        blocks = list(self._iter_vectors())
+        if len(blocks) == 0:
+            return np.empty(0, dtype=np.int64), np.empty((0, self._faiss_index.d), dtype=np.float32)
+        return np.concatenate([ids for ids, _ in blocks]), np.concatenate([vectors for _, vectors in blocks])
+
+    @classmethod
+    def from_vectors(cls, vectors: np.ndarray, index_spec: str, ids: Optional[np.ndarray] = None,
+                     train_size: int = DEFAULT_TRAIN_SIZE, search_params: Optional[dict] = None) -> "Index":
+        """ Build an index of the given spec, trained on a random sample of vectors and holding all of them """
+        index = cls(None, embedding_length=vectors.shape[1], index_spec=index_spec, search_params=search_params)
+        if not index.is_trained:
+            sample = vectors
+            if len(vectors) > train_size:
+                sample = vectors[np.random.default_rng(0).choice(len(vectors), train_size, replace=False)]
+            index.train(sample)
+        if ids is None:
+            ids = np.arange(len(vectors))
+        index.add_embeddings(vectors, ids)
+        return index
+
+    def get_closest_indices(self, query, k=4, candidate_depth: Optional[int] = None) -> list[int]:
+        """ Get the ids of the k sections closest to the query """
+        return self.get_closest_indices_batch([query], k, candidate_depth)[0]
 
-    def get_closest_indices(self, query, k=4) -> list[int]:
-        xq = self.embedder.get_embedding(query)[0]
-        D, I = self._faiss_index.search(np.array([xq]), k)
-        return list(I[0])
+    def get_closest_indices_batch(self, queries: list[str], k=4, candidate_depth: Optional[int] = None,
+                                  embeddings: Optional[list[Optional[list[float]]]] = None) -> list[list[int]]:
+        """ Get the ids of the k sections closest to each query, embedding them together and searching them as one matrix.
+            Queries that could not be embedded only get sparse results. Pass embeddings when the queries are already embedded.
+        """
+        if embeddings is None:
+            try:
+                embeddings = self.batcher.embed(queries)
+            except Exception as e:
+                print(f"ERROR EMBEDDING {e}")
+                embeddings = [None] * len(queries)
+        return self.search_embeddings(queries, embeddings, k, candidate_depth)
 
-    def add_to_index(self, entries: list[str]) -> bool:
-        embeddings = self.embedder.get_embedding(entries)
-        if embeddings and len(embeddings) > 0:
-            self._faiss_index.add(np.array(embeddings))
-            return True
-        return False
+    async def aget_closest_indices_batch(self, queries: list[str], k=4, candidate_depth: Optional[int] = None) -> list[list[int]]:
+        """ Like get_closest_indices_batch but awaits the embedding request and searches on a worker thread """
+        embeddings = await self.embedder.aget_embedding(queries)
+        if embeddings is None:
+            embeddings = [None] * len(queries)
+        return await asyncio.to_thread(self.search_embeddings, queries, embeddings, k, candidate_depth)
+
+    def search_embeddings(self, queries: list[str], embeddings: list[Optional[list[float]]], k: int,
+                          candidate_depth: Optional[int] = None) -> list[list[int]]:
+        """ Search for already embedded queries, a None embedding only gets sparse results """
+        depth = self.candidate_depth if candidate_depth is None else candidate_depth
+        hybrid = self.sparse_index is not None and depth > 0
+        with span("faiss_search"):
+            dense = self._dense_search(embeddings, max(k, depth) if hybrid else k)
+        if not hybrid:
+            return dense
+        with span("sparse_search"):
+            sparse = [self.sparse_index.search_text(query, depth) for query in queries]
+        return [reciprocal_rank_fusion([dense_ids, sparse_ids])[:k] for dense_ids, sparse_ids in zip(dense, sparse)]
+
+    def _dense_search(self, embeddings: list[Optional[list[float]]], k: int) -> list[list[int]]:
+        embedded = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+        results: list[list[int]] = [[] for _ in embeddings]
+        if len(embedded) == 0:
+            return results
+        xq = np.array([embeddings[i] for i in embedded], dtype=np.float32)
+        with self._lock.read():
+            D, I = self._search_vectors(xq, k)
+        for i, row in zip(embedded, I):
+            # Approximate indices return -1 when they find fewer than k neighbours
+            results[i] = [int(id) for id in row if id >= 0]
+        return results
+
+    def _search_vectors(self, xq: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        if self._base is None:
+            return self._faiss_index.search(xq, k)
+        # Fetch enough from the base to still have k after dropping removed ids, then merge in the added vectors
+        D, I = self._base.search(xq, k + len(self._removed))
+        if self._faiss_index.ntotal > 0:
+            added_D, added_I = self._faiss_index.search(xq, k)
+            D, I = np.concatenate([D, added_D], axis=1), np.concatenate([I, added_I], axis=1)
+        dropped = I < 0
+        if len(self._removed) > 0:
+            dropped |= np.isin(I, np.fromiter(self._removed, dtype=np.int64, count=len(self._removed)))
+        D = np.where(dropped, -np.inf, D)
+        # Inner product, larger is closer
+        order = np.argsort(-D, axis=1, kind='stable')[:, :k]
+        D, I = np.take_along_axis(D, order, axis=1), np.take_along_axis(I, order, axis=1)
+        return D, np.where(np.isneginf(D), -1, I)
+
+    def add_to_index(self, entries: list[str], ids: list[int], token_counts: Optional[list[int]] = None) -> list[bool]:
+        """ Embed and add entries under the given ids, returns whether each entry was added """
+        embeddings = self.batcher.embed(entries, token_counts)
+        added = [embedding is not None for embedding in embeddings]
+        vectors = [embedding for embedding in embeddings if embedding is not None]
+        if len(vectors) > 0:
+            self.add_embeddings(vectors, [id for id, did_add in zip(ids, added) if did_add])
+        return added
+
+    def add_embeddings(self, embeddings: Union[list[list[float]], np.ndarray], ids: Union[list[int], np.ndarray]):
+        """ Add precomputed embeddings under the given ids, for callers that batch embedding requests themselves """
+        if not self.is_trained:
+            raise ValueError(f"The {self.index_spec} index has to be trained before vectors can be added")
+        vectors = np.ascontiguousarray(embeddings, dtype=np.float32)
+        with self._lock.write():
+            self._faiss_index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+        for listener in self.add_listeners:
+            listener(vectors)
+
+    def remove_ids(self, ids: Union[list[int], np.ndarray]) -> int:
+        """ Remove vectors by id, returns how many were removed. HNSW indices do not support removal. """
+        ids = np.asarray(ids, dtype=np.int64)
+        with self._lock.write():
+            removed = self._faiss_index.remove_ids(ids)
+            if self._base is not None:
+                in_base = set(int(id) for id in ids[np.isin(ids, self._base.ids)]) - self._removed
+                self._removed.update(in_base)
+                removed += len(in_base)
+            return removed
+
+    def _with_positional_ids(self, faiss_index: faiss.Index) -> faiss.Index:
+        """ Indices saved before ids existed used the row number as the id, rebuild them with explicit ids """
+        print("Migrating index to explicit section ids")
+        # Only flat indices can hand their vectors back, anything else has to be rebuilt with tune_index.py
+        vectors = faiss_index.reconstruct_n(0, faiss_index.ntotal)
+        id_index = _new_faiss_index(faiss_index.d, self.index_spec)
+        if not id_index.is_trained:
+            id_index.train(vectors)
+        id_index.add_with_ids(vectors, np.arange(faiss_index.ntotal, dtype=np.int64))
+        return id_index
 
     def save_to_path(self, path: str):
-        faiss.write_index(self._faiss_index, path)
\ No newline at end of file
+        with self._lock.read():
+            faiss.write_index(self._merged_faiss_index(), path)
+        with open(_meta_path(path), 'w') as meta_file:
+            json.dump({"index_spec": self.index_spec, "search_params": self.search_params}, meta_file)
+
+    def save_snapshot(self, directory: str):
+        """ Save the index as a snapshot directory, which loading memory maps instead of reading.
+            Flat indices are written as raw vector and id arrays a block at a time.
+        """
+        os.makedirs(directory, exist_ok=True)
+        snapshot_format = "vectors" if self.index_spec == DEFAULT_INDEX_SPEC else "faiss"
+        with self._lock.read():
+            if snapshot_format == "vectors":
+                with open(os.path.join(directory, SNAPSHOT_VECTORS_FILE), 'wb') as vectors_file, \
+                        open(os.path.join(directory, SNAPSHOT_IDS_FILE), 'wb') as ids_file:
+                    for ids, vectors in self._iter_vectors():
+                        np.ascontiguousarray(vectors, dtype=np.float32).tofile(vectors_file)
+                        np.asarray(ids, dtype=np.int64).tofile(ids_file)
+            else:
+                faiss.write_index(self._merged_faiss_index(), os.path.join(directory, SNAPSHOT_FAISS_FILE))
+        with open(os.path.join(directory, SNAPSHOT_META_FILE), 'w') as meta_file:
+            json.dump({"format": snapshot_format, "index_spec": self.index_spec, "search_params": self.search_params,
+                       "embedding_length": self._faiss_index.d}, meta_file)
+
+    def _live_base_ids(self) -> np.ndarray:
+        if len(self._removed) == 0:
+            return self._base.ids
+        return self._base.ids[~np.isin(self._base.ids, np.fromiter(self._removed, dtype=np.int64, count=len(self._removed)))]
+
+    def _iter_vectors(self):
+        """ Yield every stored (ids, vectors) a block at a time, only supported by flat indices """
+        if isinstance(self._base, _MappedVectors):
+            removed = np.fromiter(self._removed, dtype=np.int64, count=len(self._removed))
+            for start in range(0, self._base.ntotal, COPY_BLOCK_SIZE):
+                ids = self._base.ids[start:start + COPY_BLOCK_SIZE]
+                keep = ~np.isin(ids, removed)
+                yield ids[keep], self._base.vectors[start:start + COPY_BLOCK_SIZE][keep]
+        elif self._base is not None:
+            raise ValueError(f"Vectors of a mapped {self.index_spec} index can not be reconstructed")
+        if self._faiss_index.ntotal > 0:
+            yield (faiss.vector_to_array(self._faiss_index.id_map),
+                   faiss.downcast_index(self._faiss_index.index).reconstruct_n(0, self._faiss_index.ntotal))
+
+    def _merged_faiss_index(self) -> faiss.Index:
+        """ The whole index as one faiss index, with a mapped base this is a copy in memory """
+        if self._base is None:
+            return self._faiss_index
+        if isinstance(self._base, _MappedVectors):
+            merged = _new_faiss_index(self._faiss_index.d, self.index_spec)
+            for ids, vectors in self._iter_vectors():
+                merged.add_with_ids(np.ascontiguousarray(vectors), ids)
+            return merged
+        merged = faiss.read_index(self._base.path)
+        if len(self._removed) > 0:
+            merged.remove_ids(np.fromiter(self._removed, dtype=np.int64, count=len(self._removed)))
+        if self._faiss_index.ntotal > 0:
+            merged.add_with_ids(faiss.downcast_index(self._faiss_index.index).reconstruct_n(0, self._faiss_index.ntotal),
+                                faiss.vector_to_array(self._faiss_index.id_map))
+        return merged
@@ -0,0 +1,270 @@
+import os
+import queue
+import shutil
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Iterable, Optional
+import wikitextparser as wtp
+from tqdm import tqdm
+from sections import format_document_for_indexing
+from wikidb import WikipediaDatabase, path_to_wikipedia_data, path_to_wikipedia_index
+from wikidump import WikipediaDump
+
+# Number of pages written between checkpoints
+CHECKPOINT_EVERY = 1000
+LATEST_CHECKPOINT_FILE = "LATEST"
+DONE_TITLES_FILE = "done.txt"
+SECTIONS_FILE = "sections.sqlite"
+INDEX_FILE = "index.faiss"
+# Marks the end of a stage's output
+_DONE = None
+
+
+def read_titles_file(path: str) -> list[str]:
+    """ Read a file with one page title per line """
+    with open(path, 'r', encoding='utf-8') as titles_file:
+        return [line.strip() for line in titles_file if line.strip() != '']
+
+
+def load_checkpoint(checkpoint_dir: Path) -> tuple[WikipediaDatabase, set[str]]:
+    """ Open the database in checkpoint_dir at its latest checkpoint, along with the titles that are done.
+
+        The section store is written to incrementally in checkpoint_dir while the index is snapshotted at each
+        checkpoint, sections written after the latest snapshot are dropped when the database is opened.
+    """
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    store_path = str(checkpoint_dir / SECTIONS_FILE)
+    latest_file = checkpoint_dir / LATEST_CHECKPOINT_FILE
+    if not latest_file.exists():
+        return WikipediaDatabase(store_path=store_path), set()
+    latest = checkpoint_dir / latest_file.read_text().strip()
+    print(f"Resuming from checkpoint {latest}")
+    wikidb = WikipediaDatabase(store_path=store_path, index_path=str(latest / INDEX_FILE))
+    return wikidb, set(read_titles_file(str(latest / DONE_TITLES_FILE)))
+
+
+# Each worker process opens its own handle on the dump, chunks are only read once so there is nothing to cache
+_worker_dump: Optional[WikipediaDump] = None
+
+
+def extract_chunk_entries(start_byte: int, data_length: int, titles: list[str]) -> list[tuple[str, list[tuple]]]:
+    """ Decompress a chunk once and split every requested page in it into section entries.
+        Runs in a worker process, titles that are not in the chunk come back with no entries.
+    """
+    global _worker_dump
+    if _worker_dump is None:
+        _worker_dump = WikipediaDump(path_to_wikipedia_index, path_to_wikipedia_data, chunk_cache_bytes=0, page_cache_bytes=0)
+    pages = _worker_dump.get_chunk_pages(start_byte, data_length)
+    res = []
+    for title in titles:
+        text = pages.get(title)
+        entries = format_document_for_indexing(title, wtp.parse(text)) if text is not None else []
+        res.append((title, entries))
+    return res
+
+
+class IngestPipeline():
+    """ Staged bulk ingestion from the local dump into a WikipediaDatabase:
+
+            1. titles are grouped by the dump chunk they live in
+            2. a process pool decompresses each chunk once and splits its pages into sections, pages in the
+               section corpus are read already split instead
+            3. sections from many pages are packed into embedding requests sized by the index's EmbeddingBatcher,
+               with a bounded number in flight
+            4. a single writer appends embedded pages to the index and section store, checkpointing as it goes
+
+        Stages are connected by bounded queues so a slow stage applies back-pressure to the ones before it.
+        Pages with any section that failed to embed are not written or marked done, so resuming retries them whole.
+    """
+
+    def __init__(self, wikidb: WikipediaDatabase, checkpoint_dir: Optional[Path] = None, done: Optional[set[str]] = None,
+                 workers: int = os.cpu_count() or 1, max_in_flight: int = 4, queue_size: int = 64, checkpoint_every: int = CHECKPOINT_EVERY):
+        self.wikidb = wikidb
+        self.checkpoint_dir = checkpoint_dir
+        self.done = done if done is not None else set()
+        self.failed: list[str] = []
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.queue_size = queue_size
+        self.checkpoint_every = checkpoint_every
+        # Carry on numbering from the checkpoint we resumed from so it is never overwritten in place
+        latest_file = checkpoint_dir / LATEST_CHECKPOINT_FILE if checkpoint_dir is not None else None
+        self._checkpoint_count = int(latest_file.read_text().strip()) if latest_file is not None and latest_file.exists() else 0
+        self._error: Optional[BaseException] = None
+
+    def run(self, titles: Iterable[str]):
+        existing = self.wikidb.page_titles()
+        titles = [title for title in dict.fromkeys(titles) if title not in self.done and title not in existing]
+        corpus = self.wikidb.corpus
+        corpus_titles = [title for title in titles if corpus is not None and title in corpus]
+        chunks = self._group_titles_by_chunk([title for title in titles if corpus is None or title not in corpus])
+        self._progress = tqdm(total=len(titles))
+
+        embed_queue = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+        embed_thread = threading.Thread(target=self._embed_stage, args=(embed_queue, write_queue), daemon=True)
+        write_thread = threading.Thread(target=self._write_stage, args=(write_queue,), daemon=True)
+        embed_thread.start()
+        write_thread.start()
+        try:
+            self._read_corpus_stage(corpus_titles, embed_queue)
+            self._extract_stage(chunks, embed_queue)
+        finally:
+            embed_queue.put(_DONE)
+            embed_thread.join()
+            write_thread.join()
+            self._progress.close()
+
+        if self._error is not None:
+            raise self._error
+        self.checkpoint()
+        if len(self.failed) > 0:
+            print(f"Failed to embed {len(self.failed)} pages, run again to retry them")
+
+    def checkpoint(self):
+        """ Save the index and the set of finished titles into a new checkpoint directory, then point LATEST at it.
+            The section store is committed as it goes so saving it here is a no-op.
+        """
+        if self.checkpoint_dir is None:
+            return
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        self._checkpoint_count += 1
+        name = f"{self._checkpoint_count:06d}"
+        checkpoint = self.checkpoint_dir / name
+        checkpoint.mkdir(exist_ok=True)
+        self.wikidb.save(str(self.checkpoint_dir / SECTIONS_FILE), str(checkpoint / INDEX_FILE))
+        with open(checkpoint / DONE_TITLES_FILE, 'w', encoding='utf-8') as done_file:
+            done_file.writelines(f"{title}\n" for title in self.done)
+
+        latest_file = self.checkpoint_dir / LATEST_CHECKPOINT_FILE
+        previous = latest_file.read_text().strip() if latest_file.exists() else None
+        tmp_latest_file = self.checkpoint_dir / (LATEST_CHECKPOINT_FILE + ".tmp")
+        tmp_latest_file.write_text(name)
+        os.replace(tmp_latest_file, latest_file)
+        if previous is not None and previous != name:
+            shutil.rmtree(self.checkpoint_dir / previous, ignore_errors=True)
+
+    def _group_titles_by_chunk(self, titles: list[str]) -> dict[tuple[int, int], list[str]]:
+        chunks: dict[tuple[int, int], list[str]] = {}
+        for title in titles:
+            location = self.wikidb.dump.locate(title)
+            if location is None:
+                print(f"{title} is not in the local dump, skipping")
+                self.done.add(title)
+                continue
+            chunks.setdefault(location, []).append(title)
+        return chunks
+
+    def _read_corpus_stage(self, titles: list[str], embed_queue: queue.Queue):
+        """ Pages in the section corpus are already split, so they are read here instead of in the process pool """
+        for title in titles:
+            if self._error is not None:
+                break
+            # Blocks when the embedding stage falls behind
+            embed_queue.put((title, self.wikidb.corpus.get_entries(title)))
+
+    def _extract_stage(self, chunks: dict[tuple[int, int], list[str]], embed_queue: queue.Queue):
+        """ Fan chunks out to the process pool, keeping a bounded number pending """
+        pending = set()
+        chunk_items = iter(chunks.items())
+        with ProcessPoolExecutor(self.workers) as pool:
+            exhausted = False
+            while (not exhausted or pending) and self._error is None:
+                while not exhausted and len(pending) < 2 * self.workers:
+                    try:
+                        (start_byte, data_length), titles = next(chunk_items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending.add(pool.submit(extract_chunk_entries, start_byte, data_length, titles))
+                if not pending:
+                    break
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    for title, entries in future.result():
+                        # Blocks when the embedding stage falls behind
+                        embed_queue.put((title, entries))
+            for future in pending:
+                future.cancel()
+
+    def _embed_stage(self, embed_queue: queue.Queue, write_queue: queue.Queue):
+        """ Pack pages into embedding requests and keep at most max_in_flight of them running """
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        batcher = self.wikidb.index.batcher
+
+        def embed_batch(batch: list[tuple[str, list[tuple]]]):
+            try:
+                batch_entries = [entry for _, entries in batch for entry in entries]
+                embeddings = batcher.embed([entry[4] for entry in batch_entries], [entry[5] for entry in batch_entries])
+                offset = 0
+                for title, entries in batch:
+                    page_embeddings = embeddings[offset:offset + len(entries)]
+                    offset += len(entries)
+                    if any(embedding is None for embedding in page_embeddings):
+                        page_embeddings = None
+                    # Blocks when the writer falls behind, which keeps this request slot busy
+                    write_queue.put((title, entries, page_embeddings))
+            except BaseException as e:
+                # Nothing waits on the pool's futures, so stop the run with the cause rather than lose the pages
+                self._error = e
+            finally:
+                in_flight.release()
+
+        def submit(batch):
+            in_flight.acquire()
+            # A request that was running while this one waited for a slot may have failed
+            if self._error is not None:
+                in_flight.release()
+                return
+            pool.submit(embed_batch, batch)
+
+        batch, batch_items, batch_tokens = [], 0, 0
+        with ThreadPoolExecutor(self.max_in_flight) as pool:
+            while True:
+                item = embed_queue.get()
+                if item is _DONE:
+                    break
+                title, entries = item
+                if self._error is not None:
+                    # The writer would throw the embeddings away, keep draining so extraction can finish
+                    batch, batch_items, batch_tokens = [], 0, 0
+                    continue
+                if len(entries) == 0:
+                    write_queue.put((title, entries, []))
+                    continue
+                page_tokens = sum(entry[5] for entry in entries)
+                if batch_items > 0 and (batch_items + len(entries) > batcher.max_items or batch_tokens + page_tokens > batcher.max_tokens):
+                    submit(batch)
+                    batch, batch_items, batch_tokens = [], 0, 0
+                batch.append(item)
+                batch_items += len(entries)
+                batch_tokens += page_tokens
+            if len(batch) > 0 and self._error is None:
+                submit(batch)
+        write_queue.put(_DONE)
+
+    def _write_stage(self, write_queue: queue.Queue):
+        """ The only stage that touches the database, so appends never interleave """
+        since_checkpoint = 0
+        while True:
+            item = write_queue.get()
+            if item is _DONE:
+                break
+            title, entries, embeddings = item
+            self._progress.update(1)
+            # Keep draining after an error so the upstream stages can finish
+            if self._error is not None:
+                continue
+            try:
+                if embeddings is None:
+                    self.failed.append(title)
+                    continue
+                self.wikidb.add_embedded_entries(entries, embeddings)
+                self.done.add(title)
+                since_checkpoint += 1
+                if since_checkpoint >= self.checkpoint_every:
+                    self.checkpoint()
+                    since_checkpoint = 0
+            except BaseException as e:
+                self._error = e
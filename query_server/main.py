@@ -1,27 +1,33 @@
-from typing import List
+from typing import List, Optional, Union
 import logging
 from uuid import uuid4
-from fastapi import FastAPI, Response, Request, status
+from fastapi import FastAPI, HTTPException, Response, Request, status
 from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse
-from sse_starlette.sse import EventSourceResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
+from sse_starlette.sse import EventSourceResponse
 from config import settings
 from functools import lru_cache
 import json
 import os
 import asyncio
-from query_agent import QueryAgent, ChatEntry
+import metrics
+from models import ChatDelta, ChatEntry
+from query_agent import QueryAgent
+from session_store import SessionData, open_session_store, sweep_periodically
+from wikidb import resolve_snapshot
 
-class SessionData(BaseModel):
-    chat: List[ChatEntry]
-# Just store session in memory for now
-cookie_to_session: dict[str, SessionData] = {}
+sessions = open_session_store(settings.session_backend, settings.session_store_path,
+                              ttl_seconds=settings.session_ttl_seconds, max_entries=settings.session_max_entries)
 
 os.environ["OPENAI_API_KEY"] = settings.openai_api_key
-agent = QueryAgent(dataframe_path=settings.wiki_db_path, index_path=settings.index_path)
+if settings.snapshot_root:
+    store_path, index_path = resolve_snapshot(settings.snapshot_root)
+else:
+    store_path, index_path = settings.wiki_db_path, settings.index_path
+agent = QueryAgent(store_path=store_path, index_path=index_path, immutable=bool(settings.snapshot_root))
 app = FastAPI()
 origins = ["http://localhost:3000", "https://localhost:3000"]
 app.add_middleware(
@@ -32,6 +38,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def startup():
+    await agent.open_http_session(settings.openai_max_connections)
+    app.state.session_sweeper = asyncio.create_task(sweep_periodically(sessions, settings.session_sweep_interval_seconds))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.session_sweeper.cancel()
+    await agent.close()
+
+
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
     exc_str = f'{exc}'.replace('\n', ' ').replace('   ', ' ')
@@ -39,32 +57,81 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
     content = {'status_code': 10422, 'message': exc_str, 'data': None}
     return JSONResponse(content=content, status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
 
+# Clients send this header set to 1, or ?trace=1 to the event stream, to get the time spent in each stage of their
+# request back as a Server-Timing header or a trace event
+TRACE_HEADER = "X-Trace"
+
+
+def start_trace_if_asked(request: Request) -> Optional[metrics.Trace]:
+    if request.headers.get(TRACE_HEADER) == "1" or request.query_params.get("trace") == "1":
+        return metrics.start_trace()
+    return None
+
+
+def add_server_timing(response: Response, trace: Optional[metrics.Trace]):
+    if trace is not None:
+        response.headers["Server-Timing"] = trace.server_timing()
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.get("/query/{query}")
-def query(query: str):
-    return agent.query(query)
+async def query(query: str, request: Request, response: Response):
+    trace = start_trace_if_asked(request)
+    answer = await agent.aquery(query)
+    add_server_timing(response, trace)
+    return answer
+
+
+class BatchQuery(BaseModel):
+    questions: List[str]
+
+
+@app.post("/batch_query")
+async def batch_query(batch: BatchQuery, request: Request, response: Response) -> List[ChatEntry]:
+    if len(batch.questions) > settings.batch_query_max_questions:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"At most {settings.batch_query_max_questions} questions per batch")
+    trace = start_trace_if_asked(request)
+    answers = await agent.abatch_query(batch.questions, settings.batch_query_concurrency)
+    add_server_timing(response, trace)
+    return answers
 
 
 @app.post("/chat")
-def chat(chat: List[ChatEntry]):
-    return agent.chat(chat)
+async def chat(chat: List[ChatEntry], request: Request, response: Response):
+    trace = start_trace_if_asked(request)
+    answer = await agent.achat(chat)
+    add_server_timing(response, trace)
+    return answer
 
 
 @app.post("/create_streaming_chat")
-async def create_streaming_chat(chat: List[ChatEntry], response: Response):
-    session_id = uuid4()
-    data = SessionData(chat=chat)
-    cookie_to_session[str(session_id)] = data
+async def create_streaming_chat(chat: List[ChatEntry], request: Request, response: Response):
+    session_id = request.cookies.get('session_id')
+    session = await asyncio.to_thread(sessions.get, session_id) if session_id is not None else None
+    if session is not None and session.chat == chat[:len(session.chat)]:
+        # The client resends the whole chat every turn, keep the session so its history memo carries over
+        session.chat = chat
+    else:
+        session_id = str(uuid4())
+        session = SessionData(chat=chat)
+    await asyncio.to_thread(sessions.put, session_id, session)
     response.set_cookie(key="session_id", value=session_id,
                         samesite='none', secure=True)
 
     return {"success": True}
 
 
-def encode_chat_for_sse(chat: ChatEntry) -> dict:
+def encode_chat_for_sse(chat: Union[ChatEntry, ChatDelta], event_id: str) -> dict:
     encoded = jsonable_encoder(chat)
     return {
-        "event": "message",
-        "id": "message_id",
+        # Deltas append to the entry being streamed, messages add or replace whole entries
+        "event": "delta" if isinstance(chat, ChatDelta) else "message",
+        "id": event_id,
         "retry": RETRY_TIMEOUT,
         "data": json.dumps(encoded)
     }
@@ -74,22 +141,31 @@ RETRY_TIMEOUT = 10000  # milisecond
 @app.get("/get_streaming_chat_response")
 async def get_streaming_chat_response(request: Request):
     session_id = request.cookies.get('session_id')
-    chat = cookie_to_session[session_id].chat
+    session = await asyncio.to_thread(sessions.get, session_id) if session_id is not None else None
+    if session is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown or expired chat session")
 
     async def event_generator():
-        chat_generator = agent.chat_streaming(chat)
+        # Started here since the stream is generated in its own task
+        trace = start_trace_if_asked(request)
+        chat_generator = agent.achat_streaming(session.chat, session.memory)
         try:
-            while True:
+            # Sessions span several turns, so ids are scoped to this stream
+            stream_id = uuid4().hex
+            event_count = 0
+            async for response_chat in chat_generator:
                 if await request.is_disconnected():
                     break
-
-                try:
-                    response_chat = next(chat_generator)
-                except StopIteration:
-                    break
-                
-                yield encode_chat_for_sse(response_chat)
+                event_count += 1
+                yield encode_chat_for_sse(response_chat, f"{stream_id}-{event_count}")
+            else:
+                if trace is not None:
+                    yield {"event": "trace", "id": f"{stream_id}-trace", "retry": RETRY_TIMEOUT, "data": json.dumps(trace.to_dict())}
         except asyncio.CancelledError as e:
             print("Disconnected stream")
+        finally:
+            await chat_generator.aclose()
+            # Keep the history memo the agent updated for the next turn
+            await asyncio.to_thread(sessions.put, session_id, session)
 
     return EventSourceResponse(event_generator())
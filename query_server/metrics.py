@@ -0,0 +1,235 @@
+import asyncio
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+# Prometheus text exposition format served by /metrics
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds, from a cached page read to a slow completion
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _Value():
+    """ The value of one set of labels of a counter or gauge, or a function read when metrics are rendered """
+
+    def __init__(self):
+        self.value = 0.0
+        self.function: Optional[Callable[[], float]] = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        """ Read the value from function whenever metrics are rendered, for numbers that are already kept elsewhere """
+        self.function = function
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+
+class _Buckets():
+    """ The observations of one set of labels of a histogram """
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        # Per bucket, not cumulative, the last one is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class _Metric():
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children: dict[tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def labels(self, *values: str):
+        """ The child holding the values of one set of labels, created on first use """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} has labels {self.labelnames}, got {values}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        return _Value()
+
+    def _label_text(self, values: tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values: tuple[str, ...], child: _Value) -> list[str]:
+        return [f"{self.name}{self._label_text(values)} {_number(child.get())}"]
+
+
+class Counter(_Metric):
+    """ A total that only goes up, e.g. questions answered or tokens sent """
+    kind = "counter"
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    """ A value that goes up and down, e.g. the number of vectors in the index """
+    kind = "gauge"
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self.labels().set_function(function)
+
+
+class Histogram(_Metric):
+    """ Counts of observations in cumulative buckets with their sum, e.g. latencies in seconds """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def _render_child(self, values: tuple[str, ...], child: _Buckets) -> list[str]:
+        with child._lock:
+            counts, total = list(child.counts), child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = 'le="' + _number(bound) + '"'
+            lines.append(f"{self.name}_bucket{self._label_text(values, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(values)} {_number(total)}")
+        lines.append(f"{self.name}_count{self._label_text(values)} {cumulative}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+REGISTRY: list[_Metric] = []
+
+
+def render() -> str:
+    """ Every metric in the Prometheus text format """
+    return "\n".join(line for metric in REGISTRY for line in metric.render()) + "\n"
+
+
+class Trace():
+    """ The spans of one request, collected when the client asks for them, see start_trace """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        # (stage, seconds from the start of the trace, duration in seconds) in the order they finished
+        self.spans: list[tuple[str, float, float]] = []
+
+    def server_timing(self) -> str:
+        """ The spans as a Server-Timing header value """
+        return ", ".join(f"{stage};dur={duration * 1000:.2f}" for stage, _, duration in self.spans)
+
+    def to_dict(self) -> dict:
+        return {"spans": [{"stage": stage, "start_ms": round(start * 1000, 3), "duration_ms": round(duration * 1000, 3)}
+                          for stage, start, duration in self.spans]}
+
+
+# Follows the request into tasks and asyncio.to_thread, which copy the context, but not into worker processes
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+def start_trace() -> Trace:
+    """ Record the spans of the current task and everything it starts from here on """
+    trace = Trace()
+    _current_trace.set(trace)
+    return trace
+
+
+stage_seconds = Histogram("wiki_stage_seconds", "Time spent in each stage of answering a question", ("stage",))
+
+
+def record(stage: str, start: float, end: float):
+    """ Record a stage that ran between two time.perf_counter() readings """
+    stage_seconds.labels(stage).observe(end - start)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.spans.append((stage, start - trace.start, end - start))
+
+
+@contextmanager
+def span(stage: str):
+    """ Time a stage into stage_seconds and the current trace, if any. Costs a couple of microseconds. """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, start, time.perf_counter())
+
+
+def timed(stage: str):
+    """ Decorator that times every call of a function or coroutine function as a span """
+    def decorate(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def timed_coroutine(*args, **kwargs):
+                with span(stage):
+                    return await function(*args, **kwargs)
+            return timed_coroutine
+
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+        return timed_function
+    return decorate
+
+
+# Counters and gauges of the query pipeline, the ones backed by functions are bound by QueryAgent
+questions = Counter("wiki_questions_total", "Questions answered, by endpoint kind", ("kind",))
+fallbacks = Counter("wiki_fallbacks_total", "Questions the index could not answer that were looked up on wikipedia")
+tokens_sent = Counter("wiki_tokens_sent_total", "Tokens sent to OpenAI, by request kind", ("kind",))
+cache_hits = Counter("wiki_cache_hits_total", "Cache hits, by cache", ("cache",))
+cache_misses = Counter("wiki_cache_misses_total", "Cache misses, by cache", ("cache",))
+index_vectors = Gauge("wiki_index_vectors", "Vectors in the NN index")
+queued_pages = Gauge("wiki_queued_pages", "Pages waiting for the database writer")
@@ -0,0 +1,31 @@
+from enum import Enum
+from typing import Optional
+from pydantic import BaseModel
+
+
+class Author(Enum):
+    AGENT = 0
+    USER = 1
+
+class ChatEntry(BaseModel):
+    content: str
+    author: Author
+    context: Optional[str]
+    isTransient: Optional[bool]
+    isStop: Optional[bool]
+
+
+class ChatDelta(BaseModel):
+    """ Text to append to the entry being streamed """
+    delta: str
+
+
+class ChatMemory(BaseModel):
+    """ Rolling history of a chat session, kept with the session so a turn only does work for what is new.
+
+        Turns older than the token budget are folded into summary, the rest are sent verbatim.
+        turn_tokens holds the token count of every (human, agent) turn seen so far, counted once.
+    """
+    summary: str = ""
+    summarized_turns: int = 0
+    turn_tokens: list[int] = []
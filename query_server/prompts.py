@@ -35,6 +35,18 @@ Chat History:
 Follow Up Question: {question}
 Standalone Question:""")
 
+chat_memo_template = PromptTemplate(
+    input_variables=["summary", "new_lines"],
+    template="""Progressively summarize the lines of conversation provided, adding onto the previous summary and returning a new summary. Keep the names, dates and topics the human asked about.
+
+Current summary:
+{summary}
+
+New lines of conversation:
+{new_lines}
+
+New summary:""")
+
 wikipedia_query_generation = PromptTemplate(
     input_variables=["question"],
     template="""
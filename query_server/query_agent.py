@@ -1,53 +1,185 @@
+import asyncio
+import aiohttp
+import metrics
+import multiprocessing
 import tiktoken
 import openai
+import numpy as np
+import time
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional
-from pydantic import BaseModel
-from enum import Enum
+from answer_cache import AnswerCache, CachedAnswer
+from config import settings
+from metrics import span, timed
+from models import Author, ChatDelta, ChatEntry, ChatMemory
+from ingest import extract_chunk_entries
 from wikidb import WikipediaDatabase
-import wikitextparser as wtp
-from prompts import answer_with_context, wikipedia_query_generation, chat_entry_template, chat_with_context_template, chat_summarize_template
-from token_consts import MAX_COMPLETION_TOKENS
+from section_store import Section
+from query_batcher import QueryBatcher
+from prompts import answer_with_context, wikipedia_query_generation, chat_entry_template, chat_with_context_template, chat_summarize_template, chat_memo_template
+from token_consts import MAX_COMPLETION_TOKENS, MAX_HISTORY_TOKENS, MAX_SUMMARY_TOKENS
 
 ENCODING = "cl100k_base"  # encoding for text-embedding-ada-002
+COMPLETIONS_MODEL = "text-davinci-003"
+MAX_SECTION_LEN = 2000
+SEPARATOR = "\n* "
+# Sections whose word sets overlap at least this much are treated as the same text
+DUPLICATE_SIMILARITY = 0.9
+# How the prompts ask the model to answer when the context does not hold the answer
+UNKNOWN_ANSWER = "I don't know"
+# Yielded by _astream_answer in place of text once the answer turns out to be UNKNOWN_ANSWER
+UNKNOWN = object()
+# Answer to a question of a batch that failed, e.g. on an OpenAI error or timeout
+BATCH_ERROR_ANSWER = "Sorry, something went wrong answering this question, please ask again."
 
-class Author(Enum):
-    AGENT = 0
-    USER = 1
 
-class ChatEntry(BaseModel):
-    content: str
-    author: Author
-    context: Optional[str]
-    isTransient: Optional[bool]
-    isStop: Optional[bool]
+def _is_unknown(answer: str) -> bool:
+    """ Whether a completion is the model saying the context does not hold the answer """
+    return answer.strip().lower().startswith(UNKNOWN_ANSWER.lower())
+
+
+def sections_within_budget(sections: list[Section], max_tokens: int, separator_len: int) -> int:
+    """ How many of the sections, taken in order, fit within max_tokens including a separator before each """
+    lengths = np.fromiter((section.tokens for section in sections), dtype=np.int64, count=len(sections)) + separator_len
+    return int(np.searchsorted(np.cumsum(lengths), max_tokens, side="right"))
+
+
+def dedupe_sections(sections: list[Section], threshold: float = DUPLICATE_SIMILARITY) -> list[Section]:
+    """ Drop sections that are near copies of a more relevant one, e.g. the same boilerplate on several pages """
+    kept, kept_words = [], []
+    for section in sections:
+        words = frozenset(section.content.lower().split())
+        if any(len(words & other) >= threshold * len(words | other) for other in kept_words):
+            continue
+        kept.append(section)
+        kept_words.append(words)
+    return kept
 
 
 class QueryAgent():
 
-    def __init__(self, dataframe_path: str, index_path: str):
-        self._wikidb = WikipediaDatabase(dataframe_path=dataframe_path, index_path=index_path)
+    def __init__(self, store_path: str, index_path: str, immutable: bool = False):
+        # Workers share the store file, pages read by the fallback are added to this process only.
+        # Published snapshots are never written again and are opened immutable.
+        self._wikidb = WikipediaDatabase(store_path=store_path, index_path=index_path, read_only=True, immutable=immutable)
         self.tokenizer = tiktoken.get_encoding(ENCODING)
+        self.separator_len = len(self.tokenizer.encode(SEPARATOR))
+        self._http_session: Optional[aiohttp.ClientSession] = None
+        # Started on the first fallback, pages are decompressed and split into sections off the event loop
+        self._extract_pool: Optional[ProcessPoolExecutor] = None
+        # Chat and query answers are phrased by different prompts so they are cached apart
+        self.chat_answers = self._new_answer_cache()
+        self.query_answers = self._new_answer_cache()
+        # Concurrent requests share embedding calls and index searches
+        self.query_batcher = QueryBatcher(self._wikidb.index, settings.query_batch_window_ms / 1000, settings.query_batch_max_size)
+        self._bind_metrics()
+
+    def _bind_metrics(self):
+        """ Serve the counts the caches and the database already keep through the metrics registry """
+        dump = self._wikidb.dump
+        caches = {"chat_answer": self.chat_answers, "query_answer": self.query_answers,
+                  "chunk": dump.chunk_cache, "page": dump.page_cache}
+        if self._wikidb.index.embedder.cache is not None:
+            caches["embedding"] = self._wikidb.index.embedder.cache
+        for name, cache in caches.items():
+            metrics.cache_hits.labels(name).set_function(lambda cache=cache: cache.hits)
+            metrics.cache_misses.labels(name).set_function(lambda cache=cache: cache.misses)
+        metrics.index_vectors.set_function(lambda: self._wikidb.index.ntotal)
+        metrics.queued_pages.set_function(self._wikidb.queued_page_count)
+
+    async def open_http_session(self, max_connections: int):
+        """ Create the connection pool shared by every async OpenAI request, must be called from the event loop """
+        self._http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=max_connections))
+
+    async def close(self):
+        """ Release the connection pool and the page extraction processes and finish queued database writes """
+        if self._http_session is not None:
+            await self._http_session.close()
+            self._http_session = None
+        if self._extract_pool is not None:
+            self._extract_pool.shutdown(wait=False, cancel_futures=True)
+            self._extract_pool = None
+        await asyncio.to_thread(self._wikidb.close)
+
+    def _use_http_session(self):
+        # openai reads the session from a context variable, without one it opens a new connection per request
+        if self._http_session is not None:
+            openai.aiosession.set(self._http_session)
 
     # Return response types
     def query(self, query) -> str:
         return self.answer_query_with_context(query)
 
-    def _do_completion(self, query=False, max_tokens=MAX_COMPLETION_TOKENS) -> str:
-        COMPLETIONS_MODEL = "text-davinci-003"
-        COMPLETIONS_API_PARAMS = {
+    def _new_answer_cache(self) -> AnswerCache:
+        cache = AnswerCache(settings.answer_cache_entries, settings.answer_cache_ttl_seconds,
+                            settings.answer_cache_threshold, settings.answer_cache_invalidation_threshold)
+        self._wikidb.index.add_listeners.append(cache.invalidate)
+        return cache
+
+    def _cached_answer(self, cache: AnswerCache, query: str) -> tuple[Optional[list[float]], Optional[CachedAnswer]]:
+        """ The embedding of a standalone question and the cached answer to it, if any """
+        if cache.max_entries <= 0:
+            return None, None
+        embeddings = self._wikidb.index.embedder.get_embedding(query)
+        return self._lookup_answer(cache, embeddings)
+
+    async def _acached_answer(self, cache: AnswerCache, query: str) -> tuple[Optional[list[float]], Optional[CachedAnswer]]:
+        if cache.max_entries <= 0:
+            return None, None
+        embedding = await self.query_batcher.embedding(query)
+        if embedding is None:
+            return None, None
+        # The cache is searched with faiss, keep it off the event loop
+        return embedding, await asyncio.to_thread(cache.get, embedding)
+
+    def _lookup_answer(self, cache: AnswerCache, embeddings: Optional[list[list[float]]]) -> tuple[Optional[list[float]], Optional[CachedAnswer]]:
+        if embeddings is None:
+            return None, None
+        return embeddings[0], cache.get(embeddings[0])
+
+    def _remember_answer(self, cache: AnswerCache, query: str, embedding: Optional[list[float]], answer: str, context: str):
+        # Answers we could not find are retried next time rather than cached
+        if embedding is not None and not _is_unknown(answer):
+            cache.put(query, embedding, answer, context)
+
+    async def _aremember_answer(self, cache: AnswerCache, query: str, embedding: Optional[list[float]], answer: str, context: str):
+        await asyncio.to_thread(self._remember_answer, cache, query, embedding, answer, context)
+
+    def _completion_params(self, max_tokens: int) -> dict:
+        return {
             "temperature": 0.0,
             "max_tokens": max_tokens,
             "model": COMPLETIONS_MODEL,
         }
 
+    def _do_completion(self, query=False, max_tokens=MAX_COMPLETION_TOKENS) -> str:
         # TODO: handle errors
-        response = openai.Completion.create(
-            prompt=query,
-            **COMPLETIONS_API_PARAMS
-        )
+        with span("completion"):
+            response = openai.Completion.create(
+                prompt=query,
+                **self._completion_params(max_tokens)
+            )
+        self._count_completion_tokens(response)
+        return response["choices"][0]["text"]
 
+    async def _ado_completion(self, query: str, max_tokens=MAX_COMPLETION_TOKENS) -> str:
+        with span("completion"):
+            response = await openai.Completion.acreate(
+                prompt=query,
+                **self._completion_params(max_tokens)
+            )
+        self._count_completion_tokens(response)
         return response["choices"][0]["text"]
 
+    def _count_completion_tokens(self, response):
+        # Whole completions report their prompt size, so it does not have to be tokenized again
+        if "usage" in response:
+            metrics.tokens_sent.labels("completion").inc(response["usage"]["prompt_tokens"])
+
+    def _count_prompt_tokens(self, prompt: str):
+        metrics.tokens_sent.labels("completion").inc(len(self.tokenizer.encode(prompt)))
+
+    @timed("generate_searches")
     def generate_searches_for_wikipedia(self, query: str) -> list[str]:
         wiki_queries = self._do_completion(
             wikipedia_query_generation.format(question=query)).split("\n")
@@ -55,130 +187,480 @@ class QueryAgent():
                         for q in wiki_queries if (q is not None and q.strip() != '')] + [query]
         return wiki_queries
     
-    def get_relevant_wikipedia_pages(self, wiki_queries: list[str]) -> list[tuple[str, wtp.WikiText]]:
-        res = []
-        articles = []
-        for wiki_query in wiki_queries:
-            relevant_articles = self._wikidb.search(wiki_query)
-            articles.extend(relevant_articles)
-        # Filter duplicates
-        articles = [*set(articles)]
-        for title in articles:
-            page = self._wikidb.get_page(title)
-            if page:
-                res.append((title, page))
-        return res
-
     def update_index_for_query(self, query: str):
-        wiki_queries = self.generate_searches_for_wikipedia(query)
-        print(f"Queries {wiki_queries}")
-        titles_pages = self.get_relevant_wikipedia_pages(wiki_queries)
-        for title, page in titles_pages:
-            self._wikidb.add_page(title, page)
+        asyncio.run(self.aupdate_index_for_query(query))
 
     def update_index_for_query_streaming(self, query: str):
-        wiki_queries = self.generate_searches_for_wikipedia(query)
-        titles_pages = self.get_relevant_wikipedia_pages(wiki_queries)
-        for title, page in titles_pages:
-            yield title
-            self._wikidb.add_page(title, page)
+        # Drive the concurrent fan out from sync callers on a private event loop
+        loop = asyncio.new_event_loop()
+        titles = self.aupdate_index_for_query_streaming(query)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(titles.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(titles.aclose())
+            loop.close()
 
     def answer_query_with_context(self, query: str) -> ChatEntry:
-        context = self.get_context_for_question(query)
+        metrics.questions.labels("query").inc()
+        embedding, cached = self._cached_answer(self.query_answers, query)
+        if cached is not None:
+            return ChatEntry(content=cached.answer, author=Author.AGENT, context=cached.context)
+        context = self.get_context_for_question(query, embedding=embedding)
         prompt = answer_with_context.format(context=context, question=query)
 
         # TODO: fuzzy match
         answer = self._do_completion(prompt).strip("\n").strip()
-        if answer == "I don't know.":
+        if _is_unknown(answer):
             self.update_index_for_query(query)
 
             # Try again
             # TODO: maybe forcefully insert neighbors
-            context = self.get_context_for_question(query)
+            context = self.get_context_for_question(query, embedding=embedding)
             prompt = answer_with_context.format(
                 context=context, question=query)
-            answer = self._do_completion(prompt).strip("\n")
+            answer = self._do_completion(prompt).strip("\n").strip()
 
+        self._remember_answer(self.query_answers, query, embedding, answer, context)
         return ChatEntry(content=answer, author=Author.AGENT, context=context)
 
-    def summarize_chat(self, chat: list[ChatEntry]) -> str:
-        formatted_chats = []
-        i = 0
-        # TODO: use a token budget for history
-        while i < len(chat) - 1:
-            formatted_chats.append(chat_entry_template.format(
-                human_text=chat[i].content, agent_text=chat[i+1].content))
-            i += 2
-        query = chat[len(chat)-1].content
-        history = "\n".join(formatted_chats)
+    def _format_turn(self, chat: list[ChatEntry], turn: int) -> str:
+        return chat_entry_template.format(human_text=chat[2 * turn].content, agent_text=chat[2 * turn + 1].content)
+
+    def _roll_history(self, chat: list[ChatEntry], memory: ChatMemory) -> tuple[list[str], list[str]]:
+        """ Count tokens for the turns memory has not seen and truncate from the oldest end to the token budget.
+            Returns the formatted turns that fell out of the budget, to be folded into the summary, and those within it.
+        """
+        turns = (len(chat) - 1) // 2
+        if len(memory.turn_tokens) > turns:
+            # Not a continuation of the chat this memory was built from
+            memory.summary, memory.summarized_turns, memory.turn_tokens = "", 0, []
+        for turn in range(len(memory.turn_tokens), turns):
+            memory.turn_tokens.append(len(self.tokenizer.encode(self._format_turn(chat, turn))))
+
+        start = memory.summarized_turns
+        window_tokens = sum(memory.turn_tokens[start:turns])
+        while window_tokens > MAX_HISTORY_TOKENS:
+            window_tokens -= memory.turn_tokens[start]
+            start += 1
+        evicted = [self._format_turn(chat, turn) for turn in range(memory.summarized_turns, start)]
+        window = [self._format_turn(chat, turn) for turn in range(start, turns)]
+        return evicted, window
+
+    def _fold_chunks(self, memory: ChatMemory, evicted: list[str]) -> list[list[str]]:
+        """ Split the turns leaving the window into runs within the history budget, one memo completion each, so a
+            memory that is far behind is caught up in steps rather than with one prompt of every turn it missed
+        """
+        chunks, chunk_tokens = [], 0
+        for turn, text in enumerate(evicted, start=memory.summarized_turns):
+            if len(chunks) == 0 or chunk_tokens + memory.turn_tokens[turn] > MAX_HISTORY_TOKENS:
+                chunks.append([])
+                chunk_tokens = 0
+            chunks[-1].append(text)
+            chunk_tokens += memory.turn_tokens[turn]
+        return chunks
 
-        if len(chat) > 2:
-            summarize_history_prompt = chat_summarize_template.format(
-                chat_history=history, question=query)
+    def _summarize_prompt(self, query: str, summary: str, turns: list[str]) -> Optional[str]:
+        """ The prompt that rewrites the latest question into a standalone one, None when there is no history """
+        if summary == "" and len(turns) == 0:
+            return None
+        history = "\n".join(turns)
+        if summary != "":
+            history = f"Summary of the earlier conversation: {summary}\n{history}"
+        return chat_summarize_template.format(chat_history=history, question=query)
+
+    def _memo_prompt(self, memory: ChatMemory, evicted: list[str]) -> str:
+        return chat_memo_template.format(summary=memory.summary, new_lines="\n".join(evicted))
+
+    def _plan_summary(self, chat: list[ChatEntry], query: str, memory: Optional[ChatMemory]) -> tuple[list[list[str]], Optional[str]]:
+        """ The chunks of turns to fold into memory's summary and the prompt that rewrites the question.
+
+            Without a memory nothing would keep a summary, so turns past the budget are dropped rather than folded.
+            With one, the latest chunk leaving the window is still sent verbatim this once, so folding does not have
+            to finish before the question is rewritten.
+        """
+        if memory is None:
+            _, window = self._roll_history(chat, ChatMemory())
+            return [], self._summarize_prompt(query, "", window)
+        evicted, window = self._roll_history(chat, memory)
+        chunks = self._fold_chunks(memory, evicted)
+        recent = chunks[-1] if len(chunks) > 0 else []
+        return chunks, self._summarize_prompt(query, memory.summary, recent + window)
+
+    @timed("summarize_chat")
+    def summarize_chat(self, chat: list[ChatEntry], memory: Optional[ChatMemory] = None) -> str:
+        query = chat[len(chat)-1].content
+        chunks, summarize_history_prompt = self._plan_summary(chat, query, memory)
+        for chunk in chunks:
+            memory.summary = self._do_completion(self._memo_prompt(memory, chunk), max_tokens=MAX_SUMMARY_TOKENS).strip()
+            memory.summarized_turns += len(chunk)
+        if summarize_history_prompt is not None:
             query = self._do_completion(
                 summarize_history_prompt).strip("\n").strip()
             print(f"New query is {query}")
         return query
 
-    def answer_chat_query(self, query) -> tuple[str]:
-        context = self.get_context_for_question(query)
+    @timed("answer_chat_query")
+    def answer_chat_query(self, query, embedding: Optional[list[float]] = None) -> tuple[str]:
+        context = self.get_context_for_question(query, embedding=embedding)
         chat_prompt = chat_with_context_template.format(
             context=context, question=query)
         answer = self._do_completion(chat_prompt).strip("\n").strip()
         return answer, context
 
-    def chat(self, chat: list[ChatEntry]) -> ChatEntry:
-        query = self.summarize_chat(chat)
-        answer, context = self.answer_chat_query(query)
-        if answer == "I don't know.":
+    def chat(self, chat: list[ChatEntry], memory: Optional[ChatMemory] = None) -> ChatEntry:
+        metrics.questions.labels("chat").inc()
+        query = self.summarize_chat(chat, memory)
+        embedding, cached = self._cached_answer(self.chat_answers, query)
+        if cached is not None:
+            return ChatEntry(content=cached.answer, author=Author.AGENT, context=cached.context)
+        answer, context = self.answer_chat_query(query, embedding)
+        if _is_unknown(answer):
             self.update_index_for_query(query)
-            context = self.get_context_for_question(query)
+            context = self.get_context_for_question(query, embedding=embedding)
             prompt = chat_with_context_template.format(
                 context=context, question=query)
-            answer = self._do_completion(prompt).strip("\n")
+            answer = self._do_completion(prompt).strip("\n").strip()
 
+        self._remember_answer(self.chat_answers, query, embedding, answer, context)
         return ChatEntry(content=answer, author=Author.AGENT, context=context)
 
-    def chat_streaming(self, chat: list[ChatEntry]):
-        query = self.summarize_chat(chat)
-        answer, context = self.answer_chat_query(query)
-        if answer == "I don't know.":
+    def chat_streaming(self, chat: list[ChatEntry], memory: Optional[ChatMemory] = None):
+        metrics.questions.labels("chat").inc()
+        query = self.summarize_chat(chat, memory)
+        embedding, cached = self._cached_answer(self.chat_answers, query)
+        if cached is not None:
+            yield ChatEntry(content=cached.answer, author=Author.AGENT, context=cached.context, isStop=True, isTransient=False)
+            return
+        answer, context = self.answer_chat_query(query, embedding)
+        if _is_unknown(answer):
             yield ChatEntry(content="I don't know, let me see if I can find out", author=Author.AGENT, context=context)
             for title in self.update_index_for_query_streaming(query):
                 yield ChatEntry(content=f"I'm reading... {title}", author=Author.AGENT, context='', isTransient=True, isStop=False)
             yield ChatEntry(content=f"I'm synthesizing what I just read...", author=Author.AGENT, context='', isTransient=True, isStop=False)
-            answer, context = self.answer_chat_query(query)
+            answer, context = self.answer_chat_query(query, embedding)
             yield ChatEntry(content=answer, author=Author.AGENT, context=context, isStop=True, isTransient=True)
+        self._remember_answer(self.chat_answers, query, embedding, answer, context)
         yield ChatEntry(content=answer, author=Author.AGENT, context=context, isStop=True, isTransient=False)
 
-    def get_context_for_question(self, question: str) -> tuple[str, str]:
+    def get_context_for_question(self, question: str, candidate_depth: Optional[int] = None,
+                                 embedding: Optional[list[float]] = None) -> str:
+        """
+        Fetch relevant sections and insert as many as possible.
+        candidate_depth overrides how many dense and BM25 candidates are fused, 0 uses the dense index alone.
+        Pass the question's embedding when it is already known, e.g. from the answer cache lookup.
+        """
+        return self.get_contexts_for_questions([question], candidate_depth, None if embedding is None else [embedding])[0]
+
+    def get_contexts_for_questions(self, questions: list[str], candidate_depth: Optional[int] = None,
+                                   embeddings: Optional[list[Optional[list[float]]]] = None) -> list[str]:
         """
-        Fetch relevant sections and insert as many as possible
+        Build the context for many questions at once, the questions are embedded in batches and searched as
+        one matrix, and the sections for each question are fetched with one store call
         """
+        with span("retrieve"):
+            neighbours = self._wikidb.index.get_closest_indices_batch(questions, candidate_depth=candidate_depth,
+                                                                      embeddings=embeddings)
+        return self._build_contexts(neighbours)
 
-        MAX_SECTION_LEN = 2000
-        SEPARATOR = "\n* "
+    @timed("build_context")
+    def _build_contexts(self, neighbours: list[list[int]]) -> list[str]:
+        contexts = []
+        for most_relevant_indices in neighbours:
+            print(f"found: {len(most_relevant_indices)} neighbors")
+            sections = dedupe_sections(self._wikidb.get_section_by_ids(most_relevant_indices))
+            # Add contexts until we run out of space.
+            chosen_sections = sections[:sections_within_budget(sections, MAX_SECTION_LEN, self.separator_len)]
+            contexts.append("".join(SEPARATOR + section.content.replace("\n", " ") for section in chosen_sections))
+        return contexts
 
-        encoding = tiktoken.get_encoding(ENCODING)
-        separator_len = len(encoding.encode(SEPARATOR))
+    # Async variants used by the server. OpenAI requests are awaited on the shared connection pool and
+    # FAISS search, dump decompression, wikitext parsing and store access run on worker threads.
 
-        most_relevant_indices = self._wikidb.index.get_closest_indices(
-            question)
-        print(f"found: {len(most_relevant_indices)} neighbors")
-        chosen_sections = []
-        chosen_sections_len = 0
-        chosen_sections_indexes = []
+    async def aquery(self, query: str) -> ChatEntry:
+        self._use_http_session()
+        metrics.questions.labels("query").inc()
+        embedding, cached = await self._acached_answer(self.query_answers, query)
+        if cached is not None:
+            return ChatEntry(content=cached.answer, author=Author.AGENT, context=cached.context)
+        context = await self.aget_context_for_question(query, embedding=embedding)
+        answer = (await self._ado_completion(answer_with_context.format(context=context, question=query))).strip("\n").strip()
+        if _is_unknown(answer):
+            await self.aupdate_index_for_query(query)
+            context = await self.aget_context_for_question(query, embedding=embedding)
+            answer = (await self._ado_completion(answer_with_context.format(context=context, question=query))).strip("\n").strip()
+        await self._aremember_answer(self.query_answers, query, embedding, answer, context)
+        return ChatEntry(content=answer, author=Author.AGENT, context=context)
 
-        for section_index in most_relevant_indices:
-            # Add contexts until we run out of space.
-            document_section = self._wikidb.get_section_by_id(section_index)
-            chosen_sections_len += document_section.tokens + separator_len
-            if chosen_sections_len > MAX_SECTION_LEN:
+    async def abatch_query(self, queries: list[str], max_concurrency: int) -> list[ChatEntry]:
+        """ Answer many queries, at most max_concurrency at once. Repeated queries are answered once.
+            A query that fails gets BATCH_ERROR_ANSWER, the others are still answered.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def answer(query: str) -> ChatEntry:
+            async with semaphore:
+                try:
+                    return await self.aquery(query)
+                except Exception as e:
+                    print(f"ERROR ANSWERING {query}: {e}")
+                    return ChatEntry(content=BATCH_ERROR_ANSWER, author=Author.AGENT, context=None, isStop=True)
+
+        unique = list(dict.fromkeys(queries))
+        answers = dict(zip(unique, await asyncio.gather(*(answer(query) for query in unique))))
+        return [answers[query] for query in queries]
+
+    async def _astream_completion(self, prompt: str, max_tokens=MAX_COMPLETION_TOKENS):
+        """ Yield the completion text as it is generated """
+        start = time.perf_counter()
+        # Streams do not report their prompt size, count it on a worker thread while the completion starts
+        asyncio.get_running_loop().run_in_executor(None, self._count_prompt_tokens, prompt)
+        response = await openai.Completion.acreate(
+            prompt=prompt,
+            stream=True,
+            **self._completion_params(max_tokens)
+        )
+        first = True
+        try:
+            async for chunk in response:
+                if first:
+                    metrics.record("completion_first_token", start, time.perf_counter())
+                    first = False
+                yield chunk["choices"][0]["text"]
+        finally:
+            # Includes the time the caller spends between chunks
+            metrics.record("completion_stream", start, time.perf_counter())
+            # Closing the response early stops the generation
+            await response.aclose()
+
+    async def _astream_answer(self, prompt: str, stop_if_unknown: bool):
+        """ Yield the answer text as it is generated, without leading whitespace.
+            With stop_if_unknown, text is held back while it could still be the start of UNKNOWN_ANSWER. If it is,
+            the completion is abandoned and UNKNOWN is yielded instead so the fallback can start right away.
+        """
+        pending = ""
+        deciding = stop_if_unknown
+        completion = self._astream_completion(prompt)
+        try:
+            async for text in completion:
+                if pending == "":
+                    text = text.lstrip()
+                pending += text
+                if not deciding:
+                    if text != "":
+                        yield text
+                    continue
+                if _is_unknown(pending):
+                    yield UNKNOWN
+                    return
+                if not UNKNOWN_ANSWER.lower().startswith(pending.lower()):
+                    deciding = False
+                    yield pending
+            if deciding and pending != "":
+                yield pending
+        finally:
+            await completion.aclose()
+
+    @timed("generate_searches")
+    async def agenerate_searches_for_wikipedia(self, query: str) -> list[str]:
+        wiki_queries = (await self._ado_completion(wikipedia_query_generation.format(question=query))).split("\n")
+        return [q.strip() for q in wiki_queries if (q is not None and q.strip() != '')] + [query]
+
+    async def aupdate_index_for_query(self, query: str):
+        async for _ in self.aupdate_index_for_query_streaming(query):
+            pass
+
+    async def aupdate_index_for_query_streaming(self, query: str, deadline_seconds: Optional[float] = None):
+        """ Read and index the wikipedia pages relevant to a query, yielding each title as its page is read.
+
+            All searches run at once and each result is handed to a process pool as soon as it comes back.
+            Pages that finish while an embedding request is in flight are batched into the next one.
+            After deadline_seconds it stops and leaves the answer to whatever has been indexed by then.
+        """
+        metrics.fallbacks.inc()
+        titles = self._aread_pages_for_query(query, deadline_seconds)
+        with span("fallback"):
+            try:
+                async for title in titles:
+                    yield title
+            finally:
+                await titles.aclose()
+
+    async def _aread_pages_for_query(self, query: str, deadline_seconds: Optional[float]):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (settings.fallback_deadline_seconds if deadline_seconds is None else deadline_seconds)
+        wiki_queries = await self.agenerate_searches_for_wikipedia(query)
+        print(f"Queries {wiki_queries}")
+        if self._extract_pool is None:
+            self._extract_pool = ProcessPoolExecutor(settings.fallback_workers, mp_context=multiprocessing.get_context("spawn"))
+
+        tasks: dict[asyncio.Future, str] = {
+            asyncio.ensure_future(asyncio.to_thread(self._wikidb.search, wiki_query)): "search" for wiki_query in wiki_queries}
+        seen: set[str] = set()
+        # Pages read but not yet sent for embedding, and the embedding request in flight
+        read: list[tuple[str, list[tuple]]] = []
+        embedding: Optional[asyncio.Future] = None
+        try:
+            while len(tasks) > 0 or len(read) > 0:
+                if embedding is None and len(read) > 0:
+                    embedding = asyncio.ensure_future(self._wikidb.aadd_page_entries(read))
+                    tasks[embedding] = "embed"
+                    read = []
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    print(f"Stopped reading for {query} at the deadline, answering with what was indexed")
+                    break
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    kind = tasks.pop(task)
+                    if task.exception() is not None:
+                        print(f"ERROR fallback {kind} failed: {task.exception()}")
+                    if kind == "embed":
+                        embedding = None
+                    elif kind == "search" and task.exception() is None:
+                        corpus_titles, chunks = self._new_titles_by_source(task.result(), seen)
+                        if len(corpus_titles) > 0:
+                            # Already split, reading them is a lookup and a small decompression each
+                            tasks[asyncio.ensure_future(asyncio.to_thread(self._wikidb.corpus.get_pages, corpus_titles))] = "extract"
+                        for location, titles in chunks.items():
+                            tasks[asyncio.ensure_future(self._aextract_chunk(*location, titles))] = "extract"
+                    elif kind == "extract" and task.exception() is None:
+                        for title, entries in task.result():
+                            if len(entries) > 0:
+                                read.append((title, entries))
+                                yield title
+        finally:
+            # Pages already sent to the database writer are still indexed, and so are the ones read while waiting
+            # for it since the client was told they are being read. Searches and extractions still running are dropped.
+            if len(read) > 0:
+                self._wikidb.submit_page_entries(read)
+            for task, kind in tasks.items():
+                if kind != "embed":
+                    task.cancel()
+
+    async def _aextract_chunk(self, start_byte: int, data_length: int, titles: list[str]) -> list[tuple[str, list[tuple]]]:
+        """ Decompress a chunk and split its pages into section entries in the extraction pool """
+        with span("extract_pages"):
+            return await asyncio.get_running_loop().run_in_executor(
+                self._extract_pool, extract_chunk_entries, start_byte, data_length, titles)
+
+    def _new_titles_by_source(self, titles: list[str], seen: set[str]) -> tuple[list[str], dict[tuple[int, int], list[str]]]:
+        """ Split titles that are not yet indexed, queued or being read into those in the section corpus
+            and the rest grouped by the dump chunk they live in
+        """
+        corpus = self._wikidb.corpus
+        corpus_titles: list[str] = []
+        chunks: dict[tuple[int, int], list[str]] = {}
+        for title in titles:
+            if title in seen or self._wikidb.is_page_queued(title) or self._wikidb.has_page(title):
+                continue
+            seen.add(title)
+            if corpus is not None and title in corpus:
+                corpus_titles.append(title)
+                continue
+            location = self._wikidb.dump.locate(title)
+            if location is not None:
+                chunks.setdefault(location, []).append(title)
+        return corpus_titles, chunks
+
+    @timed("summarize_chat")
+    async def asummarize_chat(self, chat: list[ChatEntry], memory: Optional[ChatMemory] = None) -> str:
+        query = chat[len(chat)-1].content
+        chunks, summarize_history_prompt = self._plan_summary(chat, query, memory)
+
+        async def fold():
+            # Each chunk is folded into the summary the previous one produced
+            for chunk in chunks:
+                memory.summary = (await self._ado_completion(self._memo_prompt(memory, chunk), max_tokens=MAX_SUMMARY_TOKENS)).strip()
+                memory.summarized_turns += len(chunk)
+
+        async def rewrite() -> str:
+            if summarize_history_prompt is None:
+                return query
+            new_query = (await self._ado_completion(summarize_history_prompt)).strip("\n").strip()
+            print(f"New query is {new_query}")
+            return new_query
+
+        if len(chunks) == 0:
+            return await rewrite()
+        _, query = await asyncio.gather(fold(), rewrite())
+        return query
+
+    @timed("answer_chat_query")
+    async def aanswer_chat_query(self, query: str, embedding: Optional[list[float]] = None) -> tuple[str, str]:
+        context = await self.aget_context_for_question(query, embedding=embedding)
+        chat_prompt = chat_with_context_template.format(context=context, question=query)
+        answer = (await self._ado_completion(chat_prompt)).strip("\n").strip()
+        return answer, context
+
+    async def achat(self, chat: list[ChatEntry], memory: Optional[ChatMemory] = None) -> ChatEntry:
+        self._use_http_session()
+        metrics.questions.labels("chat").inc()
+        query = await self.asummarize_chat(chat, memory)
+        embedding, cached = await self._acached_answer(self.chat_answers, query)
+        if cached is not None:
+            return ChatEntry(content=cached.answer, author=Author.AGENT, context=cached.context)
+        answer, context = await self.aanswer_chat_query(query, embedding)
+        if _is_unknown(answer):
+            await self.aupdate_index_for_query(query)
+            context = await self.aget_context_for_question(query, embedding=embedding)
+            prompt = chat_with_context_template.format(context=context, question=query)
+            answer = (await self._ado_completion(prompt)).strip("\n").strip()
+        await self._aremember_answer(self.chat_answers, query, embedding, answer, context)
+        return ChatEntry(content=answer, author=Author.AGENT, context=context)
+
+    async def achat_streaming(self, chat: list[ChatEntry], memory: Optional[ChatMemory] = None):
+        """ Stream the answer to the latest question. An entry is started with an empty ChatEntry, grown with
+            ChatDelta text and replaced by a final transient ChatEntry that carries the full answer and its context.
+        """
+        self._use_http_session()
+        metrics.questions.labels("chat").inc()
+        query = await self.asummarize_chat(chat, memory)
+        embedding, cached = await self._acached_answer(self.chat_answers, query)
+        if cached is not None:
+            # Nothing to wait for, send the final answer straight away
+            yield ChatEntry(content=cached.answer, author=Author.AGENT, context=cached.context, isStop=True, isTransient=False)
+            return
+        context = await self.aget_context_for_question(query, embedding=embedding)
+        answer = ""
+        unknown = False
+        yield ChatEntry(content="", author=Author.AGENT, context='', isTransient=False, isStop=False)
+        async for delta in self._astream_answer(chat_with_context_template.format(context=context, question=query), stop_if_unknown=True):
+            if delta is UNKNOWN:
+                unknown = True
                 break
+            answer += delta
+            yield ChatDelta(delta=delta)
+
+        if unknown:
+            yield ChatEntry(content="I don't know, let me see if I can find out", author=Author.AGENT, context=context, isTransient=True, isStop=False)
+            async for title in self.aupdate_index_for_query_streaming(query):
+                yield ChatEntry(content=f"I'm reading... {title}", author=Author.AGENT, context='', isTransient=True, isStop=False)
+            yield ChatEntry(content=f"I'm synthesizing what I just read...", author=Author.AGENT, context='', isTransient=True, isStop=False)
+            context = await self.aget_context_for_question(query, embedding=embedding)
+            # Clear the progress message, the new answer streams into its place
+            yield ChatEntry(content="", author=Author.AGENT, context='', isTransient=True, isStop=False)
+            async for delta in self._astream_answer(chat_with_context_template.format(context=context, question=query), stop_if_unknown=False):
+                answer += delta
+                yield ChatDelta(delta=delta)
+
+        answer = answer.strip()
+        await self._aremember_answer(self.chat_answers, query, embedding, answer, context)
+        yield ChatEntry(content=answer, author=Author.AGENT, context=context, isStop=True, isTransient=True)
 
-            chosen_sections.append(
-                SEPARATOR + document_section.content.replace("\n", " "))
-            chosen_sections_indexes.append(str(section_index))
+    async def aget_context_for_question(self, question: str, candidate_depth: Optional[int] = None,
+                                        embedding: Optional[list[float]] = None) -> str:
+        return (await self.aget_contexts_for_questions([question], candidate_depth, None if embedding is None else [embedding]))[0]
 
-        context = "".join(chosen_sections)
-        return context
+    async def aget_contexts_for_questions(self, questions: list[str], candidate_depth: Optional[int] = None,
+                                          embeddings: Optional[list[Optional[list[float]]]] = None) -> list[str]:
+        self._use_http_session()
+        if embeddings is None:
+            embeddings = [None] * len(questions)
+        with span("retrieve"):
+            neighbours = await asyncio.gather(*(self.query_batcher.closest_indices(question, candidate_depth=candidate_depth, embedding=embedding)
+                                                for question, embedding in zip(questions, embeddings)))
+        return await asyncio.to_thread(self._build_contexts, neighbours)
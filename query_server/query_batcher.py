@@ -0,0 +1,109 @@
+import asyncio
+from typing import Optional
+from index import Index
+from metrics import span
+
+# A request for a question's embedding only, as opposed to a (k, candidate_depth) neighbour search
+EMBEDDING_ONLY = None
+
+
+class QueryBatcher():
+    """ Coalesces the embedding and neighbour requests of concurrent questions into micro batches.
+
+        Requests arriving within window_seconds of the first one, or until max_batch are waiting, are served
+        together: every distinct question is embedded in one Embedder call and each group of searches with the
+        same parameters is one faiss search over a matrix of query vectors. Identical requests already in flight
+        share a single future.
+    """
+
+    def __init__(self, index: Index, window_seconds: float, max_batch: int):
+        self.index = index
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        # (question, search) -> future, search is EMBEDDING_ONLY or (k, candidate_depth)
+        self._in_flight: dict[tuple, asyncio.Future] = {}
+        self._pending: list[tuple] = []
+        self._flush_timer: Optional[asyncio.TimerHandle] = None
+        # Embeddings callers already had for questions waiting to be flushed
+        self._known_embeddings: dict[str, list[float]] = {}
+        self.batches = 0
+        self.requests = 0
+        self.coalesced = 0
+
+    async def embedding(self, question: str) -> Optional[list[float]]:
+        """ The embedding of a question, or None if it could not be embedded """
+        return await self._submit((question, EMBEDDING_ONLY))
+
+    async def closest_indices(self, question: str, k=4, candidate_depth: Optional[int] = None,
+                              embedding: Optional[list[float]] = None) -> list[int]:
+        """ The ids of the k sections closest to a question, see Index.get_closest_indices. A question whose
+            embedding is passed is not embedded again.
+        """
+        return await self._submit((question, (k, candidate_depth)), embedding)
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "requests": self.requests, "coalesced": self.coalesced}
+
+    async def _submit(self, key: tuple, embedding: Optional[list[float]] = None):
+        self.requests += 1
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._in_flight[key] = future
+            self._pending.append(key)
+            if embedding is not None:
+                self._known_embeddings[key[0]] = embedding
+            if len(self._pending) >= self.max_batch:
+                self._start_flush()
+            elif self._flush_timer is None:
+                self._flush_timer = loop.call_later(self.window_seconds, self._start_flush)
+        # Shielded so a cancelled caller does not cancel the result other callers are waiting on
+        return await asyncio.shield(future)
+
+    def _start_flush(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        batch, self._pending = self._pending, []
+        if len(batch) > 0:
+            asyncio.ensure_future(self._flush(batch))
+
+    async def _flush(self, batch: list[tuple]):
+        self.batches += 1
+        try:
+            questions = list(dict.fromkeys(question for question, _ in batch))
+            embedding_of = {question: self._known_embeddings.pop(question) for question in questions
+                            if question in self._known_embeddings}
+            unknown = [question for question in questions if question not in embedding_of]
+            if len(unknown) > 0:
+                # A batch is traced by the request that opened it, the others only wait for it
+                with span("embed_questions"):
+                    embeddings = await self.index.embedder.aget_embedding(unknown)
+                if embeddings is None:
+                    embeddings = [None] * len(unknown)
+                embedding_of.update(zip(unknown, embeddings))
+
+            searches: dict[tuple, list[str]] = {}
+            for question, search in batch:
+                if search is EMBEDDING_ONLY:
+                    self._resolve((question, search), embedding_of[question])
+                else:
+                    searches.setdefault(search, []).append(question)
+            for (k, candidate_depth), search_questions in searches.items():
+                results = await asyncio.to_thread(self.index.search_embeddings, search_questions,
+                                                  [embedding_of[question] for question in search_questions], k, candidate_depth)
+                for question, ids in zip(search_questions, results):
+                    self._resolve((question, (k, candidate_depth)), ids)
+        except Exception as e:
+            for key in batch:
+                future = self._in_flight.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+
+    def _resolve(self, key: tuple, result):
+        future = self._in_flight.pop(key)
+        if not future.done():
+            future.set_result(result)
@@ -0,0 +1,129 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import zstandard
+import wikitextparser as wtp
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Optional
+from metrics import timed
+from sections import chunker, format_document_for_indexing
+from title_index import TitleIndex, read_dump_chunks, write_title_index
+from title_search import REDIRECT_PATTERN, SKIPPED_NAMESPACES
+from wikidump import iter_pages_from_chunk
+
+MAGIC = b"WIKISEC1"
+# magic, max tokens and overlap tokens of the chunker the corpus was split with
+HEADER = struct.Struct("<8sII")
+# The title -> (offset, length) table of the frames lives next to the data file
+INDEX_SUFFIX = ".index"
+COMPRESSION_LEVEL = 3
+
+
+def _index_path(path: str) -> str:
+    return path + INDEX_SUFFIX
+
+
+class SectionCorpus():
+    """ Read only access to every article of the dump already split into section entries, built once from the dump
+        by build_section_corpus so adding a page skips decompressing its chunk, parsing and splitting it.
+
+        Each page is one zstd frame holding its sections as JSON, found through a TitleIndex of
+        title -> (offset, length) into the data file. Both are memory mapped, so a lookup is a binary search and
+        the decompression of a few kilobytes. The data file starts with the chunker settings it was split with.
+    """
+
+    def __init__(self, path: str):
+        self.index = TitleIndex(_index_path(path))
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, max_tokens, overlap_tokens = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a section corpus")
+        if (max_tokens, overlap_tokens) != (chunker.max_tokens, chunker.overlap_tokens):
+            print(f"{path} was split into sections of {max_tokens} tokens with {overlap_tokens} overlapping, "
+                  f"rebuild it to use the current {chunker.max_tokens} and {chunker.overlap_tokens}")
+        # Decompressors are not safe to share between threads
+        self._local = threading.local()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, title: str) -> bool:
+        return title in self.index
+
+    def get_entries(self, page_title: str) -> Optional[list[tuple]]:
+        """ Get a page's (title, section, section_index, permalink, content, tokens) entries or None if it is not in the corpus """
+        location = self.index.get(page_title)
+        if location is None:
+            return None
+        offset, length = location
+        decompressor = getattr(self._local, "decompressor", None)
+        if decompressor is None:
+            decompressor = self._local.decompressor = zstandard.ZstdDecompressor()
+        sections = json.loads(decompressor.decompress(self._mmap[offset:offset + length]))
+        return [(page_title, section, section_index, '', content, tokens) for section, section_index, content, tokens in sections]
+
+    @timed("read_corpus")
+    def get_pages(self, page_titles: list[str]) -> list[tuple[str, list[tuple]]]:
+        """ Get the entries of several pages, like extract_chunk_entries titles that are not in the corpus come back with none """
+        return [(page_title, self.get_entries(page_title) or []) for page_title in page_titles]
+
+
+def _split_chunk(wiki_filename: str, start_byte: int, data_length: int) -> list[tuple[str, bytes]]:
+    """ Runs in a worker process, returns the compressed frame of every article in the chunk """
+    with open(wiki_filename, 'rb') as wiki_file:
+        wiki_file.seek(start_byte)
+        data = wiki_file.read(data_length if data_length >= 0 else -1)
+    compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVEL)
+    frames = []
+    for title, text in iter_pages_from_chunk(data):
+        namespace, colon, _ = title.partition(":")
+        if (colon and namespace in SKIPPED_NAMESPACES) or REDIRECT_PATTERN.match(text.lstrip()) is not None:
+            continue
+        entries = format_document_for_indexing(title, wtp.parse(text))
+        if len(entries) == 0:
+            continue
+        sections = [(section, section_index, content, tokens) for _, section, section_index, _, content, tokens in entries]
+        frames.append((title, compressor.compress(json.dumps(sections, ensure_ascii=False).encode("utf-8"))))
+    return frames
+
+
+def _write_frames(chunks: list[tuple[int, int]], wiki_filename: str, data_file, workers: int) -> Iterable[tuple[str, int, int]]:
+    """ Split chunks in worker processes and append their frames to data_file, yielding (title, offset, length) """
+    offset = data_file.tell()
+    with ProcessPoolExecutor(workers) as pool:
+        results = pool.map(_split_chunk, [wiki_filename] * len(chunks), *zip(*chunks), chunksize=16)
+        for i, frames in enumerate(results):
+            for title, frame in frames:
+                data_file.write(frame)
+                yield title, offset, len(frame)
+                offset += len(frame)
+            if i % 1000 == 0:
+                print(f"Split {i}/{len(chunks)} chunks")
+
+
+def build_section_corpus(index_filename: str, wiki_filename: str, output_path: str, workers: int = os.cpu_count()):
+    """ One time build of a section corpus from the multistream dump, streaming every chunk once.
+        The data file and its index are written to temporary paths and moved into place, data file first.
+    """
+    tmp_path = output_path + ".tmp"
+    tmp_index_path = _index_path(output_path) + ".tmp"
+    chunks = list(read_dump_chunks(index_filename))
+    with open(tmp_path, 'wb') as data_file:
+        data_file.write(HEADER.pack(MAGIC, chunker.max_tokens, chunker.overlap_tokens))
+        write_title_index(_write_frames(chunks, wiki_filename, data_file, workers), tmp_index_path)
+    os.replace(tmp_path, output_path)
+    os.replace(tmp_index_path, _index_path(output_path))
+
+
+if __name__ == "__main__":
+    import argparse
+    from config import settings
+    parser = argparse.ArgumentParser(description="Split every article of the local wikipedia dump into sections once")
+    parser.add_argument("--output", default=settings.section_corpus_path, help="path to write the section corpus to")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes used to decompress and split chunks")
+    args = parser.parse_args()
+    build_section_corpus(settings.wikipedia_local_index_path, settings.wikipedia_local_dump_path, args.output, args.workers)
+    print(f"Split {len(SectionCorpus(args.output))} pages into {args.output}")
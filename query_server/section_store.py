@@ -0,0 +1,272 @@
+import os
+import sqlite3
+import threading
+import urllib.parse
+import pandas as pd
+from contextlib import contextmanager
+from typing import NamedTuple, Optional
+from index import reciprocal_rank_fusion
+from title_search import tokenize
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+# Stay well below SQLite's limit on bound parameters
+MAX_QUERY_PARAMS = 500
+# Reads map the database file instead of copying pages into each connection's cache, so processes reading the same
+# store share its pages. SQLite caps this at its compile time maximum.
+MMAP_BYTES = 1 << 40
+# Bumped whenever the schema gains something that existing stores have to be upgraded with
+SCHEMA_VERSION = 1
+# BM25 weights of the title and content columns of the full text index
+TITLE_WEIGHT = 2.0
+CONTENT_WEIGHT = 1.0
+
+
+class Section(NamedTuple):
+    id: int
+    title: str
+    section: Optional[str]
+    section_index: int
+    permalink: str
+    content: str
+    tokens: int
+
+
+def is_sqlite_file(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+def _connect(path: str, read_only: bool, immutable: bool = False, **kwargs) -> sqlite3.Connection:
+    if not read_only:
+        return sqlite3.connect(path, **kwargs)
+    # An immutable file is never locked or checked for changes, which also means SQLite ignores any WAL next to it
+    params = "mode=ro&immutable=1" if immutable else "mode=ro"
+    return sqlite3.connect(f"file:{urllib.parse.quote(os.path.abspath(path))}?{params}", uri=True, **kwargs)
+
+
+def freeze_store(path: str):
+    """ Ready the store at path to be opened immutable: bring its schema up to date and fold its WAL back into the
+        file. Done once when a snapshot is published, so serving never has to.
+    """
+    store = SectionStore(path)
+    store._conn.execute("PRAGMA journal_mode=DELETE")
+    store._conn.close()
+
+
+class SectionStore():
+    """ An append optimized store of document sections in SQLite, keyed by the same int64 ids as their vectors.
+
+        Rows are written and committed as they are added so persisting is incremental, lookups by id use the
+        primary key and lookups by title use an index on title. An FTS5 index over title and content is kept in
+        step with the rows by triggers and serves the sparse half of hybrid retrieval.
+
+        A read_only store never writes to its file, not even to create its tables or upgrade them, see
+        OverlaySectionStore. An immutable store is a read_only one whose file nothing writes to any more, such as a
+        published snapshot, so SQLite can skip locking it, see freeze_store.
+    """
+
+    def __init__(self, path: str = ":memory:", read_only: bool = False, immutable: bool = False):
+        self.path = path
+        self.read_only = read_only or immutable
+        self.immutable = immutable
+        self._conn = _connect(path, self.read_only, immutable, check_same_thread=False)
+        if self.read_only:
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                raise ValueError(f"{path} has an older schema, upgrade it by opening it once with a writable "
+                                 f"SectionStore, e.g. by rebuilding or republishing it with build_indices.py")
+        else:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sections (id INTEGER PRIMARY KEY, title TEXT NOT NULL, section TEXT, "
+                "section_index INTEGER NOT NULL, permalink TEXT NOT NULL, content TEXT NOT NULL, tokens INTEGER NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS sections_title ON sections (title)")
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                self._create_text_index()
+            self._conn.commit()
+        self._lock = threading.Lock()
+        self._readers = threading.local()
+
+    @contextmanager
+    def _reader(self):
+        """ A connection to read with. A file store gives every thread its own, in WAL mode each reads the last
+            committed snapshot without waiting for writes. An in memory store only has the one connection.
+        """
+        if self.path == ":memory:":
+            with self._lock:
+                yield self._conn
+            return
+        conn = getattr(self._readers, "conn", None)
+        if conn is None:
+            conn = _connect(self.path, self.read_only, self.immutable)
+            conn.execute("PRAGMA query_only=ON")
+            conn.execute(f"PRAGMA mmap_size={MMAP_BYTES}")
+            self._readers.conn = conn
+        yield conn
+
+    def _create_text_index(self):
+        self._conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS sections_fts USING fts5(title, content, content='sections', "
+            "content_rowid='id', tokenize='porter unicode61')")
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS sections_fts_insert AFTER INSERT ON sections BEGIN "
+            "INSERT INTO sections_fts (rowid, title, content) VALUES (new.id, new.title, new.content); END")
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS sections_fts_delete AFTER DELETE ON sections BEGIN "
+            "INSERT INTO sections_fts (sections_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content); END")
+        # Stores written before the text index existed are indexed once here
+        self._conn.execute("INSERT INTO sections_fts (sections_fts) VALUES ('rebuild')")
+        self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    @classmethod
+    def from_dataframe(cls, path: str, df: pd.DataFrame) -> "SectionStore":
+        """ Import a pickled DataFrame of sections, indexed by section id, into a new store at path """
+        store = cls(path)
+        store.append(df.index.tolist(), list(df.itertuples(index=False, name=None)))
+        return store
+
+    def __len__(self) -> int:
+        with self._reader() as conn:
+            return conn.execute("SELECT COUNT(*) FROM sections").fetchone()[0]
+
+    def next_id(self) -> int:
+        with self._lock:
+            max_id = self._conn.execute("SELECT MAX(id) FROM sections").fetchone()[0]
+        return max_id + 1 if max_id is not None else 0
+
+    def has_title(self, title: str) -> bool:
+        with self._reader() as conn:
+            return conn.execute("SELECT 1 FROM sections WHERE title = ? LIMIT 1", (title,)).fetchone() is not None
+
+    def titles(self) -> set[str]:
+        with self._reader() as conn:
+            return set(row[0] for row in conn.execute("SELECT DISTINCT title FROM sections"))
+
+    def ids(self) -> list[int]:
+        with self._reader() as conn:
+            return [row[0] for row in conn.execute("SELECT id FROM sections")]
+
+    def ids_for_title(self, title: str) -> list[int]:
+        with self._reader() as conn:
+            return [row[0] for row in conn.execute("SELECT id FROM sections WHERE title = ?", (title,))]
+
+    def get(self, id: int) -> Optional[Section]:
+        with self._reader() as conn:
+            row = conn.execute("SELECT * FROM sections WHERE id = ?", (id,)).fetchone()
+        return Section(*row) if row is not None else None
+
+    def get_many(self, ids: list[int]) -> list[Section]:
+        """ Fetch sections by id in the order of ids, ids that are not in the store are skipped """
+        rows = {}
+        with self._reader() as conn:
+            for start in range(0, len(ids), MAX_QUERY_PARAMS):
+                batch = [int(id) for id in ids[start:start + MAX_QUERY_PARAMS]]
+                for row in conn.execute(f"SELECT * FROM sections WHERE id IN ({','.join('?' * len(batch))})", batch):
+                    rows[row[0]] = Section(*row)
+        return [rows[int(id)] for id in ids if int(id) in rows]
+
+    def search_text(self, query: str, k: int) -> list[int]:
+        """ Get the ids of up to k sections ranked by BM25 against the words of query, best first """
+        terms = tokenize(query)
+        if len(terms) == 0:
+            return []
+        # Quote every word so punctuation in questions is never read as FTS5 query syntax
+        match = " OR ".join('"' + term + '"' for term in terms)
+        with self._reader() as conn:
+            return [row[0] for row in conn.execute(
+                f"SELECT rowid FROM sections_fts WHERE sections_fts MATCH ? "
+                f"ORDER BY bm25(sections_fts, {TITLE_WEIGHT}, {CONTENT_WEIGHT}) LIMIT ?", (match, k))]
+
+    def append(self, ids: list[int], entries: list[tuple]):
+        """ Append (title, section, section_index, permalink, content, tokens) entries under the given ids """
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO sections (id, title, section, section_index, permalink, content, tokens) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(int(id), title, section, int(section_index), permalink, content, int(tokens))
+                 for id, (title, section, section_index, permalink, content, tokens) in zip(ids, entries)])
+            self._conn.commit()
+
+    def remove_ids(self, ids: list[int]):
+        with self._lock:
+            for start in range(0, len(ids), MAX_QUERY_PARAMS):
+                batch = [int(id) for id in ids[start:start + MAX_QUERY_PARAMS]]
+                self._conn.execute(f"DELETE FROM sections WHERE id IN ({','.join('?' * len(batch))})", batch)
+            self._conn.commit()
+
+    def save_to_path(self, path: str):
+        """ Copy the store to another file, a no-op when path is the store itself since rows are committed as they are added """
+        if os.path.abspath(path) == os.path.abspath(self.path):
+            return
+        destination = sqlite3.connect(path)
+        with self._lock:
+            self._conn.backup(destination)
+        destination.close()
+
+
+class OverlaySectionStore():
+    """ A read only SectionStore with the sections added since it was opened kept apart in a store of their own,
+        in memory unless one is given.
+
+        Servers open their store this way so serving never writes to a file that other processes read, and what
+        a worker adds is its own. Ids of added sections have to be past the base's, see WikipediaDatabase. Reads
+        and text searches see both stores, the text matches of each are merged by rank. Sections of the base can
+        not be removed.
+    """
+
+    def __init__(self, base: SectionStore, overlay: Optional[SectionStore] = None):
+        self.base = base
+        self.overlay = overlay if overlay is not None else SectionStore()
+        self.path = base.path
+
+    def __len__(self) -> int:
+        return len(self.base) + len(self.overlay)
+
+    def next_id(self) -> int:
+        return max(self.base.next_id(), self.overlay.next_id())
+
+    def has_title(self, title: str) -> bool:
+        return self.overlay.has_title(title) or self.base.has_title(title)
+
+    def titles(self) -> set[str]:
+        return self.base.titles() | self.overlay.titles()
+
+    def ids(self) -> list[int]:
+        return self.base.ids() + self.overlay.ids()
+
+    def ids_for_title(self, title: str) -> list[int]:
+        return self.base.ids_for_title(title) + self.overlay.ids_for_title(title)
+
+    def in_base(self, ids: list[int]) -> bool:
+        """ Whether any of the ids is a section of the read only base """
+        return len(self.base.get_many(ids)) > 0
+
+    def get(self, id: int) -> Optional[Section]:
+        section = self.overlay.get(id)
+        return section if section is not None else self.base.get(id)
+
+    def get_many(self, ids: list[int]) -> list[Section]:
+        sections = {section.id: section for section in self.base.get_many(ids) + self.overlay.get_many(ids)}
+        return [sections[int(id)] for id in ids if int(id) in sections]
+
+    def search_text(self, query: str, k: int) -> list[int]:
+        # BM25 scores of the two stores rest on different document counts and can not be compared, so their
+        # rankings are fused instead
+        return reciprocal_rank_fusion([self.base.search_text(query, k), self.overlay.search_text(query, k)])[:k]
+
+    def append(self, ids: list[int], entries: list[tuple]):
+        self.overlay.append(ids, entries)
+
+    def remove_ids(self, ids: list[int]):
+        if self.in_base(ids):
+            raise ValueError(f"Sections of the read only store {self.path} can not be removed")
+        self.overlay.remove_ids(ids)
+
+    def save_to_path(self, path: str):
+        """ Copy the base and the added sections into a new store at path """
+        if os.path.abspath(path) == os.path.abspath(self.path):
+            raise ValueError(f"{self.path} is read only, save to another path")
+        self.base.save_to_path(path)
+        added = self.overlay.get_many(self.overlay.ids())
+        store = SectionStore(path)
+        store.append([section.id for section in added], [tuple(section[1:]) for section in added])
+        store._conn.close()
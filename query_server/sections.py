@@ -0,0 +1,34 @@
+import wikitextparser as wtp
+from chunker import Chunker
+from config import settings
+from token_consts import MAX_SECTION_TOKENS
+
+DISCARD_CATEGORIES = set(['See also', 'References', 'External links', 'Further reading', "Footnotes",
+    "Bibliography", "Sources", "Citations", "Literature", "Footnotes", "Notes and references",
+    "Photo gallery", "Works cited", "Photos", "Gallery", "Notes", "References and sources",
+    "References and notes", "General and cited references"])
+SECTION_COLUMNS = ["title", "section", "section_index", "permalink", "content", "tokens"]
+
+# Shared by every page split in this process
+chunker = Chunker(MAX_SECTION_TOKENS, settings.section_overlap_tokens)
+
+
+def encode_with_split(section: str, max_tokens: int = MAX_SECTION_TOKENS) -> list[tuple[str, int]]:
+    """ Splits a section into (text, token count) pieces of at most max_tokens on sentence boundaries """
+    if max_tokens == chunker.max_tokens:
+        return chunker.chunk(section)
+    return Chunker(max_tokens, min(chunker.overlap_tokens, max_tokens - 1)).chunk(section)
+
+
+# TODO refactor this for treating documents as a class
+def format_document_for_indexing(page_title: str, page_content: wtp.WikiText):
+    """ Split a page into (title, section, section_index, permalink, content, tokens) entries ready to be embedded """
+    sections = [section for section in page_content.sections
+                if section.title == None or (section.title and section.title.strip() not in DISCARD_CATEGORIES)]
+    # TODO: parse plain text, remove headings, format tables for ingestion, remove media references
+    res = []
+    for section, chunks in zip(sections, chunker.chunk_many([section.plain_text() for section in sections])):
+        for section_index, (split_section, tokens) in enumerate(chunks):
+            # TODO: The empty entry is the permalink, leave alone for now. artifact from port, remove later
+            res.append((page_title, section.title, section_index, '', split_section, tokens))
+    return res
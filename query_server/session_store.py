@@ -0,0 +1,171 @@
+import asyncio
+import sqlite3
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, Optional
+from pydantic import BaseModel
+from models import ChatEntry, ChatMemory
+
+
+class SessionData(BaseModel):
+    chat: List[ChatEntry]
+    memory: ChatMemory = ChatMemory()
+
+
+def encode_session(data: SessionData) -> bytes:
+    # Most entries leave the optional fields unset, skipping defaults and compressing keeps long chats small
+    return zlib.compress(data.json(exclude_defaults=True).encode("utf-8"))
+
+
+def decode_session(blob: bytes) -> SessionData:
+    return SessionData.parse_raw(zlib.decompress(blob))
+
+
+class SessionStore(ABC):
+    """ Chat sessions keyed by the session cookie, dropped after ttl_seconds without use or once more than
+        max_entries are held, least recently used first.
+
+        Sessions are values: changes to a SessionData only persist once it is put back.
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[SessionData]:
+        ...
+
+    @abstractmethod
+    def put(self, session_id: str, data: SessionData):
+        ...
+
+    @abstractmethod
+    def delete(self, session_id: str):
+        ...
+
+    @abstractmethod
+    def sweep(self) -> int:
+        """ Remove expired sessions and those over the size cap, returns how many were removed """
+        ...
+
+    @abstractmethod
+    def __len__(self) -> int:
+        ...
+
+
+class MemorySessionStore(SessionStore):
+    """ Sessions in this process only, for a single worker """
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        super().__init__(ttl_seconds, max_entries)
+        # session id -> (last used, encoded session), oldest first
+        self._sessions: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[SessionData]:
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None or time.time() - entry[0] > self.ttl_seconds:
+                return None
+            self._sessions[session_id] = (time.time(), entry[1])
+            self._sessions.move_to_end(session_id)
+        return decode_session(entry[1])
+
+    def put(self, session_id: str, data: SessionData):
+        blob = encode_session(data)
+        with self._lock:
+            self._sessions[session_id] = (time.time(), blob)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def sweep(self) -> int:
+        expired_before = time.time() - self.ttl_seconds
+        removed = 0
+        with self._lock:
+            while len(self._sessions) > 0:
+                session_id, (last_used, _) = next(iter(self._sessions.items()))
+                if last_used >= expired_before:
+                    break
+                del self._sessions[session_id]
+                removed += 1
+        return removed
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+class SqliteSessionStore(SessionStore):
+    """ Sessions in a SQLite file in WAL mode, shared by every worker process on the host and kept across restarts """
+
+    def __init__(self, path: str, ttl_seconds: float, max_entries: int):
+        super().__init__(ttl_seconds, max_entries)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, last_used REAL NOT NULL, data BLOB NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_last_used ON sessions (last_used)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[SessionData]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM sessions WHERE id = ? AND last_used >= ?",
+                                     (session_id, now - self.ttl_seconds)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE sessions SET last_used = ? WHERE id = ?", (now, session_id))
+            self._conn.commit()
+        return decode_session(row[0])
+
+    def put(self, session_id: str, data: SessionData):
+        blob = encode_session(data)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO sessions (id, last_used, data) VALUES (?, ?, ?)",
+                               (session_id, time.time(), blob))
+            self._conn.commit()
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self._conn.commit()
+
+    def sweep(self) -> int:
+        with self._lock:
+            removed = self._conn.execute("DELETE FROM sessions WHERE last_used < ?", (time.time() - self.ttl_seconds,)).rowcount
+            # The cap is enforced here rather than on every put so puts stay a single row write
+            removed += self._conn.execute(
+                "DELETE FROM sessions WHERE id IN (SELECT id FROM sessions ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)).rowcount
+            self._conn.commit()
+        return removed
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+def open_session_store(backend: str, path: str, ttl_seconds: float, max_entries: int) -> SessionStore:
+    if backend == "memory":
+        return MemorySessionStore(ttl_seconds, max_entries)
+    if backend == "sqlite":
+        return SqliteSessionStore(path, ttl_seconds, max_entries)
+    raise ValueError(f"Unknown session backend {backend}, expected memory or sqlite")
+
+
+async def sweep_periodically(store: SessionStore, interval_seconds: float):
+    """ Run store.sweep every interval_seconds off the event loop until cancelled """
+    while True:
+        await asyncio.sleep(interval_seconds)
+        removed = await asyncio.to_thread(store.sweep)
+        if removed > 0:
+            print(f"Swept {removed} sessions")
@@ -0,0 +1,13 @@
+import os
+import sys
+
+# Modules import each other by name, as they do when run from the query_server directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Settings are read when config is imported, nothing under test reaches OpenAI or a local dump
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("WIKI_DB_PATH", "")
+os.environ.setdefault("INDEX_PATH", "")
+os.environ.setdefault("WIKIPEDIA_LOCAL_INDEX_PATH", "")
+os.environ.setdefault("WIKIPEDIA_LOCAL_DUMP_PATH", "")
+os.environ.setdefault("EMBEDDING_CACHE_PATH", "")
@@ -0,0 +1,55 @@
+import numpy as np
+from answer_cache import AnswerCache
+
+DIMENSION = 4
+
+
+def direction(*components: float) -> list[float]:
+    vector = np.array(components + (0.0,) * (DIMENSION - len(components)), dtype=np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def new_cache(max_entries=10, ttl_seconds=60.0) -> AnswerCache:
+    return AnswerCache(max_entries, ttl_seconds, threshold=0.95, invalidation_threshold=0.8, embedding_length=DIMENSION)
+
+
+def test_similar_questions_hit_and_others_miss():
+    cache = new_cache()
+    cache.put("Who was Ada Lovelace?", direction(1), "A mathematician", "context")
+    assert cache.get(direction(1, 0.1)).answer == "A mathematician"
+    assert cache.get(direction(1, 1)) is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "invalidations": 0, "size": 1}
+
+
+def test_expired_answers_are_dropped():
+    cache = new_cache(ttl_seconds=-1)
+    cache.put("question", direction(1), "answer", "context")
+    assert cache.get(direction(1)) is None
+    assert cache.stats()["size"] == 0
+
+
+def test_least_recently_used_answer_is_evicted():
+    cache = new_cache(max_entries=2)
+    cache.put("first", direction(1), "1", "")
+    cache.put("second", direction(0, 1), "2", "")
+    # Using the first makes the second the least recently used
+    assert cache.get(direction(1)).answer == "1"
+    cache.put("third", direction(0, 0, 1), "3", "")
+    assert cache.get(direction(0, 1)) is None
+    assert cache.get(direction(1)).answer == "1"
+    assert cache.get(direction(0, 0, 1)).answer == "3"
+
+
+def test_new_sections_invalidate_the_answers_they_are_relevant_to():
+    cache = new_cache()
+    cache.put("first", direction(1), "1", "")
+    cache.put("second", direction(0, 1), "2", "")
+    assert cache.invalidate(np.array([direction(1, 0.2)], dtype=np.float32)) == 1
+    assert cache.get(direction(1)) is None
+    assert cache.get(direction(0, 1)).answer == "2"
+
+
+def test_disabled_cache_keeps_nothing():
+    cache = new_cache(max_entries=0)
+    cache.put("question", direction(1), "answer", "context")
+    assert cache.get(direction(1)) is None
@@ -0,0 +1,44 @@
+from cache import LRUCache
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_bounded_by_size():
+    cache = LRUCache(10, sizeof=len)
+    cache.put("a", b"xxxx")
+    cache.put("b", b"xxxx")
+    cache.put("c", b"xxxx")
+    assert "a" not in cache
+    assert cache.size == 8
+    # Replacing a value accounts for the size it had
+    cache.put("b", b"x")
+    assert cache.size == 5
+
+
+def test_never_caches_values_larger_than_the_cache():
+    cache = LRUCache(4, sizeof=len)
+    cache.put("a", b"xx")
+    cache.put("b", b"xxxxx")
+    assert "b" not in cache
+    assert cache.get("a") == b"xx"
+
+
+def test_counts_hits_and_misses():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.get("a")
+    cache.get("b")
+    cache.get("b")
+    assert (cache.hits, cache.misses) == (1, 2)
+    cache.clear()
+    assert len(cache) == 0 and cache.size == 0
@@ -0,0 +1,59 @@
+import pytest
+from chunker import Chunker
+from sections import encode_with_split
+
+
+def sentences(count: int, words: int = 8) -> str:
+    return " ".join(" ".join([f"word{i}"] * words) + "." for i in range(count))
+
+
+def assert_counted(chunker: Chunker, chunks: list[tuple[str, int]]):
+    for text, count in chunks:
+        assert count <= chunker.max_tokens
+        # A chunk's count can be one off at its leading space
+        assert abs(count - len(chunker.tokenizer.encode(text))) <= 1
+
+
+def test_short_text_is_one_chunk():
+    chunker = Chunker(max_tokens=100)
+    text = sentences(2)
+    assert chunker.chunk(text) == [(text, len(chunker.tokenizer.encode(text)))]
+
+
+def test_long_text_is_split_on_sentences():
+    chunker = Chunker(max_tokens=50)
+    text = sentences(30)
+    chunks = chunker.chunk(text)
+    assert len(chunks) > 1
+    assert_counted(chunker, chunks)
+    # Without overlap every sentence is in exactly one chunk, in order
+    assert " ".join(chunk for chunk, _ in chunks) == text
+
+
+def test_overlapping_chunks_share_sentences():
+    chunker = Chunker(max_tokens=50, overlap_tokens=20)
+    chunks = chunker.chunk(sentences(30))
+    assert_counted(chunker, chunks)
+    for (previous, _), (chunk, _) in zip(chunks, chunks[1:]):
+        assert previous.split(". ")[-1].rstrip(".") in chunk
+
+
+def test_sentence_longer_than_a_chunk_is_cut_into_windows():
+    chunker = Chunker(max_tokens=20)
+    chunks = chunker.chunk(" ".join(["word"] * 50))
+    assert [count for _, count in chunks] == [20, 20, 10]
+
+
+def test_overlap_has_to_be_less_than_a_chunk():
+    with pytest.raises(ValueError):
+        Chunker(max_tokens=10, overlap_tokens=10)
+
+
+def test_encode_with_split_counts_tokens_within_the_limit():
+    texts = [sentences(1), sentences(40)]
+    for max_tokens in [30, 2000]:
+        chunker = Chunker(max_tokens)
+        for text in texts:
+            chunks = encode_with_split(text, max_tokens)
+            assert_counted(chunker, chunks)
+            assert chunks == chunker.chunk(text)
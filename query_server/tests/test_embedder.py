@@ -0,0 +1,68 @@
+import openai
+import pytest
+from embedder import Embedder, EmbeddingBatcher, embed_with_backoff
+
+
+class FakeEmbedder():
+    """ Rejects any request holding a text in bad, fails every request with error when it is set """
+
+    def __init__(self, bad=(), error=None):
+        self.bad = set(bad)
+        self.error = error
+        self.requests = []
+
+    def embed_many(self, texts):
+        self.requests.append(list(texts))
+        if self.error is not None:
+            raise self.error
+        if any(text in self.bad for text in texts):
+            raise openai.error.InvalidRequestError("rejected", None)
+        return [[float(len(text))] for text in texts]
+
+
+def test_packs_requests_by_tokens_and_items():
+    batcher = EmbeddingBatcher(FakeEmbedder(), max_tokens=10, max_items=3)
+    assert batcher.pack([4, 4, 4, 1, 1, 1, 1, 20, 1]) == [range(0, 2), range(2, 5), range(5, 7), range(7, 8), range(8, 9)]
+    assert batcher.pack([]) == []
+
+
+def test_results_line_up_with_the_inputs():
+    batcher = EmbeddingBatcher(FakeEmbedder(), max_tokens=2, max_items=2)
+    texts = ["a", "bb", "ccc", "dddd", "eeeee"]
+    assert batcher.embed(texts, [1] * len(texts)) == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+
+
+def test_rejected_inputs_are_isolated():
+    embedder = FakeEmbedder(bad={"bad"})
+    batcher = EmbeddingBatcher(embedder)
+    texts = ["a", "b", "bad", "c"]
+    assert batcher.embed(texts, [1] * len(texts)) == [[1.0], [1.0], None, [1.0]]
+
+
+def test_other_errors_are_raised_without_bisecting():
+    embedder = FakeEmbedder(error=openai.error.RateLimitError("slow down"))
+    batcher = EmbeddingBatcher(embedder)
+    with pytest.raises(openai.error.RateLimitError):
+        batcher.embed(["a", "b", "c", "d"], [1] * 4)
+    assert len(embedder.requests) == 1
+
+
+def test_rejected_requests_are_not_retried(monkeypatch):
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        raise openai.error.InvalidRequestError("rejected", None)
+
+    monkeypatch.setattr(openai.Embedding, "create", create)
+    with pytest.raises(openai.error.InvalidRequestError):
+        embed_with_backoff(model="model", input=["a"])
+    assert len(calls) == 1
+
+
+def test_get_embedding_returns_none_on_errors(monkeypatch):
+    def create(**kwargs):
+        raise openai.error.InvalidRequestError("rejected", None)
+
+    monkeypatch.setattr(openai.Embedding, "create", create)
+    assert Embedder().get_embedding("a") is None
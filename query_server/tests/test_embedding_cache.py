@@ -0,0 +1,36 @@
+import numpy as np
+from embedding_cache import EmbeddingCache, text_hash
+
+MODEL = "model"
+
+
+def test_round_trips_float32_vectors(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+    cache.put_many(MODEL, ["a", "b"], [[0.5, 1.5], [2.0, 3.0]])
+    a, missing, b = cache.get_many(MODEL, ["a", "c", "b"])
+    assert missing is None
+    assert a.dtype == np.float32 and a.tolist() == [0.5, 1.5]
+    assert b.tolist() == [2.0, 3.0]
+    assert cache.get_many("other model", ["a"]) == [None]
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_shared_between_connections(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    EmbeddingCache(path).put_many(MODEL, ["a"], [[1.0]])
+    assert EmbeddingCache(path).get_many(MODEL, ["a"])[0].tolist() == [1.0]
+
+
+def test_only_remembered_lookups_are_kept_in_memory(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), memory_entries=2)
+    # Bulk writes go to disk only
+    cache.put_many(MODEL, ["a", "b", "c"], [[1.0], [2.0], [3.0]])
+    assert len(cache.memory) == 0
+    cache.get_many(MODEL, ["a", "b", "c"])
+    assert len(cache.memory) == 0
+
+    cache.get_many(MODEL, ["a"], remember=True)
+    cache.put_many(MODEL, ["d"], [[4.0]], remember=True)
+    assert (MODEL, text_hash("a")) in cache.memory and (MODEL, text_hash("d")) in cache.memory
+    assert len(cache.memory) == 2
+    assert cache.memory.get((MODEL, text_hash("d"))).dtype == np.float32
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+from index import Index, parse_search_params, reciprocal_rank_fusion
+from section_store import SectionStore
+
+DIMENSION = 16
+
+
+def unit_vectors(count: int, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).standard_normal((count, DIMENSION)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def nearest(index: Index, vectors: np.ndarray, k: int = 1) -> list[list[int]]:
+    return index.search_embeddings([""] * len(vectors), list(vectors), k, candidate_depth=0)
+
+
+def test_parse_search_params():
+    assert parse_search_params("nprobe=32, efSearch=64,") == {"nprobe": 32, "efSearch": 64}
+    assert parse_search_params("ratio=0.5") == {"ratio": 0.5}
+    assert parse_search_params("") == {}
+
+
+@pytest.mark.parametrize("index_spec", ["Flat", "IVF4,Flat", "HNSW8"])
+def test_specs_find_stored_vectors(index_spec):
+    vectors = unit_vectors(200)
+    index = Index.from_vectors(vectors, index_spec, ids=np.arange(1000, 1200), search_params={"nprobe": 4} if "IVF" in index_spec else None)
+    assert index.ntotal == 200
+    assert nearest(index, vectors[:20]) == [[1000 + i] for i in range(20)]
+
+
+def test_untrained_index_refuses_vectors():
+    index = Index(None, embedding_length=DIMENSION, index_spec="IVF4,Flat")
+    with pytest.raises(ValueError):
+        index.add_embeddings(unit_vectors(1), [0])
+
+
+def test_removing_ids_leaves_the_others_in_place(tmp_path):
+    vectors = unit_vectors(50)
+    index = Index.from_vectors(vectors, "Flat", ids=np.arange(50) * 10)
+    assert index.remove_ids([0, 10, 999]) == 2
+    assert nearest(index, vectors[2:5]) == [[20], [30], [40]]
+
+    path = str(tmp_path / "index.faiss")
+    index.save_to_path(path)
+    loaded = Index(path)
+    assert sorted(loaded.ids().tolist()) == list(range(20, 500, 10))
+    assert nearest(loaded, vectors[2:3]) == [[20]]
+
+
+def test_reciprocal_rank_fusion_favours_ids_in_both_rankings():
+    assert reciprocal_rank_fusion([[1, 2, 3], [3, 4, 1]]) == [1, 3, 2, 4]
+    assert reciprocal_rank_fusion([[5, 6], []]) == [5, 6]
+    assert reciprocal_rank_fusion([]) == []
+
+
+def test_hybrid_search_finds_exact_words_the_embedding_misses():
+    vectors = unit_vectors(3)
+    index = Index.from_vectors(vectors, "Flat", ids=np.arange(3))
+    store = SectionStore()
+    store.append([0, 1, 2], [(title, None, 0, '', content, 1) for title, content in
+                             [("Apollo", "moon landing"), ("Gemini", "orbit"), ("Mercury", "born 1903 in Ohio")]])
+    index.sparse_index = store
+    # The embedding points at the first section, the words only match the last
+    assert index.search_embeddings(["born 1903"], [vectors[0]], 1, candidate_depth=0) == [[0]]
+    hybrid = index.search_embeddings(["born 1903"], [vectors[0]], 2, candidate_depth=3)[0]
+    assert set(hybrid) == {0, 2}
+    # Without an embedding only the text matches are returned
+    assert index.search_embeddings(["born 1903"], [None], 2, candidate_depth=3) == [[2]]
@@ -0,0 +1,69 @@
+import pytest
+from types import SimpleNamespace
+from ingest import IngestPipeline
+
+ENTRIES = {title: [(title, None, 0, '', f"{title} content", 3)] for title in "ABCDEFGH"}
+
+
+class Corpus():
+    def __contains__(self, title):
+        return title in ENTRIES
+
+    def get_entries(self, title):
+        return ENTRIES[title]
+
+
+class Batcher():
+    max_items = 2
+    max_tokens = 100
+
+    def __init__(self, embed):
+        self.embed = embed
+
+
+def stub_database(embed):
+    written = []
+    wikidb = SimpleNamespace(corpus=Corpus(), page_titles=lambda: set(), index=SimpleNamespace(batcher=Batcher(embed)),
+                             add_embedded_entries=lambda entries, embeddings: written.extend(entries))
+    return wikidb, written
+
+
+def test_writes_embedded_pages():
+    wikidb, written = stub_database(lambda texts, token_counts: [[0.0]] * len(texts))
+    pipeline = IngestPipeline(wikidb, workers=1)
+    pipeline.run(["A", "B", "C"])
+    assert sorted(entry[0] for entry in written) == ["A", "B", "C"]
+    assert pipeline.done == {"A", "B", "C"}
+
+
+def test_pages_that_fail_to_embed_are_retried():
+    wikidb, written = stub_database(lambda texts, token_counts: [None if text.startswith("B") else [0.0] for text in texts])
+    pipeline = IngestPipeline(wikidb, workers=1)
+    pipeline.run(["A", "B", "C"])
+    assert pipeline.done == {"A", "C"}
+    assert pipeline.failed == ["B"]
+
+
+def test_embedding_errors_stop_the_run():
+    def embed(texts, token_counts):
+        raise ConnectionError("embedding API unreachable")
+
+    wikidb, written = stub_database(embed)
+    pipeline = IngestPipeline(wikidb, workers=1)
+    with pytest.raises(ConnectionError):
+        pipeline.run(["A", "B", "C"])
+    assert written == [] and pipeline.done == set()
+
+
+def test_no_more_pages_are_embedded_after_an_error():
+    calls = []
+
+    def embed(texts, token_counts):
+        calls.append(texts)
+        raise ConnectionError("embedding API unreachable")
+
+    wikidb, written = stub_database(embed)
+    pipeline = IngestPipeline(wikidb, workers=1, max_in_flight=1)
+    with pytest.raises(ConnectionError):
+        pipeline.run(list("ABCDEFGH"))
+    assert len(calls) == 1
@@ -0,0 +1,62 @@
+import asyncio
+import pytest
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    """ Metrics made by a test are registered apart from the server's """
+    monkeypatch.setattr(metrics, "REGISTRY", [])
+
+
+def test_counter_and_gauge_text_format():
+    questions = metrics.Counter("questions_total", "Questions answered", ("kind",))
+    questions.labels("chat").inc()
+    questions.labels("chat").inc(2)
+    questions.labels('say "hi"\n').inc()
+    vectors = metrics.Gauge("vectors", "Vectors in the index")
+    vectors.set_function(lambda: 42)
+    assert metrics.render() == (
+        '# HELP questions_total Questions answered\n'
+        '# TYPE questions_total counter\n'
+        'questions_total{kind="chat"} 3.0\n'
+        'questions_total{kind="say \\"hi\\"\\n"} 1.0\n'
+        '# HELP vectors Vectors in the index\n'
+        '# TYPE vectors gauge\n'
+        'vectors 42.0\n')
+
+
+def test_histogram_buckets_are_cumulative():
+    seconds = metrics.Histogram("seconds", "Latency", ("stage",), buckets=(1.0, 0.1))
+    for value in [0.05, 0.1, 0.5, 5.0]:
+        seconds.labels("search").observe(value)
+    assert seconds.render()[2:] == [
+        'seconds_bucket{stage="search",le="0.1"} 2',
+        'seconds_bucket{stage="search",le="1.0"} 3',
+        'seconds_bucket{stage="search",le="+Inf"} 4',
+        'seconds_sum{stage="search"} 5.65',
+        'seconds_count{stage="search"} 4']
+
+
+def test_labels_have_to_match():
+    with pytest.raises(ValueError):
+        metrics.Counter("total", "Total", ("kind",)).labels()
+
+
+def test_spans_are_recorded_in_the_current_trace_only():
+    @metrics.timed("inner")
+    async def inner():
+        # Threads started from a traced task record into its trace
+        await asyncio.to_thread(lambda: metrics.record("thread", 0, 0))
+
+    async def traced() -> metrics.Trace:
+        trace = metrics.start_trace()
+        with metrics.span("outer"):
+            await inner()
+        return trace
+
+    trace = asyncio.run(traced())
+    assert [stage for stage, _, _ in trace.spans] == ["thread", "inner", "outer"]
+    assert trace.server_timing().startswith("thread;dur=") and ", inner;dur=" in trace.server_timing()
+    assert [span["stage"] for span in trace.to_dict()["spans"]] == ["thread", "inner", "outer"]
+    assert metrics._current_trace.get() is None
@@ -0,0 +1,243 @@
+import asyncio
+import time
+import pytest
+from types import SimpleNamespace
+from answer_cache import AnswerCache
+from query_agent import BATCH_ERROR_ANSWER, UNKNOWN, Author, ChatEntry, ChatMemory, QueryAgent, dedupe_sections, sections_within_budget
+from token_consts import MAX_COMPLETION_TOKENS, MAX_HISTORY_TOKENS
+from section_store import Section
+
+
+def section(id: int, content: str, tokens: int = 10) -> Section:
+    return Section(id, "Title", None, 0, '', content, tokens)
+
+
+def test_sections_within_budget_counts_separators():
+    sections = [section(i, "text", tokens) for i, tokens in enumerate([10, 20, 30])]
+    assert sections_within_budget(sections, 31, 1) == 1
+    assert sections_within_budget(sections, 32, 1) == 2
+    assert sections_within_budget(sections, 63, 1) == 3
+    assert sections_within_budget(sections, 10, 1) == 0
+    assert sections_within_budget([], 100, 1) == 0
+
+
+def test_dedupe_keeps_the_more_relevant_copy():
+    sections = [section(0, "the moon landing was in 1969"), section(1, "The moon landing was in 1969"),
+                section(2, "the first moon landing was in 1969"), section(3, "something else entirely")]
+    assert [kept.id for kept in dedupe_sections(sections)] == [0, 2, 3]
+    assert [kept.id for kept in dedupe_sections(sections, threshold=0.8)] == [0, 3]
+
+
+class FallbackDatabase():
+    """ Finds one page per search in the section corpus and takes a long time to embed """
+
+    def __init__(self, read_seconds: dict[str, float]):
+        self.read_seconds = read_seconds
+        self.corpus = self
+        self.embedded, self.submitted = [], []
+
+    def __contains__(self, title):
+        return True
+
+    def search(self, query):
+        return [query.upper()]
+
+    def get_pages(self, titles):
+        time.sleep(max(self.read_seconds[title] for title in titles))
+        return [(title, [(title, None, 0, '', "content", 1)]) for title in titles]
+
+    def is_page_queued(self, title):
+        return False
+
+    def has_page(self, title):
+        return False
+
+    async def aadd_page_entries(self, pages):
+        self.embedded.extend(title for title, _ in pages)
+        await asyncio.sleep(10)
+
+    def submit_page_entries(self, pages):
+        self.submitted.extend(title for title, _ in pages)
+
+
+def test_fallback_indexes_pages_read_before_the_deadline():
+    agent = QueryAgent.__new__(QueryAgent)
+    agent._wikidb = FallbackDatabase({"A": 0, "B": 0.1, "C": 5})
+    agent._extract_pool = object()
+
+    async def searches(query):
+        return ["a", "b", "c"]
+    agent.agenerate_searches_for_wikipedia = searches
+
+    async def read_all():
+        return [title async for title in agent._aread_pages_for_query("question", 0.5)]
+
+    assert asyncio.run(read_all()) == ["A", "B"]
+    # A went to the writer at once, B was read while A was being embedded
+    assert agent._wikidb.embedded == ["A"]
+    assert agent._wikidb.submitted == ["B"]
+
+
+def long_chat(turns: int, words_per_turn: int = 300) -> list[ChatEntry]:
+    chat = []
+    for turn in range(turns):
+        chat.append(ChatEntry(content=f"question{turn}", author=Author.USER))
+        chat.append(ChatEntry(content=" ".join([f"answer{turn}"] * words_per_turn), author=Author.AGENT))
+    chat.append(ChatEntry(content="and then?", author=Author.USER))
+    return chat
+
+
+def chat_agent() -> QueryAgent:
+    """ An agent whose tokens are words and whose completions are recorded, it answers with the number of prompts so far """
+    agent = QueryAgent.__new__(QueryAgent)
+    agent.tokenizer = SimpleNamespace(encode=str.split)
+    agent.prompts = []
+
+    def complete(prompt, max_tokens=MAX_COMPLETION_TOKENS):
+        agent.prompts.append(prompt)
+        return f"summary {len(agent.prompts)}"
+
+    async def acomplete(prompt, max_tokens=MAX_COMPLETION_TOKENS):
+        return complete(prompt, max_tokens)
+    agent._do_completion = complete
+    agent._ado_completion = acomplete
+    return agent
+
+
+def test_roll_history_keeps_the_latest_turns_within_budget():
+    memory = ChatMemory()
+    evicted, window = chat_agent()._roll_history(long_chat(10), memory)
+    assert len(evicted) + len(window) == 10
+    assert sum(memory.turn_tokens[len(evicted):]) <= MAX_HISTORY_TOKENS
+    assert "question9" in window[-1]
+    # Counted once, a turn later is a continuation
+    memory.summarized_turns = len(evicted)
+    evicted, window = chat_agent()._roll_history(long_chat(11), memory)
+    assert len(evicted) == 1 and len(memory.turn_tokens) == 11
+
+
+def test_chat_without_memory_only_truncates():
+    agent = chat_agent()
+    assert agent.summarize_chat(long_chat(10)) == "summary 1"
+    # The only completion rewrites the question, with none of the turns past the budget
+    assert len(agent.prompts) == 1
+    assert "question0" not in agent.prompts[0] and "question9" in agent.prompts[0]
+
+
+@pytest.mark.parametrize("summarize", ["sync", "async"])
+def test_memory_catches_up_in_chunks_within_budget(summarize):
+    agent = chat_agent()
+    memory = ChatMemory()
+    if summarize == "sync":
+        agent.summarize_chat(long_chat(10), memory)
+    else:
+        asyncio.run(agent.asummarize_chat(long_chat(10), memory))
+    memos = [prompt for prompt in agent.prompts if "Progressively summarize" in prompt]
+    assert len(memos) > 1
+    assert all(len(prompt.split()) < MAX_HISTORY_TOKENS + 200 for prompt in memos)
+    # The rewrite sees the latest chunk verbatim along with the window
+    assert all(len(prompt.split()) < 2 * MAX_HISTORY_TOKENS + 200 for prompt in agent.prompts)
+    assert memory.summarized_turns == 10 - 3
+    # Every chunk is folded into the summary of the one before
+    assert "summary 1" in memos[1] and memory.summary.startswith("summary")
+
+
+def streaming_agent(chunks: list[str]) -> QueryAgent:
+    """ An agent whose completions stream the given chunks, recording whether the stream was closed """
+    agent = QueryAgent.__new__(QueryAgent)
+    agent.closed = False
+
+    async def stream(prompt, max_tokens=MAX_COMPLETION_TOKENS):
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            agent.closed = True
+    agent._astream_completion = stream
+    return agent
+
+
+async def collect(agent: QueryAgent, stop_if_unknown: bool) -> list:
+    return [delta async for delta in agent._astream_answer("prompt", stop_if_unknown)]
+
+
+def test_stream_holds_back_text_until_it_is_not_unknown():
+    agent = streaming_agent(["\n ", "I", " do", "n't", " think", " so"])
+    assert asyncio.run(collect(agent, stop_if_unknown=True)) == ["I don't think", " so"]
+    assert asyncio.run(collect(agent, stop_if_unknown=False)) == ["I", " do", "n't", " think", " so"]
+
+
+def test_stream_stops_as_soon_as_the_answer_is_unknown():
+    agent = streaming_agent([" I", " don", "'t know", ".", " More text"])
+    assert asyncio.run(collect(agent, stop_if_unknown=True)) == [UNKNOWN]
+    assert agent.closed
+
+
+def test_short_answer_that_could_be_unknown_is_sent():
+    assert asyncio.run(collect(streaming_agent(["I", " do"]), stop_if_unknown=True)) == ["I do"]
+
+
+def test_batch_answers_repeated_questions_once_within_the_concurrency():
+    agent = QueryAgent.__new__(QueryAgent)
+    asked, running = [], []
+
+    async def aquery(query):
+        asked.append(query)
+        running.append(query)
+        assert len(running) <= 2
+        await asyncio.sleep(0.01)
+        running.remove(query)
+        return ChatEntry(content=query.upper(), author=Author.AGENT)
+    agent.aquery = aquery
+
+    answers = asyncio.run(agent.abatch_query(["a", "b", "a", "c", "d"], max_concurrency=2))
+    assert [answer.content for answer in answers] == ["A", "B", "A", "C", "D"]
+    assert sorted(asked) == ["a", "b", "c", "d"]
+
+
+def test_unknown_answers_are_not_cached():
+    agent = QueryAgent.__new__(QueryAgent)
+    cache = AnswerCache(10, 60, threshold=0.9, invalidation_threshold=0.8, embedding_length=2)
+    for answer in [" I don't know.", "i don't know who that is."]:
+        agent._remember_answer(cache, "question", [1.0, 0.0], answer, "context")
+    assert cache.stats()["size"] == 0
+    agent._remember_answer(cache, "question", [1.0, 0.0], "Ada Lovelace", "context")
+    assert cache.get([1.0, 0.0]).answer == "Ada Lovelace"
+
+
+def test_query_falls_back_on_any_unknown_answer():
+    agent = QueryAgent.__new__(QueryAgent)
+    agent.query_answers = None
+    completions = iter(["I don't know who that is.", "Ada Lovelace"])
+    fallbacks = []
+    agent._use_http_session = lambda: None
+
+    async def no_cached_answer(cache, query):
+        return None, None
+
+    async def context(question, candidate_depth=None, embedding=None):
+        return "context"
+
+    async def complete(prompt, max_tokens=MAX_COMPLETION_TOKENS):
+        return next(completions)
+
+    async def fallback(query):
+        fallbacks.append(query)
+    agent._acached_answer, agent.aget_context_for_question = no_cached_answer, context
+    agent._ado_completion, agent.aupdate_index_for_query = complete, fallback
+
+    assert asyncio.run(agent.aquery("Who wrote the first program?")).content == "Ada Lovelace"
+    assert fallbacks == ["Who wrote the first program?"]
+
+
+def test_batch_answers_the_other_questions_when_one_fails():
+    agent = QueryAgent.__new__(QueryAgent)
+
+    async def aquery(query):
+        if query == "b":
+            raise TimeoutError("completion timed out")
+        return ChatEntry(content=query.upper(), author=Author.AGENT)
+    agent.aquery = aquery
+
+    answers = asyncio.run(agent.abatch_query(["a", "b", "c"], max_concurrency=2))
+    assert [answer.content for answer in answers] == ["A", BATCH_ERROR_ANSWER, "C"]
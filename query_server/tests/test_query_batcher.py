@@ -0,0 +1,42 @@
+import asyncio
+from types import SimpleNamespace
+from query_batcher import QueryBatcher
+
+
+class FakeIndex():
+    """ Embeds a question as its length and finds the question's length as its only neighbour """
+
+    def __init__(self):
+        self.embedded: list[list[str]] = []
+        self.embedder = SimpleNamespace(aget_embedding=self.aget_embedding)
+
+    async def aget_embedding(self, questions):
+        self.embedded.append(questions)
+        return [[float(len(question))] for question in questions]
+
+    def search_embeddings(self, questions, embeddings, k, candidate_depth):
+        return [[int(embedding[0])] for embedding in embeddings]
+
+
+def test_concurrent_questions_are_embedded_together():
+    index = FakeIndex()
+    batcher = QueryBatcher(index, window_seconds=0.01, max_batch=10)
+
+    async def ask():
+        return await asyncio.gather(batcher.closest_indices("a"), batcher.closest_indices("bb"),
+                                    batcher.closest_indices("a"), batcher.embedding("ccc"))
+
+    assert asyncio.run(ask()) == [[1], [2], [1], [3.0]]
+    assert index.embedded == [["a", "bb", "ccc"]]
+    assert batcher.stats() == {"batches": 1, "requests": 4, "coalesced": 1}
+
+
+def test_known_embeddings_are_not_embedded_again():
+    index = FakeIndex()
+    batcher = QueryBatcher(index, window_seconds=0.01, max_batch=10)
+
+    async def ask():
+        return await asyncio.gather(batcher.closest_indices("a", embedding=[7.0]), batcher.closest_indices("bb"))
+
+    assert asyncio.run(ask()) == [[7], [2]]
+    assert index.embedded == [["bb"]]
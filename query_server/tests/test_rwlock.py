@@ -0,0 +1,69 @@
+import threading
+import time
+from rwlock import ReadWriteLock
+
+
+def test_readers_share_the_lock():
+    lock = ReadWriteLock()
+    inside = threading.Barrier(3, timeout=5)
+
+    def read():
+        with lock.read():
+            # Every reader has to be inside at once for the barrier to open
+            inside.wait()
+
+    readers = [threading.Thread(target=read) for _ in range(3)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join(5)
+    assert not inside.broken
+
+
+def test_writer_waits_for_readers_and_holds_back_new_ones():
+    lock = ReadWriteLock()
+    events = []
+    first_reader_in = threading.Event()
+    release_first_reader = threading.Event()
+
+    def first_reader():
+        with lock.read():
+            first_reader_in.set()
+            release_first_reader.wait(5)
+            events.append("first read")
+
+    def writer():
+        with lock.write():
+            events.append("write")
+
+    def second_reader():
+        with lock.read():
+            events.append("second read")
+
+    threads = [threading.Thread(target=first_reader)]
+    threads[0].start()
+    first_reader_in.wait(5)
+    threads.append(threading.Thread(target=writer))
+    threads[1].start()
+    # Let the writer start waiting before the second reader arrives
+    time.sleep(0.05)
+    threads.append(threading.Thread(target=second_reader))
+    threads[2].start()
+    time.sleep(0.05)
+    assert events == []
+    release_first_reader.set()
+    for thread in threads:
+        thread.join(5)
+    assert events == ["first read", "write", "second read"]
+
+
+def test_lock_is_released_when_the_body_raises():
+    lock = ReadWriteLock()
+    for hold in (lock.read, lock.write):
+        try:
+            with hold():
+                raise RuntimeError
+        except RuntimeError:
+            pass
+    with lock.write():
+        pass
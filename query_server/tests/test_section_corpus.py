@@ -0,0 +1,27 @@
+import wikitextparser as wtp
+from bench.synthetic_dump import write_multistream_dump
+from section_corpus import SectionCorpus, build_section_corpus
+from sections import format_document_for_indexing
+
+PAGES = [
+    ("Ada Lovelace", "Ada was a mathematician.\n== Life ==\nBorn in London in 1815.\n== References ==\nA book."),
+    ("Countess of Lovelace", "#REDIRECT [[Ada Lovelace]]"),
+    ("Template:Infobox", "A template"),
+    ("Charles Babbage", "Charles designed the analytical engine."),
+]
+
+
+def test_corpus_holds_the_sections_of_every_article(tmp_path):
+    dump_path, index_path = str(tmp_path / "dump.xml.bz2"), str(tmp_path / "index.txt")
+    write_multistream_dump(PAGES, dump_path, index_path, pages_per_stream=2)
+    build_section_corpus(index_path, dump_path, str(tmp_path / "sections.zst"), workers=1)
+    corpus = SectionCorpus(str(tmp_path / "sections.zst"))
+
+    # Redirects and other namespaces are left out
+    assert len(corpus) == 2
+    assert "Ada Lovelace" in corpus and "Countess of Lovelace" not in corpus
+    for title, text in [PAGES[0], PAGES[3]]:
+        assert corpus.get_entries(title) == format_document_for_indexing(title, wtp.parse(text))
+    assert [section for _, section, _, _, _, _ in corpus.get_entries("Ada Lovelace")] == [None, " Life "]
+    assert corpus.get_entries("Missing") is None
+    assert corpus.get_pages(["Charles Babbage", "Missing"])[1] == ("Missing", [])
@@ -0,0 +1,107 @@
+import os
+import pytest
+import sqlite3
+from section_store import OverlaySectionStore, SectionStore, freeze_store
+
+
+def entry(title: str, content: str, section_index: int = 0) -> tuple:
+    return (title, None, section_index, '', content, len(content.split()))
+
+
+def test_lookups_by_id_and_title():
+    store = SectionStore()
+    store.append([5, 7, 9], [entry("Apollo", "the moon landing"), entry("Apollo", "the god", 1), entry("Zeus", "thunder")])
+    assert len(store) == 3
+    assert store.next_id() == 10
+    assert store.get(7).content == "the god"
+    assert store.get(6) is None
+    # In the order asked for, missing ids skipped
+    assert [section.id for section in store.get_many([9, 6, 5])] == [9, 5]
+    assert sorted(store.ids_for_title("Apollo")) == [5, 7]
+    assert store.titles() == {"Apollo", "Zeus"}
+    store.remove_ids([5, 7])
+    assert not store.has_title("Apollo")
+
+
+def test_text_search_follows_writes():
+    store = SectionStore()
+    store.append([1, 2], [entry("Apollo", "the moon landing in 1969"), entry("Moon", "a natural satellite")])
+    assert store.search_text("moon landing", 5) == [1, 2]
+    # Titles weigh more than content
+    assert store.search_text("moon", 5)[0] == 2
+    assert store.search_text("what?", 5) == []
+    store.remove_ids([2])
+    assert store.search_text("moon", 5) == [1]
+
+
+def test_read_only_store_is_never_written(tmp_path):
+    path = str(tmp_path / "sections.sqlite")
+    SectionStore(path).append([0], [entry("Apollo", "the moon landing")])
+    store = SectionStore(path, read_only=True)
+    assert store.get(0).title == "Apollo"
+    with pytest.raises(sqlite3.OperationalError):
+        store.append([1], [entry("Zeus", "thunder")])
+
+
+def test_overlay_keeps_additions_apart(tmp_path):
+    path = str(tmp_path / "sections.sqlite")
+    SectionStore(path).append([0, 1], [entry("Apollo", "the moon landing"), entry("Moon", "a natural satellite")])
+    store = OverlaySectionStore(SectionStore(path, read_only=True))
+    store.append([store.next_id()], [entry("Artemis", "a return to the moon")])
+
+    assert len(store) == 3
+    assert [section.title for section in store.get_many([2, 0])] == ["Artemis", "Apollo"]
+    assert store.titles() == {"Apollo", "Moon", "Artemis"}
+    assert sorted(store.search_text("moon", 5)) == [0, 1, 2]
+    assert len(SectionStore(path, read_only=True)) == 2
+
+    with pytest.raises(ValueError):
+        store.remove_ids([0])
+    store.remove_ids([2])
+    assert not store.has_title("Artemis")
+
+    store.append([2], [entry("Artemis", "a return to the moon")])
+    saved_path = str(tmp_path / "saved.sqlite")
+    store.save_to_path(saved_path)
+    assert SectionStore(saved_path).titles() == {"Apollo", "Moon", "Artemis"}
+    with pytest.raises(ValueError):
+        store.save_to_path(path)
+
+
+def test_frozen_store_opens_immutable(tmp_path):
+    path = str(tmp_path / "sections.sqlite")
+    writer = SectionStore(path)
+    writer.append([0, 1], [entry("Apollo", "the moon landing"), entry("Zeus", "thunder")])
+    writer._conn.close()
+    freeze_store(path)
+    # An immutable open ignores the WAL, so every row has to be in the file itself
+    assert not os.path.exists(path + "-wal")
+    store = SectionStore(path, immutable=True)
+    assert store.read_only and len(store) == 2
+    assert store.search_text("thunder", 5) == [1]
+    assert not os.path.exists(path + "-shm")
+
+
+def test_read_only_store_refuses_an_old_schema(tmp_path):
+    path = str(tmp_path / "sections.sqlite")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE sections (id INTEGER PRIMARY KEY, title TEXT NOT NULL, section TEXT, "
+                 "section_index INTEGER NOT NULL, permalink TEXT NOT NULL, content TEXT NOT NULL, tokens INTEGER NOT NULL)")
+    conn.commit()
+    conn.close()
+    with pytest.raises(ValueError):
+        SectionStore(path, read_only=True)
+    # Upgraded offline by a writable open
+    SectionStore(path)
+    assert len(SectionStore(path, read_only=True)) == 0
+
+
+def test_overlay_ranks_each_store_on_its_own(tmp_path):
+    path = str(tmp_path / "sections.sqlite")
+    # In a large base a passing mention has a much better BM25 score than a whole article in a small overlay
+    SectionStore(path).append(list(range(202)), [entry(f"Page {i}", "nothing to see here") for i in range(200)] +
+                              [entry("Savanna", "grass, trees and the odd zebra"), entry("Zoo", "a zebra and a lion")])
+    store = OverlaySectionStore(SectionStore(path, read_only=True))
+    store.append([202], [entry("Zebra", "zebra stripes are black and white, every zebra has its own stripes")])
+    assert 202 in store.search_text("zebra stripes", 2)
+    assert sorted(store.search_text("zebra stripes", 5)) == [200, 201, 202]
@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+from models import Author, ChatEntry, ChatMemory
+from session_store import (MemorySessionStore, SessionData, SessionStore, SqliteSessionStore, open_session_store,
+                           sweep_periodically)
+
+
+def session(text: str) -> SessionData:
+    return SessionData(chat=[ChatEntry(content=text, author=Author.USER)], memory=ChatMemory(summary=text, summarized_turns=1))
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def new_store(request, tmp_path):
+    def new_store(ttl_seconds=60.0, max_entries=10) -> SessionStore:
+        return open_session_store(request.param, str(tmp_path / "sessions.sqlite"), ttl_seconds, max_entries)
+    return new_store
+
+
+def test_sessions_roundtrip(new_store):
+    store = new_store()
+    store.put("a", session("hello"))
+    assert store.get("a") == session("hello")
+    assert store.get("b") is None
+    store.delete("a")
+    assert store.get("a") is None and len(store) == 0
+
+
+def test_expired_sessions_are_swept(new_store):
+    store = new_store(ttl_seconds=-1)
+    store.put("a", session("hello"))
+    assert store.get("a") is None
+    assert store.sweep() == 1
+    assert len(store) == 0 and store.sweep() == 0
+
+
+def test_least_recently_used_sessions_go_over_the_cap(new_store):
+    store = new_store(max_entries=2)
+    for session_id in ["a", "b", "c"]:
+        store.put(session_id, session(session_id))
+    store.sweep()
+    assert len(store) == 2
+    assert store.get("a") is None and store.get("c") is not None
+
+
+def test_sqlite_sessions_are_shared_between_workers(tmp_path):
+    path = str(tmp_path / "sessions.sqlite")
+    SqliteSessionStore(path, 60, 10).put("a", session("hello"))
+    assert SqliteSessionStore(path, 60, 10).get("a") == session("hello")
+
+
+def test_session_stores_implement_every_operation():
+    with pytest.raises(TypeError):
+        SessionStore(60, 10)
+
+
+def test_sweeper_runs_until_cancelled():
+    store = MemorySessionStore(ttl_seconds=-1, max_entries=10)
+    store.put("a", session("hello"))
+
+    async def sweep_once():
+        sweeper = asyncio.create_task(sweep_periodically(store, 0.01))
+        await asyncio.sleep(0.1)
+        sweeper.cancel()
+
+    asyncio.run(sweep_once())
+    assert len(store) == 0
@@ -0,0 +1,52 @@
+import pytest
+from title_index import TitleIndex, read_dump_chunks, read_multistream_index, write_title_index
+
+
+def write_multistream_index(path, lines):
+    with open(path, 'w', encoding='utf-8') as index_file:
+        index_file.writelines(f"{line}\n" for line in lines)
+
+
+def test_chunk_lengths_run_to_the_next_chunk(tmp_path):
+    index_path = tmp_path / "index.txt"
+    write_multistream_index(index_path, ["600:1:Anarchism", "600:2:Autism", "1500:3:Albedo", "1500:4:A", "2300:5:Alabama"])
+    assert list(read_multistream_index(str(index_path))) == [
+        ("Anarchism", 600, 900), ("Autism", 600, 900), ("Albedo", 1500, 800), ("A", 1500, 800), ("Alabama", 2300, -1)]
+    assert list(read_dump_chunks(str(index_path))) == [(600, 900), (1500, 800), (2300, -1)]
+
+
+def test_titles_keep_their_colons(tmp_path):
+    index_path = tmp_path / "index.txt"
+    write_multistream_index(index_path, ["600:1:Help:Contents", "900:2:Star Wars: Episode IV"])
+    assert [title for title, _, _ in read_multistream_index(str(index_path))] == ["Help:Contents", "Star Wars: Episode IV"]
+
+
+def test_lookups(tmp_path):
+    entries = [(f"Page {i}", 600 + 1000 * (i // 100), 1000) for i in range(1000)] + [("Zürich", 200600, -1), ("", 7, 8)]
+    path = str(tmp_path / "titles.bin")
+    write_title_index(entries, path)
+    index = TitleIndex(path)
+
+    assert len(index) == len(entries)
+    for title, start_byte, data_length in entries:
+        assert index.get(title) == (start_byte, data_length)
+        assert title in index
+    assert index["Page 99"] == (600, 1000)
+    assert index["Page 100"] == (1600, 1000)
+    assert index.get("Page 1000") is None
+    assert "page 1" not in index
+
+
+def test_empty_index(tmp_path):
+    path = str(tmp_path / "titles.bin")
+    write_title_index([], path)
+    index = TitleIndex(path)
+    assert len(index) == 0
+    assert index.get("Anything") is None
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / "titles.bin"
+    path.write_bytes(b"\0" * 64)
+    with pytest.raises(ValueError):
+        TitleIndex(str(path))
@@ -0,0 +1,39 @@
+from bench.synthetic_dump import write_multistream_dump
+from title_search import TitleSearch, build_title_search, page_document, tokenize
+
+PAGES = [
+    ("Ada Lovelace", "Ada Lovelace was an English mathematician who wrote the first computer program.\n== Life ==\nBorn in London."),
+    ("Charles Babbage", "Charles Babbage designed the analytical engine, a mechanical computer."),
+    ("Countess of Lovelace", "#REDIRECT [[Ada Lovelace]]"),
+    ("Category:Mathematicians", "Mathematicians of every country"),
+    ("London", "London is the capital of England."),
+]
+
+
+def test_tokenize_drops_stopwords_and_case():
+    assert tokenize("Who was THE first programmer?") == ["first", "programmer"]
+
+
+def test_page_documents():
+    title, counts, length = page_document(*PAGES[0])
+    # Title words count more than words of the lead, sections past the lead are left out
+    assert title == "Ada Lovelace" and length == 2 * 3 + len(tokenize(PAGES[0][1].split("\n==")[0]))
+    assert page_document(*PAGES[2])[0] == "Ada Lovelace"
+    assert page_document(*PAGES[3]) is None
+
+
+def test_search_finds_titles_and_redirects(tmp_path):
+    dump_path, index_path = str(tmp_path / "dump.xml.bz2"), str(tmp_path / "index.txt")
+    write_multistream_dump(PAGES, dump_path, index_path, pages_per_stream=2)
+    build_title_search(index_path, dump_path, str(tmp_path / "search.bin"), workers=1)
+    search = TitleSearch(str(tmp_path / "search.bin"))
+
+    assert len(search) == 4
+    assert search.search("analytical engine")[0] == "Charles Babbage"
+    assert search.search("first computer program")[0] == "Ada Lovelace"
+    # The redirect resolves to its target, which is only listed once
+    assert search.search("countess lovelace") == ["Ada Lovelace"]
+    assert search.search("capital of england", results=1) == ["London"]
+    # Category pages are not searchable
+    assert search.search("every country") == []
+    assert search.search("the of") == [] and search.search("zebra") == []
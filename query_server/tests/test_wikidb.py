@@ -0,0 +1,92 @@
+import os
+import numpy as np
+import pytest
+import wikidb
+from section_store import SectionStore
+from wikidb import WikipediaDatabase, resolve_snapshot
+
+
+@pytest.fixture(autouse=True)
+def no_dump(monkeypatch):
+    monkeypatch.setattr(wikidb, "open_local_dump", lambda: None)
+
+
+def entries(title: str, count: int) -> list[tuple]:
+    return [(title, None, i, '', f"{title} section {i}", 3) for i in range(count)]
+
+
+def vectors(count: int) -> np.ndarray:
+    return np.random.default_rng(count).standard_normal((count, 1536)).astype(np.float32)
+
+
+@pytest.fixture
+def saved(tmp_path):
+    """ A store of 5 sections of which only the first 3 are in the saved index """
+    store_path, index_path = str(tmp_path / "sections.sqlite"), str(tmp_path / "index.faiss")
+    db = WikipediaDatabase(store_path=store_path)
+    db.add_embedded_entries(entries("Apollo", 3), vectors(3))
+    db.save(store_path, index_path)
+    db.add_embedded_entries(entries("Zeus", 2), vectors(2))
+    db.close()
+    return store_path, index_path
+
+
+def test_writable_database_drops_rows_missing_from_the_index(saved):
+    store_path, index_path = saved
+    db = WikipediaDatabase(store_path=store_path, index_path=index_path)
+    assert len(db.store) == db.index.ntotal == 3
+    assert not db.has_page("Zeus")
+    db.close()
+
+
+def test_read_only_database_never_writes_the_store(saved):
+    store_path, index_path = saved
+    workers = [WikipediaDatabase(store_path=store_path, index_path=index_path, read_only=True) for _ in range(2)]
+    for db in workers:
+        # Nothing is reconciled away, ids of added sections only have to be unique in this process
+        assert db.has_page("Zeus")
+        db.add_embedded_entries(entries("Hera", 2), vectors(2))
+        assert db.has_page("Hera") and db.index.ntotal == 5
+        assert sorted(section.title for section in db.get_section_by_ids(db.store.ids_for_title("Hera"))) == ["Hera", "Hera"]
+        with pytest.raises(ValueError):
+            db.remove_page("Apollo")
+    for db in workers:
+        db.close()
+    assert SectionStore(store_path, read_only=True).titles() == {"Apollo", "Zeus"}
+
+
+def test_read_only_database_needs_a_store(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        WikipediaDatabase(store_path=str(tmp_path / "missing.sqlite"), read_only=True)
+
+
+def test_published_snapshot_is_served_immutable(saved, tmp_path):
+    store_path, index_path = saved
+    db = WikipediaDatabase(store_path=store_path, index_path=index_path)
+    db.add_embedded_entries(entries("Zeus", 2), vectors(2))
+    db.save_snapshot(str(tmp_path / "snapshots"))
+    db.close()
+
+    snapshot_store, snapshot_index = resolve_snapshot(str(tmp_path / "snapshots"))
+    server = WikipediaDatabase(store_path=snapshot_store, index_path=snapshot_index, immutable=True)
+    assert server.read_only and server.store.base.immutable
+    assert server.page_titles() == {"Apollo", "Zeus"} and server.index.ntotal == 5
+    server.add_embedded_entries(entries("Hera", 1), vectors(1))
+    assert server.has_page("Hera")
+    server.close()
+    assert sorted(os.listdir(os.path.dirname(snapshot_store))) == ["index", "sections.sqlite"]
+
+
+def test_writable_database_reconciles_replaced_sections(tmp_path):
+    store_path, index_path = str(tmp_path / "sections.sqlite"), str(tmp_path / "index.faiss")
+    db = WikipediaDatabase(store_path=store_path)
+    db.add_embedded_entries(entries("Apollo", 3), vectors(3))
+    db.save(store_path, index_path)
+    # Replaced after the save, as update_page does, the store has as many rows as the saved index but other ids
+    db.remove_page("Apollo")
+    db.add_embedded_entries(entries("Apollo", 3), vectors(3))
+    db.close()
+
+    db = WikipediaDatabase(store_path=store_path, index_path=index_path)
+    assert len(db.store) == db.index.ntotal == 0
+    db.close()
@@ -0,0 +1,35 @@
+import bz2
+from bench.synthetic_dump import write_multistream_dump
+from title_index import read_dump_chunks
+from wikidump import WikipediaDump, iter_pages_from_chunk
+
+PAGES = [(f"Page {i}", f"Text of page {i} with <b>&amp; markup</b>") for i in range(25)] + [("Last", "The end")]
+
+
+def test_iter_pages_from_chunk():
+    xml = "".join(f"<page><title>{title}</title><revision><text>{text}</text></revision></page>"
+                  for title, text in [("A", "alpha"), ("B", ""), ("C &amp; D", "gamma")])
+    assert list(iter_pages_from_chunk(bz2.compress(xml.encode("utf-8")))) == [("A", "alpha"), ("B", ""), ("C & D", "gamma")]
+
+
+def test_reads_pages_from_every_chunk(tmp_path):
+    dump_path, index_path = str(tmp_path / "dump.xml.bz2"), str(tmp_path / "index.txt")
+    write_multistream_dump(PAGES, dump_path, index_path, pages_per_stream=10)
+    dump = WikipediaDump(index_path, dump_path, chunk_cache_bytes=1 << 20, page_cache_bytes=1 << 20,
+                         title_index_path=str(tmp_path / "titles.bin"))
+    assert len(list(read_dump_chunks(index_path))) == 3
+
+    # The first and last pages of a chunk, and the last chunk which is read to the end of the file
+    for title, text in [PAGES[0], PAGES[9], PAGES[10], PAGES[-1]]:
+        assert dump.get_page(title).string == text
+    assert dump.get_page("Missing") is None
+    assert dump.get_chunk_pages(*dump.locate("Page 3"))["Page 5"] == PAGES[5][1]
+
+
+def test_reads_pages_without_a_chunk_cache(tmp_path):
+    dump_path, index_path = str(tmp_path / "dump.xml.bz2"), str(tmp_path / "index.txt")
+    write_multistream_dump(PAGES, dump_path, index_path, pages_per_stream=10)
+    dump = WikipediaDump(index_path, dump_path, chunk_cache_bytes=0, page_cache_bytes=0,
+                         title_index_path=str(tmp_path / "titles.bin"))
+    assert dump.get_page("Page 14").string == PAGES[14][1]
+    assert dump.get_page("Last").string == "The end"
@@ -0,0 +1,164 @@
+import hashlib
+import mmap
+import os
+import struct
+from array import array
+import numpy as np
+from typing import Iterable, Optional
+
+MAGIC = b"WIKITIX1"
+# magic, entry count, size of the title string table
+HEADER = struct.Struct("<8sQQ")
+
+
+def title_hash(title: str) -> int:
+    """ Stable 64 bit hash of a page title """
+    return int.from_bytes(hashlib.blake2b(title.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class TitleIndex():
+    """ A read only, memory mapped map of page title -> (start_byte, data_length).
+
+        The file is laid out as a header followed by four arrays sorted by title hash:
+            hashes (uint64), start bytes (int64), data lengths (int64), title offsets (int64, count + 1)
+        and finally a utf-8 string table holding the titles, used to resolve hash collisions.
+
+        Lookups are a binary search over the hashes, so opening the index costs nothing and the pages
+        are shared through the OS page cache by every process that maps the same file.
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, _ = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a title index")
+        self.count = count
+
+        offset = HEADER.size
+        self._hashes = np.frombuffer(self._mmap, dtype=np.uint64, count=count, offset=offset)
+        offset += 8 * count
+        self._starts = np.frombuffer(self._mmap, dtype=np.int64, count=count, offset=offset)
+        offset += 8 * count
+        self._lengths = np.frombuffer(self._mmap, dtype=np.int64, count=count, offset=offset)
+        offset += 8 * count
+        self._title_offsets = np.frombuffer(self._mmap, dtype=np.int64, count=count + 1, offset=offset)
+        offset += 8 * (count + 1)
+        self._titles_start = offset
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __contains__(self, title: str) -> bool:
+        return self.get(title) is not None
+
+    def __getitem__(self, title: str) -> tuple[int, int]:
+        result = self.get(title)
+        if result is None:
+            raise KeyError(title)
+        return result
+
+    def get(self, title: str) -> Optional[tuple[int, int]]:
+        """ Get the (start_byte, data_length) for a title or None if it is not in the index """
+        h = np.uint64(title_hash(title))
+        i = int(np.searchsorted(self._hashes, h, side='left'))
+        encoded_title = title.encode("utf-8")
+        while i < self.count and self._hashes[i] == h:
+            if self._title_at(i) == encoded_title:
+                return int(self._starts[i]), int(self._lengths[i])
+            i += 1
+        return None
+
+    def _title_at(self, i: int) -> bytes:
+        start = self._titles_start + int(self._title_offsets[i])
+        end = self._titles_start + int(self._title_offsets[i + 1])
+        return self._mmap[start:end]
+
+
+def write_title_index(entries: Iterable[tuple[str, int, int]], output_path: str):
+    """ Write (title, start_byte, data_length) entries to a title index file at output_path.
+        The file is written to a temporary path and moved into place so readers never see a partial index.
+    """
+    # array keeps the build compact for the ~20M titles of a full dump
+    hashes, starts, lengths, title_lengths = array('Q'), array('q'), array('q'), array('q')
+    tmp_path = output_path + ".tmp"
+    titles_path = output_path + ".titles.tmp"
+    with open(titles_path, 'wb') as titles_file:
+        for title, start_byte, data_length in entries:
+            encoded_title = title.encode("utf-8")
+            titles_file.write(encoded_title)
+            hashes.append(title_hash(title))
+            starts.append(start_byte)
+            lengths.append(data_length)
+            title_lengths.append(len(encoded_title))
+
+    hashes = np.frombuffer(hashes, dtype=np.uint64)
+    starts = np.frombuffer(starts, dtype=np.int64)
+    lengths = np.frombuffer(lengths, dtype=np.int64)
+    title_lengths = np.frombuffer(title_lengths, dtype=np.int64)
+    unsorted_offsets = np.concatenate([[0], np.cumsum(title_lengths)]).astype(np.int64)
+
+    order = np.argsort(hashes, kind='stable')
+    sorted_title_lengths = title_lengths[order]
+    title_offsets = np.concatenate([[0], np.cumsum(sorted_title_lengths)]).astype(np.int64)
+
+    with open(titles_path, 'rb') as titles_file, open(tmp_path, 'wb') as out:
+        titles = mmap.mmap(titles_file.fileno(), 0, access=mmap.ACCESS_READ) if len(order) and title_offsets[-1] else b""
+        out.write(HEADER.pack(MAGIC, len(order), int(title_offsets[-1])))
+        out.write(hashes[order].tobytes())
+        out.write(starts[order].tobytes())
+        out.write(lengths[order].tobytes())
+        out.write(title_offsets.tobytes())
+        for i in order:
+            out.write(titles[unsorted_offsets[i]:unsorted_offsets[i + 1]])
+    os.replace(tmp_path, output_path)
+    os.remove(titles_path)
+
+
+def read_multistream_index(index_filename: str) -> Iterable[tuple[str, int, int]]:
+    """ Read a multistream index text file and yield (title, start_byte, data_length) for each page.
+        A line is start_byte:id:name, the page title may itself contain ':'.
+    """
+    prev_start_byte = None
+    curr_chunk_titles = []
+    with open(index_filename, 'r', encoding='utf-8') as index_file:
+        for line in index_file:
+            start_byte, _, curr_page_title = line.rstrip("\n").split(":", 2)
+            start_byte = int(start_byte)
+            # First chunk is offset by non-zero value
+            if prev_start_byte is None:
+                prev_start_byte = start_byte
+            # end of chunk
+            if start_byte != prev_start_byte:
+                for title in curr_chunk_titles:
+                    yield title, prev_start_byte, start_byte - prev_start_byte
+                prev_start_byte = start_byte
+                curr_chunk_titles = []
+            curr_chunk_titles.append(curr_page_title)
+    # The last chunk runs to the end of the dump, a length of -1 reads to the end of the file
+    for title in curr_chunk_titles:
+        yield title, prev_start_byte, -1
+
+
+def read_dump_chunks(index_filename: str) -> Iterable[tuple[int, int]]:
+    """ Yield the (start_byte, data_length) of every chunk of the dump, in order """
+    previous = None
+    for _, start_byte, data_length in read_multistream_index(index_filename):
+        if (start_byte, data_length) != previous:
+            previous = (start_byte, data_length)
+            yield previous
+
+
+def build_title_index(index_filename: str, output_path: str):
+    """ One time conversion of a multistream index text file into a title index """
+    write_title_index(read_multistream_index(index_filename), output_path)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert a wikipedia multistream index into a memory mapped title index")
+    parser.add_argument("index_file", help="path to the pages-articles-multistream-index.txt file")
+    parser.add_argument("output", help="path to write the title index to")
+    args = parser.parse_args()
+    build_title_index(args.index_file, args.output)
+    print(f"Wrote {len(TitleIndex(args.output))} titles to {args.output}")
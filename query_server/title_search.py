@@ -0,0 +1,288 @@
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import wikitextparser as wtp
+from typing import Optional
+from title_index import title_hash, read_dump_chunks
+from wikidump import iter_pages_from_chunk
+
+MAGIC = b"WIKIBM25"
+# magic, document count, term count, posting count, size of the title string table, average document length
+HEADER = struct.Struct("<8sQQQQd")
+POSTING = np.dtype([("term", "<u8"), ("doc", "<u4"), ("tf", "<u2")])
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# Title terms count this many times towards a document's term frequencies
+TITLE_WEIGHT = 3
+# Only the start of the lead is indexed, it is where the defining sentence of an article lives
+LEAD_CHARS = 2000
+# Postings are spilled into this many files partitioned by the top bits of the term hash
+PARTITION_BITS = 6
+SPILL_POSTINGS = 16 * 1024 * 1024
+
+TOKEN_PATTERN = re.compile(r"\w+")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has he in is it its of on or that the this to was were which with who".split())
+SKIPPED_NAMESPACES = frozenset(["Wikipedia", "File", "Image", "Category", "Template", "Portal", "Draft", "Module",
+                                "MediaWiki", "Help", "Book", "TimedText", "Special", "User"])
+REDIRECT_PATTERN = re.compile(r"#redirect\s*:?\s*\[\[([^\]|#]+)", re.IGNORECASE)
+
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def _normalize_title(title: str) -> str:
+    title = title.replace("_", " ").strip()
+    return title[:1].upper() + title[1:]
+
+
+class TitleSearch():
+    """ A read only, memory mapped BM25 index over page titles and lead paragraphs, used in place of the wikipedia
+        search API so the fallback path runs offline.
+
+        The file is laid out as a header followed by:
+            term hashes (uint64, sorted), posting offsets (int64, terms + 1), title offsets (int64, documents + 1),
+            posting document ids (uint32), document lengths (uint32), posting term frequencies (uint16)
+        and finally a utf-8 string table of the title each document resolves to.
+
+        Redirects are indexed as extra documents holding the redirect title and resolving to the target page,
+        so a search for an alias finds the article.
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n_docs, n_terms, n_postings, _, avgdl = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a title search index")
+        self.n_docs = n_docs
+        self.avgdl = avgdl
+
+        offset = HEADER.size
+        self._terms = np.frombuffer(self._mmap, dtype=np.uint64, count=n_terms, offset=offset)
+        offset += 8 * n_terms
+        self._posting_offsets = np.frombuffer(self._mmap, dtype=np.int64, count=n_terms + 1, offset=offset)
+        offset += 8 * (n_terms + 1)
+        self._title_offsets = np.frombuffer(self._mmap, dtype=np.int64, count=n_docs + 1, offset=offset)
+        offset += 8 * (n_docs + 1)
+        self._docs = np.frombuffer(self._mmap, dtype=np.uint32, count=n_postings, offset=offset)
+        offset += 4 * n_postings
+        self._doc_lengths = np.frombuffer(self._mmap, dtype=np.uint32, count=n_docs, offset=offset)
+        offset += 4 * n_docs
+        self._tfs = np.frombuffer(self._mmap, dtype=np.uint16, count=n_postings, offset=offset)
+        offset += 2 * n_postings
+        self._titles_start = offset
+
+    def __len__(self) -> int:
+        return self.n_docs
+
+    def search(self, query: str, results: int = 10) -> list[str]:
+        """ Get the titles of up to results pages that best match the query, best first """
+        docs, scores = [], []
+        for term in set(tokenize(query)):
+            h = np.uint64(title_hash(term))
+            i = int(np.searchsorted(self._terms, h))
+            if i == len(self._terms) or self._terms[i] != h:
+                continue
+            start, end = int(self._posting_offsets[i]), int(self._posting_offsets[i + 1])
+            term_docs = self._docs[start:end]
+            tfs = self._tfs[start:end].astype(np.float32)
+            idf = np.log(1 + (self.n_docs - (end - start) + 0.5) / ((end - start) + 0.5))
+            norm = K1 * (1 - B + B * self._doc_lengths[term_docs] / self.avgdl)
+            docs.append(term_docs)
+            scores.append(idf * tfs * (K1 + 1) / (tfs + norm))
+        if len(docs) == 0:
+            return []
+
+        matched, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores))
+        # Several redirects can resolve to the same page so take a few extra before removing duplicates
+        top = min(len(totals), results * 4)
+        best = np.argpartition(-totals, top - 1)[:top]
+        best = best[np.argsort(-totals[best], kind='stable')]
+        titles = []
+        for doc in matched[best]:
+            title = self._title_at(int(doc))
+            if title not in titles:
+                titles.append(title)
+            if len(titles) == results:
+                break
+        return titles
+
+    def _title_at(self, i: int) -> str:
+        start = self._titles_start + int(self._title_offsets[i])
+        end = self._titles_start + int(self._title_offsets[i + 1])
+        return self._mmap[start:end].decode("utf-8")
+
+
+def page_document(title: str, text: str) -> Optional[tuple[str, dict[int, int], int]]:
+    """ Turn a page into (resolved title, term hash -> frequency, length) or None if it should not be searchable """
+    namespace, colon, _ = title.partition(":")
+    if colon and namespace in SKIPPED_NAMESPACES:
+        return None
+    counts: dict[int, int] = {}
+    length = 0
+    for token in tokenize(title):
+        h = title_hash(token)
+        counts[h] = counts.get(h, 0) + TITLE_WEIGHT
+        length += TITLE_WEIGHT
+
+    redirect = REDIRECT_PATTERN.match(text.lstrip())
+    if redirect is not None:
+        return _normalize_title(redirect.group(1)), counts, length
+
+    lead = text.split("\n==", 1)[0][:LEAD_CHARS]
+    try:
+        lead = wtp.parse(lead).plain_text()
+    except Exception:
+        # Truncated markup occasionally trips the parser, the raw text still holds the words
+        pass
+    for token in tokenize(lead):
+        h = title_hash(token)
+        counts[h] = counts.get(h, 0) + 1
+        length += 1
+    return title, counts, length
+
+
+def _index_chunk(wiki_filename: str, start_byte: int, data_length: int) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """ Runs in a worker process, returns the titles and lengths of the chunk's documents and their postings
+        with document ids local to the chunk.
+    """
+    with open(wiki_filename, 'rb') as wiki_file:
+        wiki_file.seek(start_byte)
+        data = wiki_file.read(data_length if data_length >= 0 else -1)
+    titles, lengths, postings = [], array('I'), []
+    for title, text in iter_pages_from_chunk(data):
+        document = page_document(title, text)
+        if document is None:
+            continue
+        resolved_title, counts, length = document
+        doc = len(titles)
+        titles.append(resolved_title)
+        lengths.append(min(length, 0xFFFFFFFF))
+        terms = np.fromiter(counts.keys(), dtype=np.uint64, count=len(counts))
+        page_postings = np.empty(len(counts), dtype=POSTING)
+        page_postings["term"] = terms
+        page_postings["doc"] = doc
+        page_postings["tf"] = np.minimum(np.fromiter(counts.values(), dtype=np.int64, count=len(counts)), 0xFFFF)
+        postings.append(page_postings)
+    return titles, np.frombuffer(lengths, dtype=np.uint32), np.concatenate(postings) if postings else np.empty(0, dtype=POSTING)
+
+
+class _PostingSpill():
+    """ Buffers postings in memory and appends them to one file per hash range, so building never holds the
+        whole inverted index in memory and each range can be sorted on its own.
+    """
+
+    def __init__(self, directory: str):
+        self.paths = [os.path.join(directory, f"{p:03d}.postings") for p in range(1 << PARTITION_BITS)]
+        self._buffers: list[list[np.ndarray]] = [[] for _ in self.paths]
+        self._buffered = 0
+
+    def add(self, postings: np.ndarray):
+        partitions = (postings["term"] >> np.uint64(64 - PARTITION_BITS)).astype(np.int64)
+        order = np.argsort(partitions, kind='stable')
+        postings, partitions = postings[order], partitions[order]
+        bounds = np.searchsorted(partitions, np.arange(len(self.paths) + 1))
+        for p in range(len(self.paths)):
+            if bounds[p] < bounds[p + 1]:
+                self._buffers[p].append(postings[bounds[p]:bounds[p + 1]])
+        self._buffered += len(postings)
+        if self._buffered >= SPILL_POSTINGS:
+            self.flush()
+
+    def flush(self):
+        for path, buffer in zip(self.paths, self._buffers):
+            if len(buffer) > 0:
+                with open(path, 'ab') as spill_file:
+                    np.concatenate(buffer).tofile(spill_file)
+                buffer.clear()
+        self._buffered = 0
+
+
+def _append_file(out, path: str):
+    with open(path, 'rb') as part:
+        shutil.copyfileobj(part, out)
+
+
+def build_title_search(index_filename: str, wiki_filename: str, output_path: str, workers: int = os.cpu_count()):
+    """ One time build of a title search index from the multistream dump.
+        Chunks are tokenized in worker processes, postings are spilled to disk by hash range and each range is
+        sorted separately, then everything is written to a temporary file and moved into place.
+    """
+    work_dir = tempfile.mkdtemp(prefix="title_search_", dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        spill = _PostingSpill(work_dir)
+        titles_path = os.path.join(work_dir, "titles")
+        doc_lengths, title_lengths = array('I'), array('q')
+        with open(titles_path, 'wb') as titles_file, ProcessPoolExecutor(workers) as pool:
+            chunks = list(read_dump_chunks(index_filename))
+            results = pool.map(_index_chunk, [wiki_filename] * len(chunks), *zip(*chunks), chunksize=16)
+            for i, (titles, lengths, postings) in enumerate(results):
+                postings["doc"] += len(doc_lengths)
+                spill.add(postings)
+                doc_lengths.extend(lengths.tolist())
+                for title in titles:
+                    encoded_title = title.encode("utf-8")
+                    titles_file.write(encoded_title)
+                    title_lengths.append(len(encoded_title))
+                if i % 1000 == 0:
+                    print(f"Indexed {i}/{len(chunks)} chunks, {len(doc_lengths)} documents")
+        spill.flush()
+
+        # Sort each hash range by (term, doc) and lay its postings out contiguously, ranges are already in hash order
+        docs_path, tfs_path = os.path.join(work_dir, "docs"), os.path.join(work_dir, "tfs")
+        terms, term_counts = [], []
+        with open(docs_path, 'wb') as docs_file, open(tfs_path, 'wb') as tfs_file:
+            for path in spill.paths:
+                if not os.path.exists(path):
+                    continue
+                postings = np.fromfile(path, dtype=POSTING)
+                os.remove(path)
+                postings = postings[np.lexsort((postings["doc"], postings["term"]))]
+                starts = np.flatnonzero(np.concatenate([[True], postings["term"][1:] != postings["term"][:-1]]))
+                terms.append(postings["term"][starts])
+                term_counts.append(np.diff(np.concatenate([starts, [len(postings)]])))
+                postings["doc"].tofile(docs_file)
+                postings["tf"].tofile(tfs_file)
+
+        terms = np.concatenate(terms) if terms else np.empty(0, dtype=np.uint64)
+        posting_offsets = np.concatenate([[0], np.cumsum(np.concatenate(term_counts))]).astype(np.int64) \
+            if term_counts else np.zeros(1, dtype=np.int64)
+        doc_lengths = np.frombuffer(doc_lengths, dtype=np.uint32)
+        title_offsets = np.concatenate([[0], np.cumsum(np.frombuffer(title_lengths, dtype=np.int64))]).astype(np.int64)
+        avgdl = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+
+        tmp_path = output_path + ".tmp"
+        with open(tmp_path, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, len(doc_lengths), len(terms), int(posting_offsets[-1]), int(title_offsets[-1]), avgdl))
+            out.write(terms.tobytes())
+            out.write(posting_offsets.tobytes())
+            out.write(title_offsets.tobytes())
+            _append_file(out, docs_path)
+            out.write(doc_lengths.tobytes())
+            _append_file(out, tfs_path)
+            _append_file(out, titles_path)
+        os.replace(tmp_path, output_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    import argparse
+    from config import settings
+    parser = argparse.ArgumentParser(description="Build the offline BM25 title search index from the local wikipedia dump")
+    parser.add_argument("--output", default=settings.title_search_path, help="path to write the search index to")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes used to decompress and tokenize chunks")
+    args = parser.parse_args()
+    build_title_search(settings.wikipedia_local_index_path, settings.wikipedia_local_dump_path, args.output, args.workers)
+    print(f"Indexed {len(TitleSearch(args.output))} documents into {args.output}")
@@ -1,4 +1,11 @@
 # The maximum size of completions
 MAX_COMPLETION_TOKENS = 300
 # The maximum token size of an embedded section
-MAX_SECTION_TOKENS = 2000
\ No newline at end of file
+MAX_SECTION_TOKENS = 2000
+# Bounds on a single embedding request when batching sections from many pages
+MAX_EMBEDDING_BATCH_TOKENS = 32000
+MAX_EMBEDDING_BATCH_ITEMS = 256
+# Budget for the verbatim chat turns sent when rewriting a follow up question, older turns are summarized
+MAX_HISTORY_TOKENS = 1000
+# The maximum size of the rolling summary of older chat turns
+MAX_SUMMARY_TOKENS = 200
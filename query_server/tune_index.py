@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+import time
+import faiss
+import numpy as np
+from config import settings
+from index import Index, DEFAULT_TRAIN_SIZE, parse_search_params
+
+os.environ["OPENAI_API_KEY"] = settings.openai_api_key
+
+NPROBE_VALUES = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+EF_SEARCH_VALUES = [16, 32, 64, 128, 256, 512]
+
+
+def param_grid(index_spec: str) -> list[dict]:
+    """ The search time parameters worth sweeping for a spec """
+    if "IVF" in index_spec:
+        return [{"nprobe": nprobe} for nprobe in NPROBE_VALUES]
+    if "HNSW" in index_spec:
+        return [{"efSearch": ef_search} for ef_search in EF_SEARCH_VALUES]
+    return [{}]
+
+
+def sample_queries(vectors: np.ndarray, n_queries: int, noise: float = 0.01) -> np.ndarray:
+    """ Perturbed copies of stored vectors, a stand in when no real query embeddings are available """
+    rng = np.random.default_rng(1)
+    queries = vectors[rng.choice(len(vectors), min(n_queries, len(vectors)), replace=False)]
+    queries = queries + rng.normal(scale=noise, size=queries.shape).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def recall_report(vectors: np.ndarray, queries: np.ndarray, index_specs: list[str], k: int = 4,
+                  train_size: int = DEFAULT_TRAIN_SIZE) -> list[dict]:
+    """ Measure recall@k and per query latency of each spec and search parameter against the flat index """
+    flat = faiss.IndexFlatIP(vectors.shape[1])
+    flat.add(vectors)
+    _, ground_truth = flat.search(queries, k)
+
+    results = []
+    for index_spec in index_specs:
+        start = time.perf_counter()
+        index = Index.from_vectors(vectors, index_spec, train_size=train_size)
+        build_seconds = time.perf_counter() - start
+        for params in param_grid(index_spec):
+            index.set_search_params(**params)
+            latencies = []
+            found = np.empty_like(ground_truth)
+            # Search one query at a time, that is what the server does
+            for i, query in enumerate(queries):
+                start = time.perf_counter()
+                _, I = index._faiss_index.search(query.reshape(1, -1), k)
+                latencies.append(time.perf_counter() - start)
+                found[i] = I[0]
+            recall = np.mean([len(set(found[i]) & set(ground_truth[i])) / k for i in range(len(queries))])
+            results.append({
+                "index_spec": index_spec,
+                "search_params": params,
+                "recall": float(recall),
+                "p50_ms": float(np.percentile(latencies, 50) * 1000),
+                "p99_ms": float(np.percentile(latencies, 99) * 1000),
+                "build_seconds": build_seconds,
+            })
+            print(f"{index_spec:<24} {json.dumps(params):<20} recall@{k}={recall:.3f} "
+                  f"p50={results[-1]['p50_ms']:.2f}ms p99={results[-1]['p99_ms']:.2f}ms")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a flat index to an approximate one, or compare approximate indices against it")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="build an index of a new spec from the vectors of a flat index")
+    build_parser.add_argument("flat_index", help="path to a saved flat index")
+    build_parser.add_argument("index_spec", help='faiss index_factory spec, e.g. "IVF4096,PQ64"')
+    build_parser.add_argument("output", help="path to save the new index to")
+    build_parser.add_argument("--train-size", type=int, default=DEFAULT_TRAIN_SIZE)
+    build_parser.add_argument("--search-params", default="", help='e.g. "nprobe=32"')
+
+    report_parser = subparsers.add_parser("report", help="recall vs latency of index specs against the flat index")
+    report_parser.add_argument("flat_index", help="path to a saved flat index")
+    report_parser.add_argument("index_specs", nargs="+", help='faiss index_factory specs, e.g. "IVF1024,Flat" "HNSW32"')
+    report_parser.add_argument("--queries", help="a .npy file of real query embeddings, defaults to perturbed stored vectors")
+    report_parser.add_argument("--n-queries", type=int, default=1000)
+    report_parser.add_argument("--k", type=int, default=4)
+    report_parser.add_argument("--train-size", type=int, default=DEFAULT_TRAIN_SIZE)
+    report_parser.add_argument("--output", help="write the report as json")
+    args = parser.parse_args()
+
+    ids, vectors = Index(args.flat_index).reconstruct_all()
+    if args.command == "build":
+        index = Index.from_vectors(vectors, args.index_spec, ids=ids, train_size=args.train_size)
+        index.set_search_params(**parse_search_params(args.search_params))
+        index.save_to_path(args.output)
+        print(f"Saved {index.ntotal} vectors to {args.output}")
+    else:
+        queries = np.load(args.queries).astype(np.float32) if args.queries else sample_queries(vectors, args.n_queries)
+        report = recall_report(vectors, queries, args.index_specs, k=args.k, train_size=args.train_size)
+        if args.output:
+            with open(args.output, 'w') as report_file:
+                json.dump(report, report_file, indent=2)
@@ -1,31 +1,63 @@
+import asyncio
+import os
+import queue
+import shutil
+import threading
 import pandas as pd
 import wikipedia
-import csv
-import bz2
 import wikitextparser as wtp
-import bs4 as bs
-import tiktoken
-from typing import Optional, Union
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Callable, NamedTuple, Optional, Union
 from index import Index
-from nltk.tokenize import sent_tokenize
-from os import path
+from metrics import span, timed
 from config import settings
 from token_consts import MAX_SECTION_TOKENS
-import pickle
-
-WIKI_INDEX_FILE = 'wiki_index.pckl'
-DISCARD_CATEGORIES = set(['See also', 'References', 'External links', 'Further reading', "Footnotes",
-    "Bibliography", "Sources", "Citations", "Literature", "Footnotes", "Notes and references",
-    "Photo gallery", "Works cited", "Photos", "Gallery", "Notes", "References and sources",
-    "References and notes", "General and cited references"])
-
-# TODO: encoder should be parameterized
-ENCODING = "cl100k_base"
-tokenizer = tiktoken.get_encoding(ENCODING)
+from sections import SECTION_COLUMNS, encode_with_split, format_document_for_indexing
+from section_corpus import SectionCorpus
+from section_store import OverlaySectionStore, Section, SectionStore, freeze_store, is_sqlite_file
+from title_search import TitleSearch
+from wikidump import WikipediaDump
 
 path_to_wikipedia_index = settings.wikipedia_local_index_path
 path_to_wikipedia_data = settings.wikipedia_local_dump_path
 
+# A snapshot root holds a directory per saved snapshot and a link to the published one
+CURRENT_SNAPSHOT = "current"
+SNAPSHOT_SECTIONS_FILE = "sections.sqlite"
+SNAPSHOT_INDEX_DIR = "index"
+
+
+def resolve_snapshot(snapshot_root: str) -> tuple[str, str]:
+    """ Get the (store path, index path) of the published snapshot under snapshot_root.
+        The link is resolved here, so a process keeps serving the snapshot it opened when a newer one is published.
+    """
+    directory = os.path.realpath(os.path.join(snapshot_root, CURRENT_SNAPSHOT))
+    return os.path.join(directory, SNAPSHOT_SECTIONS_FILE), os.path.join(directory, SNAPSHOT_INDEX_DIR)
+
+
+def open_local_dump() -> WikipediaDump:
+    """ Open the local copy of wikipedia configured in settings """
+    return WikipediaDump(path_to_wikipedia_index, path_to_wikipedia_data,
+                         chunk_cache_bytes=settings.chunk_cache_bytes, page_cache_bytes=settings.page_cache_bytes)
+
+
+class _PageWrite(NamedTuple):
+    title: str
+    entries: list[tuple]
+    # Resolves to the number of the page's sections that were added
+    done: Future
+
+
+class _Operation(NamedTuple):
+    apply: Callable[[], object]
+    done: Future
+
+
+# Stops the writer thread
+_STOP = object()
+
+
 class WikipediaDatabase():
     """ A wikipedia database allows for:
 
@@ -33,161 +65,342 @@ class WikipediaDatabase():
             2. querying for full pages by page id or title
             3. searching for relevant articles against a query
 
-        For now it is just a simple wrapper over a local pandas df of wikipedia sections as well as a local copy of wikipedia and the NN index.
-        Ideally we should split this class to seperate the datastore from the local wikipedia copy.
+        For now it is just a simple wrapper over a SectionStore of wikipedia sections as well as a local copy of wikipedia and the NN index.
+        The local copy of wikipedia lives in WikipediaDump.
+
+        Every change to the store and the index is applied by a single writer thread. Pages queued while it is
+        busy are embedded and added together, and a page already queued is not queued again. Sections are
+        published to the store before their vectors reach the index and leave it after, so any id a reader finds
+        in the index resolves to a section, and readers never wait for an embedding request.
+
+        Servers open the database read_only. The store file is then never written to, so any number of workers
+        can share it. Pages a worker adds go to a store in its memory, next to the vectors it adds to its index,
+        and both last as long as the process. Builds open it writable, which adds to the store file as they go
+        and drops rows the saved index does not have when it is opened, see _reconcile. Upgrading and migrating
+        stores is left to builds too, a read_only database refuses a store that needs either.
+
+        Published snapshots are opened immutable as well, see save_snapshot.
     """
     index: Index
 
-    def __init__(self, dataframe_path: Optional[str] = None, index_path: Optional[str] = None):
-        # Vector datastore
-        if dataframe_path:
-            self.df: pd.DataFrame = pd.read_pickle(dataframe_path)
-            # self.df.drop("embeddings", axis=1, inplace=True)
-        else:
-            self.df = pd.DataFrame([], columns=["title", "section", "section_index", "permalink", "content", "tokens"])
-        
+    def __init__(self, store_path: Optional[str] = None, index_path: Optional[str] = None, read_only: bool = False,
+                 immutable: bool = False):
         self.index = Index(index_path)
+        self.read_only = read_only or immutable
 
-        # Wikipedia documentstore
-        self.index_filename = path_to_wikipedia_index
-        self.wiki_filename = path_to_wikipedia_data
-        # HACK: this is just a quick hack to read the index and store. We should do this better
-        if not path.exists(WIKI_INDEX_FILE):
-            self.wiki_index = {}
-            self._build_wiki_index()
-            with open(WIKI_INDEX_FILE, 'wb') as handle:
-                pickle.dump(self.wiki_index, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        # Vector datastore, sections are keyed by the same ids as their vectors in the index.
+        # Without a path the store lives in memory until it is saved.
+        if store_path and self.read_only:
+            self.store = OverlaySectionStore(self._open_store(store_path, read_only=True, immutable=immutable))
         else:
-            print("Loading wiki index from file")
-            with open(WIKI_INDEX_FILE, 'rb') as handle:
-                self.wiki_index = pickle.load(handle)
+            self.store = self._open_store(store_path) if store_path else SectionStore()
+        self.index.sparse_index = self.store
+        if not self.read_only:
+            self._reconcile()
+        # Ids are only unique within this process when read_only, which is all the in memory store needs
+        self._next_id = max(self.store.next_id(), int(self.index.ids().max()) + 1 if self.index.ntotal > 0 else 0)
+        self._writes: queue.Queue = queue.Queue()
+        # Pages queued or being written by title, guarded by _writing_lock
+        self._writing: dict[str, Future] = {}
+        self._writing_lock = threading.Lock()
+        self._writer = threading.Thread(target=self._write_loop, name="wikidb-writer", daemon=True)
+        self._writer.start()
+
+        # Wikipedia documentstore
+        self.dump = open_local_dump()
+        self.title_search = TitleSearch(settings.title_search_path) if os.path.exists(settings.title_search_path) else None
+        if self.title_search is None:
+            print(f"No title search index at {settings.title_search_path}, searching with the wikipedia API")
+        self.corpus = SectionCorpus(settings.section_corpus_path) if os.path.exists(settings.section_corpus_path) else None
 
     # TODO __gettiem__
-    def get_section_by_ids(self, ids: list[int]):
+    def get_section_by_ids(self, ids: list[int]) -> list[Section]:
         """ Get a section by ids """
-        return self.df.iloc[ids]
-    
-    def get_section_by_id(self, id: int):
+        return self.store.get_many(ids)
+
+    def get_section_by_id(self, id: int) -> Optional[Section]:
         """Get a section by id """
-        return self.get_section_by_ids([id]).iloc[0]
+        return self.store.get(id)
 
+    @timed("wikipedia_search")
     def search(self, query: str) -> list[str]:
-        """ Search wikipedia api for articles relevant to a task """
+        """ Search for articles relevant to a task, locally when a title search index has been built """
+        if self.title_search is not None:
+            return self.title_search.search(query)
         return wikipedia.search(query)
 
+    @timed("get_page")
     def get_page(self, page_title: str) -> Union[wtp.WikiText, None]:
         """ Get the wikitext for a page given its title """
-        try:
-            start_byte, data_length = self._search_index(page_title)
-        except KeyError:
+        return self.dump.get_page(page_title)
+
+    def get_page_entries(self, page_title: str) -> Optional[list[tuple]]:
+        """ Get a page split into section entries, from the section corpus when it has the page """
+        if self.corpus is not None:
+            entries = self.corpus.get_entries(page_title)
+            if entries is not None:
+                return entries
+        page_content = self.get_page(page_title)
+        if page_content is None:
             return None
-        chunk_xml = self._decompress_chunk(start_byte, data_length)
-        parsed_page = self._extract_page_from_chunk(page_title, chunk_xml)
-        return parsed_page
+        return self._format_document_for_indexing(page_title, page_content)
+
+    def cache_stats(self) -> dict:
+        """ Hit and miss counters for the chunk and page caches """
+        return self.dump.cache_stats()
+
+    def has_page(self, page_title: str) -> bool:
+        return self.store.has_title(page_title)
+
+    def queued_page_count(self) -> int:
+        """ The number of pages queued or being written """
+        return len(self._writing)
+
+    def is_page_queued(self, page_title: str) -> bool:
+        """ Whether the page is waiting for or being written by the writer """
+        return page_title in self._writing
+
+    def page_titles(self) -> set[str]:
+        return self.store.titles()
 
     def add_page(self, page_title: str, page_content: wtp.WikiText):
         """Add a page to the vector datastore """
-        # Don't add existing pages
-        if page_title in self.df['title'].values:
+        self.add_pages([(page_title, page_content)])
+
+    def add_pages(self, pages: list[tuple[str, wtp.WikiText]]):
+        """ Add several pages to the vector datastore, their sections are embedded together in as few requests as possible """
+        self.add_page_entries([(page_title, self._format_document_for_indexing(page_title, page_content))
+                               for page_title, page_content in pages if not self.is_page_queued(page_title) and not self.has_page(page_title)])
+
+    def add_titles(self, page_titles: list[str]):
+        """ Add pages by title, reading their sections from the section corpus or the dump """
+        pages = []
+        for page_title in page_titles:
+            if self.is_page_queued(page_title) or self.has_page(page_title):
+                continue
+            entries = self.get_page_entries(page_title)
+            if entries is not None:
+                pages.append((page_title, entries))
+        self.add_page_entries(pages)
+
+    def add_page_entries(self, pages: list[tuple[str, list[tuple]]]):
+        """ Add pages that were already split into section entries, e.g. by a worker process, embedding them together.
+            Returns once every page is in the datastore, including pages another caller had already queued.
+        """
+        for done in self.submit_page_entries(pages):
+            done.result()
+
+    async def aadd_page_entries(self, pages: list[tuple[str, list[tuple]]]):
+        """ Like add_page_entries without holding a thread while the writer works.
+            Cancelling the caller does not cancel the writes, queued pages are still added.
+        """
+        writes = self.submit_page_entries(pages)
+        if len(writes) > 0:
+            await asyncio.shield(asyncio.gather(*(asyncio.wrap_future(done) for done in writes)))
+
+    def submit_page_entries(self, pages: list[tuple[str, list[tuple]]]) -> list[Future]:
+        """ Queue pages for the writer, returns a future per page that is being added.
+            Pages that are already in the datastore are skipped and pages that are already queued share their future.
+        """
+        writes = []
+        with self._writing_lock:
+            for page_title, page_entries in pages:
+                if page_title in self._writing:
+                    writes.append(self._writing[page_title])
+                elif len(page_entries) > 0 and not self.has_page(page_title):
+                    write = _PageWrite(page_title, page_entries, Future())
+                    self._writing[page_title] = write.done
+                    self._writes.put(write)
+                    writes.append(write.done)
+        return writes
+
+    def add_embedded_entries(self, entries: list[tuple], embeddings: list[list[float]]):
+        """ Add already embedded section entries to the vector datastore, entries and embeddings must line up """
+        if len(entries) == 0:
             return
-        print(f"Adding page: {page_title}")
-        entries = self._format_document_for_indexing(page_title, page_content)        
-        did_add = self.index.add_to_index([entry[4] for entry in entries])
-        if did_add:
-            self.df = pd.concat([self.df, pd.DataFrame(entries, columns=["title", "section", "section_index", "permalink", "content", "tokens"])])
+        self._on_writer(lambda: self._publish(entries, embeddings))
+
+    def remove_page(self, page_title: str) -> int:
+        """ Remove a page's sections from the index and the datastore, returns the number of sections removed """
+        return self._on_writer(lambda: self._remove_page(page_title))
+
+    def update_page(self, page_title: str, page_content: Optional[wtp.WikiText] = None) -> bool:
+        """ Replace a page's sections in place, e.g. to refresh a stale article.
+            The new sections are embedded before the old ones are removed, so a failure leaves the old page intact.
+        """
+        if page_content is None:
+            entries = self.get_page_entries(page_title)
+            if entries is None:
+                return False
+        else:
+            entries = self._format_document_for_indexing(page_title, page_content)
+        embeddings = self.index.batcher.embed([entry[4] for entry in entries], [entry[5] for entry in entries])
+        if any(embedding is None for embedding in embeddings):
+            print(f"ERROR failed to embed {page_title}, keeping the current version")
+            return False
+
+        def replace():
+            self._remove_page(page_title)
+            self._publish(entries, embeddings)
+        self._on_writer(replace)
+        return True
+
+    def close(self):
+        """ Stop the writer once the writes queued so far are applied """
+        if self._writer.is_alive():
+            self._writes.put(_STOP)
+            self._writer.join()
+
+    def _on_writer(self, apply: Callable[[], object]):
+        """ Run apply on the writer thread in order with queued pages and return its result """
+        operation = _Operation(apply, Future())
+        self._writes.put(operation)
+        return operation.done.result()
 
-    def save(self, dataframe_path: str, index_path: str):
-        self.index.save_to_path(index_path)
-        self.df.to_pickle(dataframe_path)
+    def _write_loop(self):
+        while True:
+            writes = [self._writes.get()]
+            # Everything queued meanwhile goes into the same batch
+            while not self._writes.empty():
+                writes.append(self._writes.get_nowait())
+            pages: list[_PageWrite] = []
+            for write in writes:
+                if isinstance(write, _PageWrite):
+                    pages.append(write)
+                    continue
+                # Operations run after the pages queued before them
+                self._write_pages(pages)
+                pages = []
+                if write is _STOP:
+                    return
+                try:
+                    write.done.set_result(write.apply())
+                except Exception as e:
+                    write.done.set_exception(e)
+            self._write_pages(pages)
+
+    def _write_pages(self, pages: list[_PageWrite]):
+        if len(pages) == 0:
+            return
+        try:
+            for page in pages:
+                print(f"Adding page: {page.title}")
+            entries = [entry for page in pages for entry in page.entries]
+            with span("embed_sections"):
+                embeddings = self.index.batcher.embed([entry[4] for entry in entries], [entry[5] for entry in entries])
+            added = [(entry, embedding) for entry, embedding in zip(entries, embeddings) if embedding is not None]
+            if len(added) < len(entries):
+                failed_titles = set(entry[0] for entry, embedding in zip(entries, embeddings) if embedding is None)
+                print(f"ERROR failed to embed {len(entries) - len(added)} sections of {failed_titles}")
+            if len(added) > 0:
+                self._publish([entry for entry, _ in added], [embedding for _, embedding in added])
+            counts = {page.title: 0 for page in pages}
+            for entry, _ in added:
+                counts[entry[0]] += 1
+            results = [(page.done, counts[page.title], None) for page in pages]
+        except Exception as e:
+            results = [(page.done, None, e) for page in pages]
+        with self._writing_lock:
+            for page in pages:
+                del self._writing[page.title]
+        for done, count, error in results:
+            if error is not None:
+                done.set_exception(error)
+            else:
+                done.set_result(count)
+
+    @timed("publish")
+    def _publish(self, entries: list[tuple], embeddings: list[list[float]]):
+        # Store first, an id the index returns must already resolve to its section
+        ids = list(range(self._next_id, self._next_id + len(entries)))
+        self._next_id += len(entries)
+        self.store.append(ids, entries)
+        self.index.add_embeddings(embeddings, ids)
+
+    def _remove_page(self, page_title: str) -> int:
+        ids = self.store.ids_for_title(page_title)
+        if len(ids) == 0:
+            return 0
+        if self.read_only and self.store.in_base(ids):
+            raise ValueError(f"{page_title} is in the read only store {self.store.path}, update it with a writable database")
+        # Index first, the reverse of _publish
+        self.index.remove_ids(ids)
+        self.store.remove_ids(ids)
+        return len(ids)
+
+    def save(self, store_path: str, index_path: str):
+        """ Save the index, the store only has to be copied when saving somewhere new since its rows are committed as they are added.
+            Runs on the writer so the two are saved at the same point.
+        """
+        def save():
+            self.index.save_to_path(index_path)
+            self.store.save_to_path(store_path)
+        self._on_writer(save)
+
+    def save_snapshot(self, snapshot_root: str, keep: int = 2) -> str:
+        """ Save the store and the index into a new directory under snapshot_root and publish it by swapping the
+            current link, which is atomic, so a process starting meanwhile opens either snapshot whole. The keep most
+            recent snapshots are kept for processes still serving an older one. Returns the new snapshot's directory.
+            The snapshot's store is never written again, so it is frozen here for servers to open immutable.
+        """
+        def save() -> str:
+            os.makedirs(snapshot_root, exist_ok=True)
+            name = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+            tmp_directory = os.path.join(snapshot_root, name + ".tmp")
+            os.makedirs(tmp_directory)
+            self.store.save_to_path(os.path.join(tmp_directory, SNAPSHOT_SECTIONS_FILE))
+            freeze_store(os.path.join(tmp_directory, SNAPSHOT_SECTIONS_FILE))
+            self.index.save_snapshot(os.path.join(tmp_directory, SNAPSHOT_INDEX_DIR))
+            os.rename(tmp_directory, os.path.join(snapshot_root, name))
+
+            tmp_link = os.path.join(snapshot_root, CURRENT_SNAPSHOT + ".tmp")
+            if os.path.lexists(tmp_link):
+                os.remove(tmp_link)
+            os.symlink(name, tmp_link)
+            os.replace(tmp_link, os.path.join(snapshot_root, CURRENT_SNAPSHOT))
+
+            snapshots = sorted(entry.name for entry in os.scandir(snapshot_root)
+                               if entry.is_dir(follow_symlinks=False) and not entry.name.endswith(".tmp"))
+            for old_name in snapshots[:-keep]:
+                shutil.rmtree(os.path.join(snapshot_root, old_name), ignore_errors=True)
+            return os.path.join(snapshot_root, name)
+        return self._on_writer(save)
+
+    def _open_store(self, store_path: str, read_only: bool = False, immutable: bool = False) -> SectionStore:
+        if read_only and not os.path.exists(store_path):
+            raise FileNotFoundError(f"No section store at {store_path}, build one with build_indices.py")
+        if not os.path.exists(store_path) or is_sqlite_file(store_path):
+            return SectionStore(store_path, read_only, immutable)
+        # Stores used to be pickled DataFrames, import them once into a store next to the pickle
+        migrated_path = store_path + ".sqlite"
+        if os.path.exists(migrated_path):
+            return SectionStore(migrated_path, read_only)
+        if read_only:
+            raise ValueError(f"{store_path} is a pickled store, open it once with a writable WikipediaDatabase to migrate it")
+        print(f"Migrating {store_path} to {migrated_path}")
+        df: pd.DataFrame = pd.read_pickle(store_path)
+        if self.index.migrated_from_positional:
+            # The old index used row positions as ids
+            df = df.reset_index(drop=True)
+        return SectionStore.from_dataframe(migrated_path, df[SECTION_COLUMNS])
+
+    def _reconcile(self):
+        """ Drop sections without vectors and vectors without sections, e.g. rows written after the last index save.
+            The id sets are compared rather than the counts, replacing a page leaves the counts equal.
+        """
+        index_ids = set(int(id) for id in self.index.ids())
+        store_ids = set(self.store.ids())
+        if len(store_ids - index_ids) > 0:
+            print(f"Removing {len(store_ids - index_ids)} sections that are not in the index")
+            self.store.remove_ids(list(store_ids - index_ids))
+        if len(index_ids - store_ids) > 0:
+            print(f"Removing {len(index_ids - store_ids)} vectors that are not in the store")
+            self.index.remove_ids(list(index_ids - store_ids))
 
     # TODO refactor this for treating index vs local wiki appropriately
     def _encode_with_split(self, section: str, max_tokens: int = MAX_SECTION_TOKENS):
-        """ Encodes and potentially splits a section into seperate sections on sentence boundries by max_tokens """
-        encoded_section = tokenizer.encode(section)
-        if len(encoded_section) >= max_tokens:
-            sentences = sent_tokenize(section.replace("\n", " "))
-            n_tokens = 0
-            prev_boundary = 0
-            result = []
-            for i, sentence in enumerate(sentences):
-                # Space is one token
-                n_tokens += 1 + len(tokenizer.encode(sentence))
-                if n_tokens >= max_tokens:
-                    max_length_sentence = " ".join(sentences[prev_boundary:i])
-                    encoded_max_length_sentence = tokenizer.encode(max_length_sentence)
-                    # Edge case where the entire sentence is unbrekable and too long
-                    if len(encoded_max_length_sentence) <= MAX_SECTION_TOKENS:
-                        result.append((max_length_sentence, encoded_max_length_sentence))
-                    n_tokens = 0
-                    prev_boundary = i
-                    
-            # Handle remaining
-            max_length_sentence = " ".join(sentences[prev_boundary:])
-            encoded_max_length_sentence = tokenizer.encode(max_length_sentence)
-            if len(encoded_max_length_sentence) <= MAX_SECTION_TOKENS:
-                result.append((max_length_sentence, encoded_max_length_sentence))
-            
-            return result
-        return [(section, encoded_section)]
-
-
-    # TODO refactor this for treating documents as a class
-    def _format_document_for_indexing(self, page_title: str, page_content: wtp.WikiText):
-        res = []
-        for section in page_content.sections:
-            if section.title == None or (section.title and section.title.strip() not in DISCARD_CATEGORIES):
-                # TODO: parse plain text, remove headings, format tables for ingestion, remove media references
-                encoded_sections = self._encode_with_split(section.plain_text())
-                section_index = 0
-                for split_section, encoded_section in encoded_sections:
-                    # TODO: The empty entry is the permalink, leave alone for now. artifact from port, remove later
-                    res.append((page_title, section.title, section_index, '', split_section, len(encoded_section)))
-                    section_index += 1
-        return res 
-
-    def _search_index(self, page_title: str) -> tuple[int, int]:
-        """ Search downloaded index for the btye range of the chunk containing the page """
-        return self.wiki_index[page_title]
-
-    def _build_wiki_index(self):
-        """ Load the wikipedia index which tells you which bz2 byte range to read into memory """
-        index_file = open(self.index_filename, 'r')
-        csv_reader = csv.reader(index_file, delimiter=':')
-        # A line is start_byte:id:name
-        prev_start_byte = None
-        curr_chunk_titles = []
-        for line in csv_reader:
-            curr_page_title = line[2]
-            start_byte = int(line[0])
-            # First chunk is offset by non-zero value
-            if prev_start_byte == None:
-                prev_start_byte = start_byte
-            # end of chunk
-            if start_byte != prev_start_byte:
-                for title in curr_chunk_titles:
-                    self.wiki_index[title] = (prev_start_byte, start_byte - prev_start_byte)
-                prev_start_byte = start_byte
-                curr_chunk_titles = []
-                curr_chunk_titles.append(curr_page_title)
-            else: 
-                curr_chunk_titles.append(curr_page_title)
-        index_file.close()
-
-    def _decompress_chunk(self, start_byte: int, data_length: int) -> str:
-        """ Read a chunk of the wikpedia dump """
-        with open(self.wiki_filename, 'rb') as wiki_file:
-            wiki_file.seek(start_byte)
-            data = wiki_file.read(data_length)
-        return bz2.decompress(data).decode("utf-8") 
-
-    def _extract_page_from_chunk(self, page_title: str, chunk_xml: str) -> wtp.WikiText:
-        """ Parse a chunk and return the page contents as WikiText for a given page title"""
-        soup = bs.BeautifulSoup(chunk_xml, "lxml")
-        pages = soup.find_all('page')
-        for page in pages:
-            if page.title.text == page_title:
-                text = page.find('text').text
-                return wtp.parse(text)
-        # TODO: handle this better
-        print(f'didnt find {page_title}')
+        """ Splits a section into (text, token count) pieces on sentence boundaries by max_tokens """
+        return encode_with_split(section, max_tokens)
 
+    def _format_document_for_indexing(self, page_title: str, page_content: wtp.WikiText):
+        return format_document_for_indexing(page_title, page_content)
@@ -0,0 +1,133 @@
+import bz2
+import os
+import wikitextparser as wtp
+from lxml import etree
+from os import path
+from typing import Iterator, Optional, Union
+from title_index import TitleIndex, build_title_index
+from cache import LRUCache
+from metrics import span
+
+WIKI_INDEX_FILE = 'wiki_index.bin'
+# How much compressed data to feed the decompressor at a time when streaming a chunk
+DECOMPRESS_BLOCK_SIZE = 64 * 1024
+
+
+def iter_pages_from_chunk(data: bytes) -> Iterator[tuple[str, str]]:
+    """ Stream (title, wikitext) for every page in a bz2 compressed chunk of the multistream dump.
+        Decompression and parsing are incremental, so a caller that stops iterating skips the rest of the chunk.
+    """
+    # A chunk is a run of <page> elements without a root. The first and last chunks also carry the
+    # <mediawiki> open and close tags, recover lets the parser ignore the unbalanced one.
+    parser = etree.XMLPullParser(events=('end',), tag='{*}page', recover=True, huge_tree=True)
+    parser.feed(b"<chunk>")
+    decompressor = bz2.BZ2Decompressor()
+    data = memoryview(data)
+    for offset in range(0, len(data), DECOMPRESS_BLOCK_SIZE):
+        block = data[offset:offset + DECOMPRESS_BLOCK_SIZE]
+        while block:
+            # The last chunk is followed by a separate stream holding the closing </mediawiki>
+            if decompressor.eof:
+                decompressor = bz2.BZ2Decompressor()
+            parser.feed(decompressor.decompress(block))
+            block = decompressor.unused_data if decompressor.eof else b""
+            yield from _read_pages(parser)
+
+
+def _read_pages(parser: etree.XMLPullParser) -> Iterator[tuple[str, str]]:
+    for _, page in parser.read_events():
+        title = page.findtext('{*}title')
+        text = page.findtext('{*}revision/{*}text') or ''
+        # Discard pages as we go so we never hold more than one page of the chunk
+        page.clear()
+        while page.getprevious() is not None:
+            del page.getparent()[0]
+        yield title, text
+
+
+class WikipediaDump():
+    """ Read only access to a local multistream bz2 copy of wikipedia.
+
+        This holds no vector store state, so it is cheap to open in worker processes for bulk extraction.
+    """
+
+    def __init__(self, index_filename: str, wiki_filename: str, chunk_cache_bytes: int, page_cache_bytes: int,
+                 title_index_path: str = WIKI_INDEX_FILE):
+        self.index_filename = index_filename
+        self.wiki_filename = wiki_filename
+        # The title index is memory mapped, building it is a one time conversion of the multistream index
+        if not path.exists(title_index_path):
+            print("Building wiki index, this only happens once")
+            build_title_index(self.index_filename, title_index_path)
+        self.wiki_index = TitleIndex(title_index_path)
+        # Keep the dump open, chunks are read with pread so this is safe to share between threads
+        self._wiki_fd = os.open(self.wiki_filename, os.O_RDONLY)
+        self._wiki_file_size = os.fstat(self._wiki_fd).st_size
+
+        # Related pages tend to live in the same chunk, so cache every page split out of a decompressed chunk
+        # keyed by its byte range, as well as the parsed pages themselves keyed by title
+        self.chunk_cache = LRUCache(chunk_cache_bytes, sizeof=lambda pages: sum(len(t) + len(p) for t, p in pages.items()))
+        self.page_cache = LRUCache(page_cache_bytes, sizeof=lambda page: len(page.string))
+
+    def locate(self, page_title: str) -> Optional[tuple[int, int]]:
+        """ Get the (start_byte, data_length) of the chunk containing a page, or None if the page is not in the dump """
+        return self.wiki_index.get(page_title)
+
+    def get_page(self, page_title: str) -> Union[wtp.WikiText, None]:
+        """ Get the wikitext for a page given its title """
+        parsed_page = self.page_cache.get(page_title)
+        if parsed_page is not None:
+            return parsed_page
+        try:
+            start_byte, data_length = self._search_index(page_title)
+        except KeyError:
+            return None
+        if self.chunk_cache.max_size > 0:
+            page_text = self.get_chunk_pages(start_byte, data_length).get(page_title)
+            if page_text is None:
+                # TODO: handle this better
+                print(f'didnt find {page_title}')
+                return None
+            parsed_page = wtp.parse(page_text)
+        else:
+            # Nothing to gain from splitting out the whole chunk, stop as soon as we find the page
+            with span("decompress_chunk"):
+                parsed_page = self._extract_page_from_chunk(page_title, self._read_chunk(start_byte, data_length))
+            if parsed_page is None:
+                return None
+        self.page_cache.put(page_title, parsed_page)
+        return parsed_page
+
+    def get_chunk_pages(self, start_byte: int, data_length: int) -> dict[str, str]:
+        """ Get the raw wikitext of every page in a chunk keyed by title, decompressing the chunk on a cache miss """
+        chunk_key = (start_byte, data_length)
+        pages = self.chunk_cache.get(chunk_key)
+        if pages is None:
+            with span("decompress_chunk"):
+                pages = dict(iter_pages_from_chunk(self._read_chunk(start_byte, data_length)))
+            self.chunk_cache.put(chunk_key, pages)
+        return pages
+
+    def cache_stats(self) -> dict:
+        """ Hit and miss counters for the chunk and page caches """
+        return {"chunk_cache": self.chunk_cache.stats(), "page_cache": self.page_cache.stats()}
+
+    def _search_index(self, page_title: str) -> tuple[int, int]:
+        """ Search downloaded index for the btye range of the chunk containing the page """
+        return self.wiki_index[page_title]
+
+    def _read_chunk(self, start_byte: int, data_length: int) -> bytes:
+        """ Read a compressed chunk of the wikpedia dump """
+        # The last chunk in the dump has a data_length of -1 and is read to the end of the file
+        if data_length < 0:
+            data_length = self._wiki_file_size - start_byte
+        return os.pread(self._wiki_fd, data_length, start_byte)
+
+    def _extract_page_from_chunk(self, page_title: str, chunk: bytes) -> Optional[wtp.WikiText]:
+        """ Stream a compressed chunk and return the page contents as WikiText for a given page title"""
+        for title, text in iter_pages_from_chunk(chunk):
+            if title == page_title:
+                return wtp.parse(text)
+        # TODO: handle this better
+        print(f'didnt find {page_title}')
+        return None